@@ -0,0 +1,125 @@
+"""
+Benchmark of the bass drums on beat scoring from midi_utils, compares the
+original nested loop implementation with the vectorized implementations
+(one file at a time and batched) on synthetic drum tracks, and checks that
+they return identical results.
+"""
+
+import argparse
+import math
+import random
+import timeit
+
+import numpy as np
+from pretty_midi import Instrument
+from pretty_midi import Note
+from pretty_midi import PrettyMIDI
+
+from midi_utils import get_bass_drums
+from midi_utils import get_bass_drums_on_beat
+from midi_utils import get_bass_drums_on_beat_batch
+from midi_utils import get_bass_drums_on_beat_ratio
+from midi_utils import get_bass_drums_on_beat_ratios
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--num_files", type=int, default=20)
+parser.add_argument("--length", type=float, default=600,
+                    help="The length of each track in seconds")
+parser.add_argument("--seed", type=int, default=42)
+args = parser.parse_args()
+
+
+def _get_bass_drums_on_beat_loop(pm_drums: PrettyMIDI) -> float:
+  # The original implementation, O(beats * bass drums)
+  beats = pm_drums.get_beats()
+  bass_drums = [note.start for note in pm_drums.instruments[0].notes
+                if note.pitch == 35 or note.pitch == 36]
+  return _get_bass_drums_on_beat_ratio_loop(beats, bass_drums)
+
+
+def _get_bass_drums_on_beat_ratio_loop(beats, bass_drums) -> float:
+  bass_drums_on_beat = []
+  for beat in beats:
+    beat_has_bass_drum = False
+    for bass_drum in bass_drums:
+      if math.isclose(beat, bass_drum):
+        beat_has_bass_drum = True
+        break
+    bass_drums_on_beat.append(True if beat_has_bass_drum else False)
+  num_bass_drums_on_beat = len([bd for bd in bass_drums_on_beat if bd])
+  return num_bass_drums_on_beat / len(bass_drums_on_beat)
+
+
+def _generate_drums(length: float, rng: random.Random) -> PrettyMIDI:
+  tempo = rng.choice([90, 120, 128, 140])
+  pm_drums = PrettyMIDI(initial_tempo=tempo)
+  drums = Instrument(program=0, is_drum=True)
+  beat_length = 60 / tempo
+  on_beat_probability = rng.random()
+  for beat in np.arange(0, length, beat_length / 2):
+    if rng.random() < on_beat_probability:
+      # Uses the same rounding as the beats, with some jitter to check the
+      # tolerance (1e-12 is close, 1e-6 is not)
+      start = pm_drums.tick_to_time(int(pm_drums.time_to_tick(beat)))
+      start += rng.choice([0, 0, 1e-12, 1e-6])
+      drums.notes.append(Note(100, rng.choice([35, 36]), start, start + 0.1))
+    drums.notes.append(Note(80, 42, beat + 0.01, beat + 0.05))
+  pm_drums.instruments.append(drums)
+  return pm_drums
+
+
+def _time(name: str, function, baseline: float = None) -> tuple:
+  start = timeit.default_timer()
+  result = function()
+  duration = timeit.default_timer() - start
+  speedup = f", speedup: {baseline / duration:.1f}x" if baseline else ""
+  print(f"{name}: {duration:.3f} sec{speedup}")
+  return duration, result
+
+
+def app():
+  rng = random.Random(args.seed)
+  pm_drums_list = [_generate_drums(args.length, rng)
+                   for _ in range(args.num_files)]
+  print(f"Number of files: {len(pm_drums_list)}, "
+        f"length: {args.length} sec")
+
+  # Scoring only, the beats and bass drums are extracted beforehand
+  beats_list = [pm_drums.get_beats() for pm_drums in pm_drums_list]
+  bass_drums_list = [get_bass_drums(pm_drums) for pm_drums in pm_drums_list]
+  print(f"Number of beats: {sum(len(beats) for beats in beats_list)}, "
+        f"number of bass drums: "
+        f"{sum(len(bass_drums) for bass_drums in bass_drums_list)}")
+  loop_duration, loop_ratios = _time(
+    "Loop (scoring)",
+    lambda: [_get_bass_drums_on_beat_ratio_loop(beats, bass_drums.tolist())
+             for beats, bass_drums in zip(beats_list, bass_drums_list)])
+  _, vectorized_ratios = _time(
+    "Vectorized (scoring)",
+    lambda: [get_bass_drums_on_beat_ratio(beats, bass_drums)
+             for beats, bass_drums in zip(beats_list, bass_drums_list)],
+    loop_duration)
+  _, batch_ratios = _time(
+    "Batch (scoring)",
+    lambda: get_bass_drums_on_beat_ratios(beats_list, bass_drums_list),
+    loop_duration)
+  assert loop_ratios == vectorized_ratios, "Vectorized results differ"
+  assert loop_ratios == batch_ratios.tolist(), "Batch results differ"
+
+  # End to end, including the beats computation
+  loop_duration, loop_ratios = _time(
+    "Loop", lambda: [_get_bass_drums_on_beat_loop(pm_drums)
+                     for pm_drums in pm_drums_list])
+  _, vectorized_ratios = _time(
+    "Vectorized", lambda: [get_bass_drums_on_beat(pm_drums)
+                           for pm_drums in pm_drums_list], loop_duration)
+  _, batch_ratios = _time(
+    "Batch", lambda: get_bass_drums_on_beat_batch(pm_drums_list),
+    loop_duration)
+  assert loop_ratios == vectorized_ratios, "Vectorized results differ"
+  assert loop_ratios == batch_ratios.tolist(), "Batch results differ"
+  print("Results are identical")
+
+
+if __name__ == "__main__":
+  app()
@@ -0,0 +1,61 @@
+"""
+Microbenchmark of the progress counters from multiprocessing_utils, compares
+the increments per second of the manager backed AtomicCounter and the shared
+memory SharedCounter, incremented from all the workers of a pool.
+"""
+
+import argparse
+import timeit
+from itertools import cycle
+from multiprocessing import Manager
+from multiprocessing.pool import Pool
+
+from multiprocessing_utils import AtomicCounter
+from multiprocessing_utils import SharedCounter
+from multiprocessing_utils import init_shared_counters
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--pool_size", type=int, default=4)
+parser.add_argument("--increments", type=int, default=100000)
+parser.add_argument("--increments_per_task", type=int, default=100)
+args = parser.parse_args()
+
+
+def _increment(count: int, counter):
+  for _ in range(count):
+    counter.increment()
+
+
+def _benchmark(name: str, counter, pool: Pool):
+  tasks = [args.increments_per_task] * (args.increments
+                                        // args.increments_per_task)
+  start = timeit.default_timer()
+  pool.starmap(_increment, zip(tasks, cycle([counter])))
+  stop = timeit.default_timer()
+  assert counter.value() == sum(tasks)
+  increments_per_sec = sum(tasks) / (stop - start)
+  print(f"{name}: {sum(tasks)} increments in {stop - start:.2f} sec "
+        f"({increments_per_sec:.0f} increments/sec)")
+  return increments_per_sec
+
+
+def app():
+  # Prints only at the start and the end
+  print_step = args.increments
+
+  with Pool(args.pool_size) as pool:
+    manager = Manager()
+    atomic_counter = AtomicCounter(manager, args.increments, print_step)
+    atomic_rate = _benchmark("AtomicCounter", atomic_counter, pool)
+
+  shared_counter = SharedCounter(args.increments, print_step)
+  with Pool(args.pool_size,
+            initializer=init_shared_counters,
+            initargs=(shared_counter,)) as pool:
+    shared_rate = _benchmark("SharedCounter", shared_counter, pool)
+
+  print(f"Speedup: {shared_rate / atomic_rate:.1f}x")
+
+
+if __name__ == "__main__":
+  app()
@@ -0,0 +1,154 @@
+"""
+Benchmark of the examples on a dataset, use the synthetic_dataset_utils.py
+file to generate a synthetic dataset of any size. Each example is run in a
+separate process for each pool size, and the throughput (items per second),
+the CPU time and utilization, the peak memory (RSS) of the largest process
+(the main process or a pool worker) and the size of the results sent back
+from the pool workers (IPC) are reported.
+"""
+
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+import timeit
+from typing import Dict
+from typing import List
+from typing import Optional
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--examples", type=str, default="00,01,04,05,06,09")
+parser.add_argument("--pool_sizes", type=str, default="1,2,4")
+parser.add_argument("--sample_size", type=int, default=0)
+parser.add_argument("--path_dataset_dir", type=str, required=True)
+parser.add_argument("--path_match_scores_file", type=str)
+parser.add_argument("--path_tag_cache", type=str)
+parser.add_argument("--path_output_dir", type=str, required=True)
+parser.add_argument("--path_report", type=str)
+args = parser.parse_args()
+EXAMPLES = args.examples.split(",")
+POOL_SIZES = [int(pool_size) for pool_size in args.pool_sizes.split(",")]
+TAG_EXAMPLES = ["02", "03", "07", "08"]
+if set(EXAMPLES) & set(TAG_EXAMPLES) and not args.path_tag_cache:
+  parser.error(f"--path_tag_cache is required for the examples "
+               f"{','.join(TAG_EXAMPLES)}")
+
+# The examples measuring the size of their results
+RESULT_SIZE_EXAMPLES = ["00", "05", "06", "07", "08"]
+
+
+def get_example_args(example: str, pool_size: int) -> List[str]:
+  """
+  Returns the command line arguments of the given example, the examples
+  using tags only use the tag cache (no requests to the Last.fm API).
+
+  :param example: the example number, for example "04"
+  :param pool_size: the number of processes of the example
+  :return: the list of arguments
+  """
+  output_dir = os.path.join(args.path_output_dir, f"example_{example}")
+  example_args = ["--sample_size", str(args.sample_size),
+                  "--pool_size", str(pool_size),
+                  "--path_dataset_dir", args.path_dataset_dir]
+  if example == "00":
+    return example_args + ["--path_output_dir", output_dir,
+                           "--bass_drums_on_beat_threshold", "0.75",
+                           "--measure_result_size"]
+  example_args += ["--path_match_scores_file",
+                   args.path_match_scores_file
+                   or os.path.join(args.path_dataset_dir, "match_scores.json")]
+  if example in TAG_EXAMPLES or example == "09":
+    if args.path_tag_cache:
+      example_args += ["--path_tag_cache", args.path_tag_cache,
+                       "--tag_cache_only"]
+  if example in ["03", "07", "08"]:
+    example_args += ["--tags", "['jazz', 'blues']"]
+  if example in ["05", "06", "07", "08", "09"]:
+    example_args += ["--path_output_dir", output_dir]
+  if example == "09":
+    outputs = ["artist", "classes", "drums", "pianos"]
+    if args.path_tag_cache:
+      outputs.insert(1, "tags")
+    example_args += ["--outputs", ",".join(outputs)]
+  if example in RESULT_SIZE_EXAMPLES:
+    example_args += ["--measure_result_size"]
+  return example_args
+
+
+def run_example(example: str, pool_size: int) -> Optional[Dict]:
+  """
+  Runs the given example in a new process and returns its measures, the CPU
+  time includes the pool workers, the peak memory is the peak of the largest
+  process (ru_maxrss is a per process maximum, not a sum).
+
+  :param example: the example number, for example "04"
+  :param pool_size: the number of processes of the example
+  :return: the dictionary of measures, None if the example failed
+  """
+  command = ([sys.executable, f"chapter_06_example_{example}.py"]
+             + get_example_args(example, pool_size))
+  env = dict(os.environ, MPLBACKEND="Agg")
+  start = timeit.default_timer()
+  process = subprocess.Popen(command,
+                             stdout=subprocess.PIPE,
+                             stderr=subprocess.STDOUT,
+                             cwd=os.path.dirname(os.path.abspath(__file__)),
+                             env=env,
+                             universal_newlines=True)
+  output = process.stdout.read()
+  process.stdout.close()
+  # Waits for the example with wait4 to get the resources usage of the
+  # example and of its (waited) pool workers
+  _, status, rusage = os.wait4(process.pid, 0)
+  process.returncode = os.waitstatus_to_exitcode(status)
+  duration = timeit.default_timer() - start
+  if process.returncode != 0:
+    print(f"Exception during processing of example {example}: "
+          f"{output.strip().splitlines()[-1:]}")
+    return None
+
+  # Example 00 prints the sample size at the start of its line
+  items = re.search(r"number of tracks in sample: (\d+)", output,
+                    re.IGNORECASE)
+  result_size = re.search(r"Result size: (\d+) bytes per result", output)
+  items = int(items.group(1)) if items else 0
+  cpu_time = rusage.ru_utime + rusage.ru_stime
+  return {"example": example,
+          "pool_size": pool_size,
+          "items": items,
+          "duration": duration,
+          "items_per_sec": items / duration,
+          "cpu_time": cpu_time,
+          "cpu_utilization": cpu_time / (duration * pool_size),
+          "max_process_rss_mb": rusage.ru_maxrss / 1024,
+          "result_size": int(result_size.group(1)) if result_size else None}
+
+
+def app():
+  measures = []
+  print(f"{'example':>8}{'pool':>6}{'items':>8}{'items/s':>10}"
+        f"{'time (s)':>10}{'cpu (s)':>10}{'cpu %':>8}{'max rss/proc (MB)':>20}"
+        f"{'ipc (B)':>10}")
+  for example in EXAMPLES:
+    for pool_size in POOL_SIZES:
+      measure = run_example(example, pool_size)
+      if not measure:
+        continue
+      measures.append(measure)
+      result_size = measure["result_size"]
+      print(f"{example:>8}{pool_size:>6}{measure['items']:>8}"
+            f"{measure['items_per_sec']:>10.2f}"
+            f"{measure['duration']:>10.2f}"
+            f"{measure['cpu_time']:>10.2f}"
+            f"{measure['cpu_utilization'] * 100:>8.0f}"
+            f"{measure['max_process_rss_mb']:>20.1f}"
+            f"{result_size if result_size is not None else '-':>10}")
+  if args.path_report:
+    with open(args.path_report, "w") as file:
+      json.dump(measures, file, indent=2)
+
+
+if __name__ == "__main__":
+  app()
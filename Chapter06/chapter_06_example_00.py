@@ -4,141 +4,320 @@ Extract techno (four on the floor) drum rhythms.
 VERSION: Magenta 1.1.7
 """
 import argparse
-import copy
-import glob
-import math
 import os
-import random
 import shutil
 import timeit
-from itertools import cycle
-from multiprocessing import Manager
+from collections import Counter
+from itertools import chain
 from multiprocessing.pool import Pool
 from typing import List
 from typing import Optional
+from typing import Union
 
 import matplotlib.pyplot as plt
-from pretty_midi import Instrument
 from pretty_midi import PrettyMIDI
 
-from multiprocessing_utils import AtomicCounter
+from dedup_utils import DEDUP_MODES
+from dedup_utils import print_duplicates
+from dedup_utils import remove_duplicates
+from lakh_utils import SAMPLING_MODES
+from lakh_utils import sample_midi_paths
+from manifest_utils import Manifest
+from manifest_utils import get_fingerprint
+from manifest_utils import get_pending
+from metrics_utils import init_metrics
+from midi_utils import get_bass_drums_on_beat
+from midi_utils import get_drums_or_rejection
+from midi_utils import is_drum_instrument
+from midi_utils import read_midi
+from midi_utils import write_midi
+from multiprocessing_utils import SharedCounter
+from multiprocessing_utils import WorkerLimits
+from multiprocessing_utils import WorkerUtilization
+from multiprocessing_utils import get_pickled_size
+from multiprocessing_utils import imap_results
+from multiprocessing_utils import sort_largest_first
+from note_cache_utils import NoteCache
+from note_cache_utils import get_cached_bass_drums_on_beat
+from note_cache_utils import get_cached_drum_tracks_count
+from quarantine_utils import Quarantine
+from rejection_utils import Rejected
+from rejection_utils import Rejection
+from rejection_utils import print_rejections
+from shard_utils import Shard
+from shard_utils import save_stats
+from smf_utils import read_midi_filtered
+from tfrecord_utils import NoteSequenceWriter
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--sample_size", type=int, default=1000)
+parser.add_argument("--sampling", type=str, default="reservoir",
+                    choices=SAMPLING_MODES)
+parser.add_argument("--seed", type=int)
 parser.add_argument("--pool_size", type=int, default=4)
+parser.add_argument("--chunksize", type=int, default=1)
+parser.add_argument("--compact_results", action="store_true")
+parser.add_argument("--measure_result_size", action="store_true")
 parser.add_argument("--path_dataset_dir", type=str, required=True)
 parser.add_argument("--path_output_dir", type=str, required=True)
+parser.add_argument("--output_format", type=str, default="midi",
+                    choices=["midi", "tfrecord"])
+parser.add_argument("--path_note_cache", type=str)
+parser.add_argument("--path_manifest", type=str)
+parser.add_argument("--resume", action="store_true")
+parser.add_argument("--retry_errors", action="store_true")
 parser.add_argument("--bass_drums_on_beat_threshold",
                     type=float, required=True, default=0)
+parser.add_argument("--bass_drums_on_beat_tolerance", type=float, default=0)
+parser.add_argument("--scan_midi", action="store_true")
+parser.add_argument("--dedup", type=str, choices=DEDUP_MODES)
+parser.add_argument("--path_duplicates", type=str)
+parser.add_argument("--largest_first", action="store_true")
+parser.add_argument("--print_utilization", action="store_true")
+parser.add_argument("--soft_timeout", type=float)
+parser.add_argument("--hard_timeout", type=float)
+parser.add_argument("--soft_rss_limit", type=float)
+parser.add_argument("--hard_rss_limit", type=float)
+parser.add_argument("--path_quarantine", type=str)
+parser.add_argument("--num_shards", type=int, default=1)
+parser.add_argument("--shard_index", type=int, default=0)
+parser.add_argument("--path_stats", type=str)
+parser.add_argument("--path_metrics", type=str)
+parser.add_argument("--metrics_interval", type=float)
 args = parser.parse_args()
+if not 0 <= args.shard_index < args.num_shards:
+  parser.error("--shard_index must be lower than --num_shards")
+if args.resume and not args.path_manifest:
+  parser.error("--path_manifest is required with --resume")
+if args.resume and args.output_format == "tfrecord":
+  # The records of the reprocessed inputs would stay in the TFRecord files
+  # of the previous runs, and be duplicated when concatenating the files
+  parser.error("--resume is not supported with --output_format=tfrecord")
+if (args.soft_timeout and args.hard_timeout
+    and args.hard_timeout <= args.soft_timeout):
+  parser.error("--hard_timeout must be greater than --soft_timeout")
 
-# The list of all MIDI paths on disk (we might process only a sample)
-MIDI_PATHS = glob.glob(os.path.join(args.path_dataset_dir, "**", "*.mid"),
-                       recursive=True)
+# The shard of the dataset processed by this run, None if not sharded
+SHARD = (Shard(args.num_shards, args.shard_index)
+         if args.num_shards > 1 else None)
 
+# The optional metrics of the run (the durations of the stages, the errors
+# and the bytes read and written), aggregated from the pool workers
+METRICS = (init_metrics(args.path_metrics, args.metrics_interval)
+           if args.path_metrics else None)
 
-def extract_drums(midi_path: str) -> Optional[PrettyMIDI]:
+# The optional time and memory limits of the pool workers, the inputs
+# exceeding them are rejected and quarantined
+WORKER_LIMITS = (
+  WorkerLimits(args.pool_size, args.soft_timeout, args.hard_timeout,
+               args.soft_rss_limit, args.hard_rss_limit)
+  if any([args.soft_timeout, args.hard_timeout, args.soft_rss_limit,
+          args.hard_rss_limit]) else None)
+
+# The optional skip list of the inputs that exceeded the worker limits,
+# in this run or in the previous runs
+QUARANTINE = (Quarantine(args.path_quarantine)
+              if args.path_quarantine else None)
+
+# The optional NoteSequence writer, used instead of writing MIDI files if
+# the output format is TFRecord
+NOTE_SEQUENCE_WRITER = (NoteSequenceWriter(args.path_output_dir, "drums")
+                        if args.output_format == "tfrecord" else None)
+
+# The optional note cache, used instead of parsing the MIDI files if provided
+NOTE_CACHE = (NoteCache(args.path_note_cache)
+              if args.path_note_cache else None)
+
+# The optional manifest of the processed items, to resume the run
+MANIFEST = Manifest(args.path_manifest) if args.path_manifest else None
+
+# The arguments changing the outputs, a resumed run must use the same
+MANIFEST_CONFIG = {"path_output_dir": args.path_output_dir,
+                   "output_format": args.output_format,
+                   "dedup": args.dedup,
+                   "bass_drums_on_beat_threshold":
+                     args.bass_drums_on_beat_threshold,
+                   "bass_drums_on_beat_tolerance":
+                     args.bass_drums_on_beat_tolerance}
+
+
+def extract_drums(midi_path: str) -> Union[PrettyMIDI, Rejected]:
   """
   Extracts a PrettyMIDI instance of all the merged drum tracks
   from the given MIDI path.
 
   :param midi_path: the path to the MIDI file
-  :return: the PrettyMIDI instance of the merged drum tracks
+  :return: the PrettyMIDI instance of the merged drum tracks, or the
+  rejection if there are no drums
   """
   os.makedirs(args.path_output_dir, exist_ok=True)
-  pm = PrettyMIDI(midi_path)
-  pm_drums = copy.deepcopy(pm)
-  pm_drums.instruments = [instrument for instrument in pm_drums.instruments
-                          if instrument.is_drum]
-  if len(pm_drums.instruments) > 1:
-    # Some drum tracks are split, we can merge them
-    drums = Instrument(program=0, is_drum=True)
-    for instrument in pm_drums.instruments:
-      for note in instrument.notes:
-        drums.notes.append(note)
-    pm_drums.instruments = [drums]
-  if len(pm_drums.instruments) != 1:
-    raise Exception(f"Invalid number of drums {midi_path}: "
-                    f"{len(pm_drums.instruments)}")
-  return pm_drums
-
-
-def get_bass_drums_on_beat(pm_drums: PrettyMIDI) -> float:
+  if args.scan_midi:
+    # Only parses the drum tracks, see smf_utils
+    pm = read_midi_filtered(midi_path, is_drum_instrument)
+  else:
+    pm = read_midi(midi_path)
+  return get_drums_or_rejection(pm)
+
+
+def reject(midi_path: str,
+           fingerprint: Optional[str],
+           rejected: Rejected) -> Rejected:
   """
-  Returns the ratio of the bass drums that fall directly on a beat.
+  Records the filtered MIDI file in the manifest, as processed without
+  result, so it isn't processed again when resuming.
 
-  :param pm_drums: the PrettyMIDI instance to analyse
-  :return: the ratio of the bass drums that fall on a beat
+  :param midi_path: the MIDI file path
+  :param fingerprint: the fingerprint of the MIDI file
+  :param rejected: the rejection
+  :return: the rejection
   """
-  beats = pm_drums.get_beats()
-  bass_drums = [note.start for note in pm_drums.instruments[0].notes
-                if note.pitch == 35 or note.pitch == 36]
-  bass_drums_on_beat = []
-  for beat in beats:
-    beat_has_bass_drum = False
-    for bass_drum in bass_drums:
-      if math.isclose(beat, bass_drum):
-        beat_has_bass_drum = True
-        break
-    bass_drums_on_beat.append(True if beat_has_bass_drum else False)
-  num_bass_drums_on_beat = len([bd for bd in bass_drums_on_beat if bd])
-  return num_bass_drums_on_beat / len(bass_drums_on_beat)
-
-
-def process(midi_path: str, counter: AtomicCounter) -> Optional[dict]:
+  if MANIFEST is not None:
+    MANIFEST.put(midi_path, fingerprint)
+  return rejected
+
+
+def process(midi_path: str) -> Union[dict, Rejected]:
   """
-  Processes the MIDI file at the given path and increments the counter. The
-  method will call the extract_drums method and the get_bass_drums_on_beat
-  method, and write the resulting drum file if the bass drum ratio is over
-  the threshold.
+  Processes the MIDI file at the given path. The method will call the
+  extract_drums method and the get_bass_drums_on_beat method, and write the
+  resulting drum file if the bass drum ratio is over the threshold.
 
   :param midi_path: the MIDI file path to process
-  :param counter: the counter to increment
-  :return: the dictionary containing the MIDI path, the PrettyMIDI instance
-  and the ratio of bass drum on beat, raises an exception if the file cannot
-  be processed
+  :return: the dictionary containing the MIDI path, the output path, the drums
+  end time and note count, the ratio of bass drum on beat and the PrettyMIDI
+  instance (unless the results are compact), or the rejection if the file is
+  filtered or cannot be processed
   """
+  fingerprint = None
   try:
-    pm_drums = extract_drums(midi_path)
-    bass_drums_on_beat = get_bass_drums_on_beat(pm_drums)
-    if bass_drums_on_beat >= args.bass_drums_on_beat_threshold:
-      midi_filename = os.path.basename(midi_path)
-      pm_drums.write(os.path.join(args.path_output_dir, f"{midi_filename}.mid"))
+    if MANIFEST is not None:
+      fingerprint = get_fingerprint(midi_path)
+    midi_md5 = os.path.splitext(os.path.basename(midi_path))[0]
+    cached_midi = NOTE_CACHE.get(midi_md5) if NOTE_CACHE is not None else None
+    if cached_midi is not None:
+      # Scores the drums from the note cache, so that the MIDI file is only
+      # parsed for the drums that are written
+      if get_cached_drum_tracks_count(cached_midi) == 0:
+        return reject(midi_path, fingerprint,
+                      Rejected(Rejection.NO_DRUMS, 0))
+      bass_drums_on_beat = get_cached_bass_drums_on_beat(
+        cached_midi, abs_tol=args.bass_drums_on_beat_tolerance)
+      if bass_drums_on_beat < args.bass_drums_on_beat_threshold:
+        return reject(midi_path, fingerprint,
+                      Rejected(Rejection.NOT_ON_BEAT, bass_drums_on_beat))
+      pm_drums = extract_drums(midi_path)
+      if isinstance(pm_drums, Rejected):
+        # The cache is stale, the parsed file has no drums
+        return reject(midi_path, fingerprint, pm_drums)
+    else:
+      pm_drums = extract_drums(midi_path)
+      if isinstance(pm_drums, Rejected):
+        return reject(midi_path, fingerprint, pm_drums)
+      bass_drums_on_beat = get_bass_drums_on_beat(
+        pm_drums, abs_tol=args.bass_drums_on_beat_tolerance)
+      if bass_drums_on_beat < args.bass_drums_on_beat_threshold:
+        return reject(midi_path, fingerprint,
+                      Rejected(Rejection.NOT_ON_BEAT, bass_drums_on_beat))
+    midi_filename = os.path.basename(midi_path)
+    if NOTE_SEQUENCE_WRITER is not None:
+      output_path = NOTE_SEQUENCE_WRITER.write(pm_drums, midi_filename)
     else:
-      raise Exception(f"Not on beat {midi_path}: {bass_drums_on_beat}")
-    return {"midi_path": midi_path,
-            "pm_drums": pm_drums,
-            "bass_drums_on_beat": bass_drums_on_beat}
+      output_path = os.path.join(args.path_output_dir, f"{midi_filename}.mid")
+      write_midi(pm_drums, output_path)
+    result = {"midi_path": midi_path,
+              "output_path": output_path,
+              "end_time": pm_drums.get_end_time(),
+              "note_count": len(pm_drums.instruments[0].notes),
+              "bass_drums_on_beat": bass_drums_on_beat}
+    if MANIFEST is not None:
+      MANIFEST.put(midi_path, fingerprint, result=result,
+                   output_paths=[output_path])
+    if not args.compact_results:
+      result["pm_drums"] = pm_drums
+    return result
   except Exception as e:
-    if "Not on beat" not in str(e):
-      print(f"Exception during processing of {midi_path}: {e}")
-  finally:
-    counter.increment()
+    print(f"Exception during processing of {midi_path}: {e}")
+    if MANIFEST is not None:
+      MANIFEST.put(midi_path, fingerprint, error=str(e))
+    return Rejected(Rejection.ERROR, str(e))
 
 
-def app(midi_paths: List[str]):
+def app(midi_paths: List[str], tracks_count: Optional[int]):
   start = timeit.default_timer()
 
-  # Cleanup the output directory
-  shutil.rmtree(args.path_output_dir, ignore_errors=True)
+  # Skips the MIDI files with the same content as another file of the sample
+  # before parsing them, the duplicates are mapped to the kept MIDI files
+  unique_midi_paths, duplicates = (
+    remove_duplicates(midi_paths, lambda midi_path: midi_path, args.dedup,
+                      args.pool_size, NOTE_CACHE, args.path_duplicates)
+    if args.dedup else (midi_paths, {}))
+
+  if args.resume:
+    # Only processes the new items and the items whose input changed, the
+    # results of the other items are read from the manifest
+    MANIFEST.check_config(MANIFEST_CONFIG)
+    pending_midi_paths, processed_results = get_pending(
+      MANIFEST, unique_midi_paths, get_fingerprint, args.retry_errors)
+    print(f"Number of items already processed: "
+          f"{len(unique_midi_paths) - len(pending_midi_paths)}")
+  else:
+    if SHARD is None:
+      # Cleanup the output directory, the shards of a sharded run share
+      # it (the output files are named after the input files)
+      shutil.rmtree(args.path_output_dir, ignore_errors=True)
+    if MANIFEST is not None:
+      MANIFEST.reset(MANIFEST_CONFIG)
+    pending_midi_paths, processed_results = unique_midi_paths, []
+
+  if args.largest_first:
+    # Starts the largest files first, so the pool doesn't wait for a
+    # single worker processing a large file at the end of the run
+    pending_midi_paths = sort_largest_first(pending_midi_paths,
+                                            lambda midi_path: midi_path)
 
   # Starts the threads
+  counter = SharedCounter(len(pending_midi_paths), 1000)
   with Pool(args.pool_size) as pool:
-    manager = Manager()
-    counter = AtomicCounter(manager, len(midi_paths), 1000)
     print("START")
-    results = pool.starmap(process, zip(midi_paths, cycle([counter])))
-    results = [result for result in results if result]
+    utilization = WorkerUtilization() if args.print_utilization else None
+    results_count = 0
+    rejections = Counter()
+    results_size = 0
+    pm_drums_lengths = []
+    bass_drums_on_beat = []
+    for result in chain(processed_results,
+                        imap_results(pool, process, pending_midi_paths,
+                                     counter, args.chunksize, METRICS,
+                                     rejections,
+                                     utilization=utilization,
+                                     limits=WORKER_LIMITS,
+                                     quarantine=QUARANTINE)):
+      results_count += 1
+      if args.measure_result_size:
+        results_size += get_pickled_size(result)
+      pm_drums_lengths.append(result["end_time"])
+      bass_drums_on_beat.append(result["bass_drums_on_beat"])
     print("END")
-    results_percentage = len(results) / len(midi_paths) * 100
-    print(f"Number of tracks: {len(MIDI_PATHS)}, "
-          f"number of tracks in sample: {len(midi_paths)}, "
-          f"number of results: {len(results)} "
+    # The duplicates aren't processed, the results and rejections are
+    # counted over the unique tracks of the sample
+    results_percentage = results_count / len(unique_midi_paths) * 100
+    if tracks_count is not None:
+      # Unknown with the "directories" sampling
+      print(f"Number of tracks: {tracks_count}")
+    print(f"Number of tracks in sample: {len(midi_paths)}, "
+          f"number of unique tracks in sample: {len(unique_midi_paths)}, "
+          f"number of results: {results_count} "
           f"({results_percentage:.2f}%)")
+    print_rejections(rejections, len(unique_midi_paths))
+    if args.dedup:
+      print_duplicates(duplicates, len(midi_paths))
+    if utilization is not None:
+      utilization.print()
+    if args.measure_result_size and results_count:
+      print(f"Result size: {results_size // results_count} bytes per result "
+            f"(total: {results_size} bytes)")
 
   # Creates an histogram for the drum lengths
-  pm_drums = [result["pm_drums"] for result in results]
-  pm_drums_lengths = [pm.get_end_time() for pm in pm_drums]
   plt.figure(num=None, figsize=(10, 8), dpi=500)
   plt.hist(pm_drums_lengths, bins=100, color="darkmagenta")
   plt.title('Drums lengths')
@@ -146,22 +325,38 @@ def app(midi_paths: List[str]):
   plt.show()
 
   # Creates an histogram for the bass drums on beat
-  bass_drums_on_beat = [result["bass_drums_on_beat"] for result in results]
   plt.figure(num=None, figsize=(10, 8), dpi=500)
   plt.hist(bass_drums_on_beat, bins=100, color="darkmagenta")
   plt.title('Bass drums on beat')
   plt.ylabel('count')
   plt.show()
 
+  if METRICS is not None:
+    METRICS.save()
+
+  if args.path_stats:
+    # The statistics of the run, merged with the other shards using the
+    # shard_utils.py file
+    stats = {"tracks_in_sample": len(midi_paths),
+             "unique_tracks_in_sample": len(unique_midi_paths),
+             "results": results_count,
+             "drums_lengths": pm_drums_lengths,
+             "bass_drums_on_beat": bass_drums_on_beat,
+             "rejections": rejections,
+             "duplicates": len(duplicates)}
+    if tracks_count is not None:
+      stats["tracks"] = tracks_count
+    save_stats(args.path_stats, stats)
+
   stop = timeit.default_timer()
   print("Time: ", stop - start)
 
 
 if __name__ == "__main__":
-  if args.sample_size:
-    # Process a sample of it
-    MIDI_PATHS_SAMPLE = random.sample(list(MIDI_PATHS), args.sample_size)
-  else:
-    # Process all the dataset
-    MIDI_PATHS_SAMPLE = list(MIDI_PATHS)
-  app(MIDI_PATHS_SAMPLE)
+  # The MIDI paths to process (we might process only a sample), the dataset
+  # is walked lazily by the main process and only the sample is kept, the
+  # pool workers don't use it. The paths relative to the dataset are the
+  # same on every machine, they are used for the shards
+  MIDI_PATHS_SAMPLE, TRACKS_COUNT = sample_midi_paths(
+    args.path_dataset_dir, args.sample_size, SHARD, args.sampling, args.seed)
+  app(MIDI_PATHS_SAMPLE, TRACKS_COUNT)
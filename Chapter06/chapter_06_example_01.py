@@ -5,74 +5,102 @@ VERSION: Magenta 1.1.7
 """
 
 import argparse
-import random
 import timeit
 from collections import Counter
-from itertools import cycle
-from multiprocessing import Manager
 from multiprocessing.pool import Pool
 from typing import List
 from typing import Optional
 
 import matplotlib.pyplot as plt
-import tables
 from bokeh.colors.groups import purple as colors
 
-from lakh_utils import get_msd_score_matches
-from lakh_utils import msd_id_to_h5
-from multiprocessing_utils import AtomicCounter
+from lakh_utils import sample_msd_score_matches
+from metadata_utils import MetadataIndex
+from metadata_utils import get_song_metadata
+from metrics_utils import init_metrics
+from multiprocessing_utils import SharedCounter
+from multiprocessing_utils import imap_results
+from shard_utils import Shard
+from shard_utils import save_stats
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--sample_size", type=int, default=1000)
+parser.add_argument("--seed", type=int)
 parser.add_argument("--pool_size", type=int, default=4)
+parser.add_argument("--chunksize", type=int, default=1)
 parser.add_argument("--path_dataset_dir", type=str, required=True)
 parser.add_argument("--path_match_scores_file", type=str, required=True)
+parser.add_argument("--path_metadata_index", type=str)
+parser.add_argument("--num_shards", type=int, default=1)
+parser.add_argument("--shard_index", type=int, default=0)
+parser.add_argument("--path_stats", type=str)
+parser.add_argument("--path_metrics", type=str)
+parser.add_argument("--metrics_interval", type=float)
 args = parser.parse_args()
+if not 0 <= args.shard_index < args.num_shards:
+  parser.error("--shard_index must be lower than --num_shards")
 
-# The list of all MSD ids (we might process only a sample)
-MSD_SCORE_MATCHES = get_msd_score_matches(args.path_match_scores_file)
+# The shard of the dataset processed by this run, None if not sharded
+SHARD = (Shard(args.num_shards, args.shard_index)
+         if args.num_shards > 1 else None)
 
+# The optional metrics of the run (the durations of the stages, the errors
+# and the bytes read and written), aggregated from the pool workers
+METRICS = (init_metrics(args.path_metrics, args.metrics_interval)
+           if args.path_metrics else None)
 
-def process(msd_id: str, counter: AtomicCounter) -> Optional[dict]:
+# The optional MSD metadata index, used instead of the h5 files if provided
+METADATA_INDEX = (MetadataIndex(args.path_metadata_index)
+                  if args.path_metadata_index else None)
+
+
+def process(msd_id: str) -> Optional[dict]:
   """
-  Processes the given MSD id and increments the counter. The
-  method will find and return the artist.
+  Processes the given MSD id. The method will find and return the artist.
 
   :param msd_id: the MSD id to process
-  :param counter: the counter to increment
   :return: the dictionary containing the MSD id and the artist, raises an
   exception if the file cannot be processed
   """
   try:
-    with tables.open_file(msd_id_to_h5(msd_id, args.path_dataset_dir)) as h5:
-      artist = h5.root.metadata.songs.cols.artist_name[0].decode("utf-8")
-      return {"msd_id": msd_id, "artist": artist}
+    metadata = get_song_metadata(msd_id, args.path_dataset_dir,
+                                 METADATA_INDEX)
+    artist = metadata["artist_name"]
+    return {"msd_id": msd_id, "artist": artist}
   except Exception as e:
     print(f"Exception during processing of {msd_id}: {e}")
-  finally:
-    counter.increment()
 
 
-def app(msd_ids: List[str]):
+def app(msd_ids: List[str], tracks_count: int):
   start = timeit.default_timer()
 
-  # Starts the threads
-  with Pool(args.pool_size) as pool:
-    manager = Manager()
-    counter = AtomicCounter(manager, len(msd_ids))
+  results_count = 0
+  artists = Counter()
+  if METADATA_INDEX is not None:
+    # Queries the index directly, no need for the threads
     print("START")
-    results = pool.starmap(process, zip(msd_ids, cycle([counter])))
-    results = [result for result in results if result]
+    for metadata in METADATA_INDEX.get_many(msd_ids):
+      results_count += 1
+      artists[metadata["artist_name"]] += 1
     print("END")
-    results_percentage = len(results) / len(msd_ids) * 100
-    print(f"Number of tracks: {len(MSD_SCORE_MATCHES)}, "
-          f"number of tracks in sample: {len(msd_ids)}, "
-          f"number of results: {len(results)} "
-          f"({results_percentage:.2f}%)")
+  else:
+    # Starts the threads
+    counter = SharedCounter(len(msd_ids))
+    with Pool(args.pool_size) as pool:
+      print("START")
+      for result in imap_results(pool, process, msd_ids, counter,
+                                 args.chunksize, METRICS):
+        results_count += 1
+        artists[result["artist"]] += 1
+      print("END")
+  results_percentage = results_count / len(msd_ids) * 100
+  print(f"Number of tracks: {tracks_count}, "
+        f"number of tracks in sample: {len(msd_ids)}, "
+        f"number of results: {results_count} "
+        f"({results_percentage:.2f}%)")
 
   # Creates a bar chart for the most common artists
-  artists = [result["artist"] for result in results]
-  most_common_artists = Counter(artists).most_common(25)
+  most_common_artists = artists.most_common(25)
   print(f"Most common artists: {most_common_artists}")
   plt.figure(num=None, figsize=(10, 8), dpi=500)
   plt.bar([artist for artist, _ in most_common_artists],
@@ -84,15 +112,25 @@ def app(msd_ids: List[str]):
   plt.ylabel("count")
   plt.show()
 
+  if METRICS is not None:
+    METRICS.save()
+
+  if args.path_stats:
+    # The statistics of the run, merged with the other shards using the
+    # shard_utils.py file
+    save_stats(args.path_stats, {"tracks": tracks_count,
+                                 "tracks_in_sample": len(msd_ids),
+                                 "results": results_count,
+                                 "artists": artists})
+
   stop = timeit.default_timer()
   print("Time: ", stop - start)
 
 
 if __name__ == "__main__":
-  if args.sample_size:
-    # Process a sample of it
-    MSD_IDS = random.sample(list(MSD_SCORE_MATCHES), args.sample_size)
-  else:
-    # Process all the dataset
-    MSD_IDS = list(MSD_SCORE_MATCHES)
-  app(MSD_IDS)
+  # The MSD ids to process (we might process only a sample), the match
+  # scores file is streamed by the main process to keep only the scores of
+  # the sample, the pool workers don't use them
+  MSD_IDS, _, TRACKS_COUNT = sample_msd_score_matches(
+    args.path_match_scores_file, args.sample_size, SHARD, args.seed)
+  app(MSD_IDS, TRACKS_COUNT)
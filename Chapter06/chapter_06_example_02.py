@@ -6,106 +6,152 @@ VERSION: Magenta 1.1.7
 """
 
 import argparse
-import random
 import timeit
 from collections import Counter
-from itertools import cycle
-from multiprocessing import Manager
 from multiprocessing.pool import Pool
 from typing import List
 from typing import Optional
 
 import matplotlib.pyplot as plt
-import requests
-import tables
 from bokeh.colors.groups import purple as colors
 
-from lakh_utils import get_msd_score_matches
-from lakh_utils import msd_id_to_h5
-from multiprocessing_utils import AtomicCounter
+from lakh_utils import sample_msd_score_matches
+from lastfm_utils import LAST_FM_API_URL
+from lastfm_utils import TagCache
+from lastfm_utils import TagFetcher
+from lastfm_utils import get_tags
+from metadata_utils import MetadataIndex
+from metadata_utils import get_song_metadata
+from metrics_utils import init_metrics
+from multiprocessing_utils import SharedCounter
+from multiprocessing_utils import imap_results
+from shard_utils import Shard
+from shard_utils import save_stats
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--sample_size", type=int, default=1000)
+parser.add_argument("--seed", type=int)
 parser.add_argument("--pool_size", type=int, default=4)
+parser.add_argument("--chunksize", type=int, default=1)
 parser.add_argument("--path_dataset_dir", type=str, required=True)
 parser.add_argument("--path_match_scores_file", type=str, required=True)
-parser.add_argument("--last_fm_api_key", type=str, required=True)
+parser.add_argument("--path_metadata_index", type=str)
+parser.add_argument("--last_fm_api_key", type=str)
+parser.add_argument("--last_fm_api_url", type=str, default=LAST_FM_API_URL)
+parser.add_argument("--path_tag_cache", type=str)
+parser.add_argument("--tag_cache_ttl", type=float)
+parser.add_argument("--tag_cache_only", action="store_true")
+parser.add_argument("--fetch_concurrency", type=int, default=0)
+parser.add_argument("--fetch_rate_limit", type=float, default=5)
+parser.add_argument("--num_shards", type=int, default=1)
+parser.add_argument("--shard_index", type=int, default=0)
+parser.add_argument("--path_stats", type=str)
+parser.add_argument("--path_metrics", type=str)
+parser.add_argument("--metrics_interval", type=float)
 args = parser.parse_args()
+if not 0 <= args.shard_index < args.num_shards:
+  parser.error("--shard_index must be lower than --num_shards")
+if not args.last_fm_api_key and not args.tag_cache_only:
+  parser.error("--last_fm_api_key is required without --tag_cache_only")
+if args.fetch_concurrency and not args.path_tag_cache:
+  parser.error("--path_tag_cache is required with --fetch_concurrency")
 
-# The list of all MSD ids (we might process only a sample)
-MSD_SCORE_MATCHES = get_msd_score_matches(args.path_match_scores_file)
+# The shard of the dataset processed by this run, None if not sharded
+SHARD = (Shard(args.num_shards, args.shard_index)
+         if args.num_shards > 1 else None)
 
+# The optional metrics of the run (the durations of the stages, the errors
+# and the bytes read and written), aggregated from the pool workers
+METRICS = (init_metrics(args.path_metrics, args.metrics_interval)
+           if args.path_metrics else None)
 
-def get_tags(h5) -> Optional[list]:
+# The optional MSD metadata index, used instead of the h5 files if provided
+METADATA_INDEX = (MetadataIndex(args.path_metadata_index)
+                  if args.path_metadata_index else None)
+
+# The optional Last.fm tag cache, used before calling the API if provided
+TAG_CACHE = (TagCache(args.path_tag_cache, args.tag_cache_ttl)
+             if args.path_tag_cache else None)
+
+
+def prefetch_tags(msd_ids: List[str]):
   """
-  Returns the top tags (ordered most popular first) from the Last.fm API
-  using the title and the artist name from the h5 database.
+  Fetches the tags of the given MSD ids concurrently from this process,
+  before the processing, and stores them in the tag cache. The processing
+  will then find the tags in the tag cache.
 
-  :param h5: the h5 database
-  :return: the list of tags
+  :param msd_ids: the MSD ids to fetch the tags for
   """
-  title = h5.root.metadata.songs.cols.title[0].decode("utf-8")
-  artist = h5.root.metadata.songs.cols.artist_name[0].decode("utf-8")
-  request = (f"https://ws.audioscrobbler.com/2.0/"
-             f"?method=track.gettoptags"
-             f"&artist={artist}"
-             f"&track={title}"
-             f"&api_key={args.last_fm_api_key}"
-             f"&format=json")
-  response = requests.get(request, timeout=10)
-  json = response.json()
-  if "error" in json:
-    raise Exception(f"Error in request for '{artist}' - '{title}': "
-                    f"'{json['message']}'")
-  if "toptags" not in json:
-    raise Exception(f"Error in request for '{artist}' - '{title}': "
-                    f"no top tags")
-  tags = [tag["name"] for tag in json["toptags"]["tag"]]
-  tags = [tag.lower().strip() for tag in tags if tag]
-  return tags
-
-
-def process(msd_id: str, counter: AtomicCounter) -> Optional[dict]:
+  tracks = []
+  for msd_id in msd_ids:
+    try:
+      metadata = get_song_metadata(msd_id, args.path_dataset_dir,
+                                   METADATA_INDEX)
+      tracks.append((metadata["artist_name"], metadata["title"]))
+    except Exception:
+      # The exception will be reported during the processing
+      continue
+  fetcher = TagFetcher(args.last_fm_api_key,
+                       TAG_CACHE,
+                       concurrency=args.fetch_concurrency,
+                       rate_limit=args.fetch_rate_limit,
+                       api_url=args.last_fm_api_url)
+  counter = SharedCounter(len(tracks))
+  print("START FETCH")
+  for _ in fetcher.fetch_many(tracks):
+    counter.increment()
+  print("END FETCH")
+
+
+def process(msd_id: str) -> Optional[dict]:
   """
-  Processes the given MSD id and increments the counter. The
-  method will call the get_tags method.
+  Processes the given MSD id. The method will call the get_tags method.
 
   :param msd_id: the MSD id to process
-  :param counter: the counter to increment
   :return: the dictionary containing the MSD id and the tags, raises an
   exception if the file cannot be processed
   """
   try:
-    with tables.open_file(msd_id_to_h5(msd_id, args.path_dataset_dir)) as h5:
-      tags = get_tags(h5)
-      return {"msd_id": msd_id, "tags": tags}
+    metadata = get_song_metadata(msd_id, args.path_dataset_dir,
+                                 METADATA_INDEX)
+    tags = get_tags(metadata["artist_name"],
+                    metadata["title"],
+                    args.last_fm_api_key,
+                    tag_cache=TAG_CACHE,
+                    cache_only=args.tag_cache_only,
+                    api_url=args.last_fm_api_url)
+    return {"msd_id": msd_id, "tags": tags}
   except Exception as e:
     print(f"Exception during processing of {msd_id}: {e}")
-  finally:
-    counter.increment()
 
 
-def app(msd_ids: List[str]):
+def app(msd_ids: List[str], tracks_count: int):
   start = timeit.default_timer()
 
+  if args.fetch_concurrency and not args.tag_cache_only:
+    prefetch_tags(msd_ids)
+
   # Starts the threads
+  counter = SharedCounter(len(msd_ids))
   with Pool(args.pool_size) as pool:
-    manager = Manager()
-    counter = AtomicCounter(manager, len(msd_ids))
     print("START")
-    results = pool.starmap(process, zip(msd_ids, cycle([counter])))
-    results = [result for result in results if result]
+    results_count = 0
+    tags = Counter()
+    for result in imap_results(pool, process, msd_ids, counter,
+                               args.chunksize, METRICS):
+      results_count += 1
+      if result["tags"]:
+        tags[result["tags"][0]] += 1
     print("END")
-    results_percentage = len(results) / len(msd_ids) * 100
-    print(f"Number of tracks: {len(MSD_SCORE_MATCHES)}, "
+    results_percentage = results_count / len(msd_ids) * 100
+    print(f"Number of tracks: {tracks_count}, "
           f"number of tracks in sample: {len(msd_ids)}, "
-          f"number of results: {len(results)} "
+          f"number of results: {results_count} "
           f"({results_percentage:.2f}%)")
 
   # Creates a bar chart for the most common tags
-  tags = [result["tags"][0] for result in results if result["tags"]]
-  most_common_tags_20 = Counter(tags).most_common(20)
-  most_common_tags_100 = Counter(tags).most_common(100)
+  most_common_tags_20 = tags.most_common(20)
+  most_common_tags_100 = tags.most_common(100)
   print(f"Most common tags (100): {most_common_tags_100}")
   plt.figure(num=None, figsize=(10, 8), dpi=500)
   plt.bar([tag for tag, _ in most_common_tags_20],
@@ -117,15 +163,25 @@ def app(msd_ids: List[str]):
   plt.ylabel("count")
   plt.show()
 
+  if METRICS is not None:
+    METRICS.save()
+
+  if args.path_stats:
+    # The statistics of the run, merged with the other shards using the
+    # shard_utils.py file
+    save_stats(args.path_stats, {"tracks": tracks_count,
+                                 "tracks_in_sample": len(msd_ids),
+                                 "results": results_count,
+                                 "tags": tags})
+
   stop = timeit.default_timer()
   print("Time: ", stop - start)
 
 
 if __name__ == "__main__":
-  if args.sample_size:
-    # Process a sample of it
-    MSD_IDS = random.sample(list(MSD_SCORE_MATCHES), args.sample_size)
-  else:
-    # Process all the dataset
-    MSD_IDS = list(MSD_SCORE_MATCHES)
-  app(MSD_IDS)
+  # The MSD ids to process (we might process only a sample), the match
+  # scores file is streamed by the main process to keep only the scores of
+  # the sample, the pool workers don't use them
+  MSD_IDS, _, TRACKS_COUNT = sample_msd_score_matches(
+    args.path_match_scores_file, args.sample_size, SHARD, args.seed)
+  app(MSD_IDS, TRACKS_COUNT)
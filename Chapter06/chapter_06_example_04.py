@@ -5,101 +5,232 @@ VERSION: Magenta 1.1.7
 """
 
 import argparse
-import random
 import timeit
 from collections import Counter
-from itertools import cycle
-from multiprocessing import Manager
 from multiprocessing.pool import Pool
+from typing import Dict
 from typing import List
-from typing import Optional
+from typing import Union
 
 import matplotlib.pyplot as plt
-import tables
 from bokeh.colors.groups import purple as colors
-from pretty_midi import PrettyMIDI
 from pretty_midi import program_to_instrument_class
 
+from dedup_utils import DEDUP_MODES
+from dedup_utils import print_duplicates
+from dedup_utils import remove_duplicates
+from lakh_utils import get_best_msd_score_matches
 from lakh_utils import get_matched_midi_md5
 from lakh_utils import get_midi_path
-from lakh_utils import get_msd_score_matches
-from lakh_utils import msd_id_to_h5
-from multiprocessing_utils import AtomicCounter
+from lakh_utils import sample_msd_score_matches
+from metadata_utils import MetadataIndex
+from metadata_utils import get_song_metadata
+from metrics_utils import init_metrics
+from midi_utils import read_midi
+from multiprocessing_utils import SharedCounter
+from multiprocessing_utils import WorkerLimits
+from multiprocessing_utils import WorkerUtilization
+from multiprocessing_utils import imap_results
+from multiprocessing_utils import sort_largest_first
+from note_cache_utils import NoteCache
+from note_cache_utils import get_cached_instrument_classes
+from quarantine_utils import Quarantine
+from rejection_utils import Rejected
+from rejection_utils import Rejection
+from rejection_utils import print_rejections
+from shard_utils import Shard
+from shard_utils import save_stats
+from smf_utils import get_scanned_instrument_classes
+from smf_utils import scan_midi_file
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--sample_size", type=int, default=1000)
+parser.add_argument("--seed", type=int)
 parser.add_argument("--pool_size", type=int, default=4)
+parser.add_argument("--chunksize", type=int, default=1)
 parser.add_argument("--path_dataset_dir", type=str, required=True)
 parser.add_argument("--path_match_scores_file", type=str, required=True)
+parser.add_argument("--path_metadata_index", type=str)
+parser.add_argument("--path_note_cache", type=str)
+parser.add_argument("--scan_midi", action="store_true")
+parser.add_argument("--dedup", type=str, choices=DEDUP_MODES)
+parser.add_argument("--path_duplicates", type=str)
+parser.add_argument("--largest_first", action="store_true")
+parser.add_argument("--print_utilization", action="store_true")
+parser.add_argument("--soft_timeout", type=float)
+parser.add_argument("--hard_timeout", type=float)
+parser.add_argument("--soft_rss_limit", type=float)
+parser.add_argument("--hard_rss_limit", type=float)
+parser.add_argument("--path_quarantine", type=str)
+parser.add_argument("--num_shards", type=int, default=1)
+parser.add_argument("--shard_index", type=int, default=0)
+parser.add_argument("--path_stats", type=str)
+parser.add_argument("--path_metrics", type=str)
+parser.add_argument("--metrics_interval", type=float)
 args = parser.parse_args()
+if not 0 <= args.shard_index < args.num_shards:
+  parser.error("--shard_index must be lower than --num_shards")
+if (args.soft_timeout and args.hard_timeout
+    and args.hard_timeout <= args.soft_timeout):
+  parser.error("--hard_timeout must be greater than --soft_timeout")
 
-# The list of all MSD ids (we might process only a sample)
-MSD_SCORE_MATCHES = get_msd_score_matches(args.path_match_scores_file)
+# The best score match of each processed MSD id, set in the main process and
+# in the pool workers by init_worker
+MSD_SCORE_MATCHES = None
 
+# The shard of the dataset processed by this run, None if not sharded
+SHARD = (Shard(args.num_shards, args.shard_index)
+         if args.num_shards > 1 else None)
 
-def get_instrument_classes(msd_id) -> Optional[list]:
+# The optional metrics of the run (the durations of the stages, the errors
+# and the bytes read and written), aggregated from the pool workers
+METRICS = (init_metrics(args.path_metrics, args.metrics_interval)
+           if args.path_metrics else None)
+
+# The optional time and memory limits of the pool workers, the inputs
+# exceeding them are rejected and quarantined
+WORKER_LIMITS = (
+  WorkerLimits(args.pool_size, args.soft_timeout, args.hard_timeout,
+               args.soft_rss_limit, args.hard_rss_limit)
+  if any([args.soft_timeout, args.hard_timeout, args.soft_rss_limit,
+          args.hard_rss_limit]) else None)
+
+# The optional skip list of the inputs that exceeded the worker limits,
+# in this run or in the previous runs
+QUARANTINE = (Quarantine(args.path_quarantine)
+              if args.path_quarantine else None)
+
+# The optional MSD metadata index, used instead of the h5 files if provided
+METADATA_INDEX = (MetadataIndex(args.path_metadata_index)
+                  if args.path_metadata_index else None)
+
+
+# The optional note cache, used instead of parsing the MIDI files if provided
+NOTE_CACHE = (NoteCache(args.path_note_cache)
+              if args.path_note_cache else None)
+
+
+def get_input_midi_path(msd_id: str) -> str:
   """
-  Returns the list of instruments classes given by PrettyMIDI for the MSD id.
+  Returns the path of the MIDI file matched with the given MSD id.
 
   :param msd_id: the MSD id
-  :return: the list of instruments classes
+  :return: the MIDI path
+  """
+  midi_md5 = get_matched_midi_md5(msd_id, MSD_SCORE_MATCHES)
+  return get_midi_path(msd_id, midi_md5, args.path_dataset_dir)
+
+
+def get_instrument_classes(msd_id) -> Union[List[str], Rejected]:
+  """
+  Returns the list of instruments classes given by PrettyMIDI for the MSD id.
 
+  :param msd_id: the MSD id
+  :return: the list of instruments classes, or the rejection if there are no
+  instruments
   """
   midi_md5 = get_matched_midi_md5(msd_id, MSD_SCORE_MATCHES)
+  cached_midi = NOTE_CACHE.get(midi_md5) if NOTE_CACHE is not None else None
+  if cached_midi is not None:
+    return get_cached_instrument_classes(cached_midi)
   midi_path = get_midi_path(msd_id, midi_md5, args.path_dataset_dir)
-  pm = PrettyMIDI(midi_path)
+  if args.scan_midi:
+    # Only reads the programs and channels of the tracks, see smf_utils
+    return get_scanned_instrument_classes(scan_midi_file(midi_path))
+  pm = read_midi(midi_path)
   classes = [program_to_instrument_class(instrument.program)
              for instrument in pm.instruments
              if not instrument.is_drum]
   drums = ["Drums" for instrument in pm.instruments if instrument.is_drum]
   classes = classes + drums
   if not classes:
-    raise Exception(f"No program classes for {msd_id}: "
-                    f"{len(classes)}")
+    return Rejected(Rejection.NO_PROGRAM_CLASSES, len(classes))
   return classes
 
 
-def process(msd_id: str, counter: AtomicCounter) -> Optional[dict]:
+def process(msd_id: str) -> Union[dict, Rejected]:
   """
-  Processes the given MSD id and increments the counter. The
-  method will call the get_instrument_classes method.
+  Processes the given MSD id. The method will call the get_instrument_classes
+  method.
 
   :param msd_id: the MSD id to process
-  :param counter: the counter to increment
-  :return: the dictionary containing the MSD id and the classes, raises an
-  exception if the file cannot be processed
+  :return: the dictionary containing the MSD id and the classes, or the
+  rejection if the file is filtered or cannot be processed
   """
   try:
-    with tables.open_file(msd_id_to_h5(msd_id, args.path_dataset_dir)) as h5:
-      classes = get_instrument_classes(msd_id)
-      return {"msd_id": msd_id, "classes": classes}
+    # Only keeps the songs that have MSD metadata
+    get_song_metadata(msd_id, args.path_dataset_dir, METADATA_INDEX)
+    classes = get_instrument_classes(msd_id)
+    if isinstance(classes, Rejected):
+      return classes
+    return {"msd_id": msd_id, "classes": classes}
   except Exception as e:
     print(f"Exception during processing of {msd_id}: {e}")
-  finally:
-    counter.increment()
+    return Rejected(Rejection.ERROR, str(e))
+
+
+def init_worker(msd_score_matches: Dict):
+  """
+  Initializes the globals of the pool workers, called in the main process
+  before starting the pool.
+
+  :param msd_score_matches: the best score match of each processed MSD id,
+  see get_best_msd_score_matches
+  """
+  global MSD_SCORE_MATCHES
+  MSD_SCORE_MATCHES = msd_score_matches
 
 
-def app(msd_ids: List[str]):
+def app(msd_ids: List[str], tracks_count: int):
   start = timeit.default_timer()
 
+  # Skips the MSD ids with the same MIDI content as another MSD id of the
+  # sample before parsing them, the duplicates are mapped to the kept MSD ids
+  unique_msd_ids, duplicates = (
+    remove_duplicates(msd_ids, get_input_midi_path, args.dedup, args.pool_size,
+                      NOTE_CACHE, args.path_duplicates)
+    if args.dedup else (msd_ids, {}))
+
+  if args.largest_first:
+    # Starts the largest files first, so the pool doesn't wait for a
+    # single worker processing a large file at the end of the run
+    unique_msd_ids = sort_largest_first(unique_msd_ids, get_input_midi_path)
+
   # Starts the threads
-  with Pool(args.pool_size) as pool:
-    manager = Manager()
-    counter = AtomicCounter(manager, len(msd_ids))
+  counter = SharedCounter(len(unique_msd_ids))
+  with Pool(args.pool_size,
+            initializer=init_worker,
+            initargs=(MSD_SCORE_MATCHES,)) as pool:
     print("START")
-    results = pool.starmap(process, zip(msd_ids, cycle([counter])))
-    results = [result for result in results if result]
+    utilization = WorkerUtilization() if args.print_utilization else None
+    results_count = 0
+    rejections = Counter()
+    classes = Counter()
+    for result in imap_results(pool, process, unique_msd_ids, counter,
+                               args.chunksize, METRICS,
+                               rejections,
+                               utilization=utilization,
+                               limits=WORKER_LIMITS,
+                               quarantine=QUARANTINE):
+      results_count += 1
+      classes.update(result["classes"])
     print("END")
-    results_percentage = len(results) / len(msd_ids) * 100
-    print(f"Number of tracks: {len(MSD_SCORE_MATCHES)}, "
+    # The duplicates aren't processed, the results and rejections are
+    # counted over the unique tracks of the sample
+    results_percentage = results_count / len(unique_msd_ids) * 100
+    print(f"Number of tracks: {tracks_count}, "
           f"number of tracks in sample: {len(msd_ids)}, "
-          f"number of results: {len(results)} "
+          f"number of unique tracks in sample: {len(unique_msd_ids)}, "
+          f"number of results: {results_count} "
           f"({results_percentage:.2f}%)")
+    print_rejections(rejections, len(unique_msd_ids))
+    if args.dedup:
+      print_duplicates(duplicates, len(msd_ids))
+    if utilization is not None:
+      utilization.print()
 
   # Creates a bar chart for the most common classes
-  classes_list = [result["classes"] for result in results]
-  classes = [c for classes in classes_list for c in classes]
-  most_common_classes = Counter(classes).most_common()
+  most_common_classes = classes.most_common()
   plt.figure(num=None, figsize=(10, 8), dpi=500)
   plt.bar([c for c, _ in most_common_classes],
           [count for _, count in most_common_classes],
@@ -110,15 +241,31 @@ def app(msd_ids: List[str]):
   plt.ylabel('count')
   plt.show()
 
+  if METRICS is not None:
+    METRICS.save()
+
+  if args.path_stats:
+    # The statistics of the run, merged with the other shards using the
+    # shard_utils.py file
+    save_stats(args.path_stats, {"tracks": tracks_count,
+                                 "tracks_in_sample": len(msd_ids),
+                                 "unique_tracks_in_sample": len(unique_msd_ids),
+                                 "results": results_count,
+                                 "classes": classes,
+                                 "rejections": rejections,
+                                 "duplicates": len(duplicates)})
+
   stop = timeit.default_timer()
   print("Time: ", stop - start)
 
 
 if __name__ == "__main__":
-  if args.sample_size:
-    # Process a sample of it
-    MSD_IDS = random.sample(list(MSD_SCORE_MATCHES), args.sample_size)
-  else:
-    # Process all the dataset
-    MSD_IDS = list(MSD_SCORE_MATCHES)
-  app(MSD_IDS)
+  # The MSD ids to process (we might process only a sample), the match
+  # scores file is streamed by the main process to keep only the scores of
+  # the sample, the pool workers only receive the best match of each
+  # processed MSD id
+  MSD_IDS, msd_score_matches, TRACKS_COUNT = sample_msd_score_matches(
+    args.path_match_scores_file, args.sample_size, SHARD, args.seed)
+  init_worker(get_best_msd_score_matches(msd_score_matches, MSD_IDS))
+  del msd_score_matches
+  app(MSD_IDS, TRACKS_COUNT)
@@ -7,141 +7,347 @@ VERSION: Magenta 1.1.7
 """
 
 import argparse
-import copy
 import os
-import random
 import shutil
 import timeit
-from itertools import cycle
-from multiprocessing import Manager
+from collections import Counter
+from itertools import chain
 from multiprocessing.pool import Pool
+from typing import Dict
 from typing import List
-from typing import Optional
+from typing import Union
 
 import matplotlib.pyplot as plt
-import tables
-from pretty_midi import Instrument
 from pretty_midi import PrettyMIDI
 
+from dedup_utils import DEDUP_MODES
+from dedup_utils import print_duplicates
+from dedup_utils import remove_duplicates
+from lakh_utils import get_best_msd_score_matches
 from lakh_utils import get_matched_midi_md5
 from lakh_utils import get_midi_path
-from lakh_utils import get_msd_score_matches
-from lakh_utils import msd_id_to_h5
-from multiprocessing_utils import AtomicCounter
+from lakh_utils import sample_msd_score_matches
+from manifest_utils import Manifest
+from manifest_utils import get_fingerprint
+from manifest_utils import get_pending
+from metadata_utils import MetadataIndex
+from metadata_utils import get_song_metadata
+from metrics_utils import init_metrics
+from midi_utils import get_pianos_or_rejection
+from midi_utils import is_piano_instrument
+from midi_utils import read_midi
+from midi_utils import write_midi
+from multiprocessing_utils import SharedCounter
+from multiprocessing_utils import WorkerLimits
+from multiprocessing_utils import WorkerUtilization
+from multiprocessing_utils import get_pickled_size
+from multiprocessing_utils import imap_results
+from multiprocessing_utils import sort_largest_first
+from quarantine_utils import Quarantine
+from rejection_utils import Rejected
+from rejection_utils import Rejection
+from rejection_utils import print_rejections
+from shard_utils import Shard
+from shard_utils import save_stats
+from smf_utils import read_midi_filtered
+from tfrecord_utils import NoteSequenceWriter
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--sample_size", type=int, default=1000)
+parser.add_argument("--seed", type=int)
 parser.add_argument("--pool_size", type=int, default=4)
+parser.add_argument("--chunksize", type=int, default=1)
+parser.add_argument("--compact_results", action="store_true")
+parser.add_argument("--measure_result_size", action="store_true")
 parser.add_argument("--path_dataset_dir", type=str, required=True)
 parser.add_argument("--path_match_scores_file", type=str, required=True)
+parser.add_argument("--path_metadata_index", type=str)
 parser.add_argument("--path_output_dir", type=str, required=True)
+parser.add_argument("--output_format", type=str, default="midi",
+                    choices=["midi", "tfrecord"])
+parser.add_argument("--path_manifest", type=str)
+parser.add_argument("--resume", action="store_true")
+parser.add_argument("--retry_errors", action="store_true")
+parser.add_argument("--scan_midi", action="store_true")
+parser.add_argument("--dedup", type=str, choices=DEDUP_MODES)
+parser.add_argument("--path_duplicates", type=str)
+parser.add_argument("--largest_first", action="store_true")
+parser.add_argument("--print_utilization", action="store_true")
+parser.add_argument("--soft_timeout", type=float)
+parser.add_argument("--hard_timeout", type=float)
+parser.add_argument("--soft_rss_limit", type=float)
+parser.add_argument("--hard_rss_limit", type=float)
+parser.add_argument("--path_quarantine", type=str)
+parser.add_argument("--num_shards", type=int, default=1)
+parser.add_argument("--shard_index", type=int, default=0)
+parser.add_argument("--path_stats", type=str)
+parser.add_argument("--path_metrics", type=str)
+parser.add_argument("--metrics_interval", type=float)
 args = parser.parse_args()
+if not 0 <= args.shard_index < args.num_shards:
+  parser.error("--shard_index must be lower than --num_shards")
+if args.resume and not args.path_manifest:
+  parser.error("--path_manifest is required with --resume")
+if args.resume and args.output_format == "tfrecord":
+  # The records of the reprocessed inputs would stay in the TFRecord files
+  # of the previous runs, and be duplicated when concatenating the files
+  parser.error("--resume is not supported with --output_format=tfrecord")
+if (args.soft_timeout and args.hard_timeout
+    and args.hard_timeout <= args.soft_timeout):
+  parser.error("--hard_timeout must be greater than --soft_timeout")
 
-# The list of all MSD ids (we might process only a sample)
-MSD_SCORE_MATCHES = get_msd_score_matches(args.path_match_scores_file)
-PIANO_PROGRAMS = list(range(0, 8))
+# The best score match of each processed MSD id, set in the main process and
+# in the pool workers by init_worker
+MSD_SCORE_MATCHES = None
 
+# The shard of the dataset processed by this run, None if not sharded
+SHARD = (Shard(args.num_shards, args.shard_index)
+         if args.num_shards > 1 else None)
 
-def extract_pianos(msd_id: str) -> List[PrettyMIDI]:
+# The optional metrics of the run (the durations of the stages, the errors
+# and the bytes read and written), aggregated from the pool workers
+METRICS = (init_metrics(args.path_metrics, args.metrics_interval)
+           if args.path_metrics else None)
+
+# The optional time and memory limits of the pool workers, the inputs
+# exceeding them are rejected and quarantined
+WORKER_LIMITS = (
+  WorkerLimits(args.pool_size, args.soft_timeout, args.hard_timeout,
+               args.soft_rss_limit, args.hard_rss_limit)
+  if any([args.soft_timeout, args.hard_timeout, args.soft_rss_limit,
+          args.hard_rss_limit]) else None)
+
+# The optional skip list of the inputs that exceeded the worker limits,
+# in this run or in the previous runs
+QUARANTINE = (Quarantine(args.path_quarantine)
+              if args.path_quarantine else None)
+
+# The optional NoteSequence writer, used instead of writing MIDI files if
+# the output format is TFRecord
+NOTE_SEQUENCE_WRITER = (NoteSequenceWriter(args.path_output_dir, "pianos")
+                        if args.output_format == "tfrecord" else None)
+
+# The optional MSD metadata index, used instead of the h5 files if provided
+METADATA_INDEX = (MetadataIndex(args.path_metadata_index)
+                  if args.path_metadata_index else None)
+
+# The optional manifest of the processed items, to resume the run
+MANIFEST = Manifest(args.path_manifest) if args.path_manifest else None
+
+# The arguments changing the outputs, a resumed run must use the same
+MANIFEST_CONFIG = {"path_output_dir": args.path_output_dir,
+                   "output_format": args.output_format,
+                   "dedup": args.dedup}
+
+
+def get_input_midi_path(msd_id: str) -> str:
+  """
+  Returns the path of the MIDI file matched with the given MSD id.
+
+  :param msd_id: the MSD id
+  :return: the MIDI path
+  """
+  midi_md5 = get_matched_midi_md5(msd_id, MSD_SCORE_MATCHES)
+  return get_midi_path(msd_id, midi_md5, args.path_dataset_dir)
+
+
+def get_input_fingerprint(msd_id: str) -> str:
+  """
+  Returns the fingerprint of the MIDI file matched with the given MSD id, see
+  get_fingerprint.
+
+  :param msd_id: the MSD id
+  :return: the fingerprint of the input file
+  """
+  return get_fingerprint(get_input_midi_path(msd_id))
+
+
+def extract_pianos(msd_id: str) -> Union[List[PrettyMIDI], Rejected]:
   """
   Extracts a list of PrettyMIDI instance of all the separate piano tracks
   from the given MSD id.
 
   :param msd_id: the MSD id
-  :return: the list of PrettyMIDI instances of the separate piano tracks
+  :return: the list of PrettyMIDI instances of the separate piano tracks, or
+  the rejection if there are no pianos or if a piano is too long
   """
   os.makedirs(args.path_output_dir, exist_ok=True)
   midi_md5 = get_matched_midi_md5(msd_id, MSD_SCORE_MATCHES)
   midi_path = get_midi_path(msd_id, midi_md5, args.path_dataset_dir)
-  pm = PrettyMIDI(midi_path)
-  pm.instruments = [instrument for instrument in pm.instruments
-                    if instrument.program in PIANO_PROGRAMS
-                    and not instrument.is_drum]
-  pm_pianos = []
-  if len(pm.instruments) > 1:
-    for piano_instrument in pm.instruments:
-      pm_piano = copy.deepcopy(pm)
-      pm_piano_instrument = Instrument(program=piano_instrument.program)
-      pm_piano.instruments = [pm_piano_instrument]
-      for note in piano_instrument.notes:
-        pm_piano_instrument.notes.append(note)
-      pm_pianos.append(pm_piano)
+  if args.scan_midi:
+    # Only parses the piano tracks, see smf_utils
+    pm = read_midi_filtered(midi_path, is_piano_instrument)
   else:
-    pm_pianos.append(pm)
-  for index, pm_piano in enumerate(pm_pianos):
-    if len(pm_piano.instruments) != 1:
-      raise Exception(f"Invalid number of piano {msd_id}: "
-                      f"{len(pm_piano.instruments)}")
-    if pm_piano.get_end_time() > 1000:
-      raise Exception(f"Piano track too long {msd_id}: "
-                      f"{pm_piano.get_end_time()}")
-  return pm_pianos
-
-
-def process(msd_id: str, counter: AtomicCounter) -> Optional[dict]:
+    pm = read_midi(midi_path)
+  return get_pianos_or_rejection(pm)
+
+
+def process(msd_id: str) -> Union[dict, Rejected]:
   """
-  Processes the given MSD id and increments the counter. The
-  method will call the extract_pianos method and write the resulting MIDI
-  files to disk.
+  Processes the given MSD id. The method will call the extract_pianos method
+  and write the resulting MIDI files to disk.
 
   :param msd_id: the MSD id to process
-  :param counter: the counter to increment
-  :return: the dictionary containing the MSD id and the PrettyMIDI pianos,
-  raises an exception if the file cannot be processed
+  :return: the dictionary containing the MSD id, the output paths, the pianos
+  end times and note counts, and the PrettyMIDI pianos (unless the results are
+  compact), or the rejection if the file is filtered or cannot be processed
   """
+  fingerprint = None
   try:
-    with tables.open_file(msd_id_to_h5(msd_id, args.path_dataset_dir)) as h5:
-      pm_pianos = extract_pianos(msd_id)
-      for index, pm_piano in enumerate(pm_pianos):
-        pm_piano.write(os.path.join(args.path_output_dir,
-                                    f"{msd_id}_{index}.mid"))
-      return {"msd_id": msd_id, "pm_pianos": pm_pianos}
+    if MANIFEST is not None:
+      fingerprint = get_input_fingerprint(msd_id)
+    # Only keeps the songs that have MSD metadata
+    get_song_metadata(msd_id, args.path_dataset_dir, METADATA_INDEX)
+    pm_pianos = extract_pianos(msd_id)
+    if isinstance(pm_pianos, Rejected):
+      # Filtered, recorded as processed without result
+      if MANIFEST is not None:
+        MANIFEST.put(msd_id, fingerprint)
+      return pm_pianos
+    output_paths = []
+    for index, pm_piano in enumerate(pm_pianos):
+      if NOTE_SEQUENCE_WRITER is not None:
+        output_path = NOTE_SEQUENCE_WRITER.write(pm_piano,
+                                                 f"{msd_id}_{index}")
+      else:
+        output_path = os.path.join(args.path_output_dir,
+                                   f"{msd_id}_{index}.mid")
+        write_midi(pm_piano, output_path)
+      output_paths.append(output_path)
+    result = {"msd_id": msd_id,
+              "output_paths": output_paths,
+              "end_times": [pm_piano.get_end_time() for pm_piano in pm_pianos],
+              "note_counts": [len(pm_piano.instruments[0].notes)
+                              for pm_piano in pm_pianos]}
+    if MANIFEST is not None:
+      MANIFEST.put(msd_id, fingerprint, result=result,
+                   output_paths=output_paths)
+    if not args.compact_results:
+      result["pm_pianos"] = pm_pianos
+    return result
   except Exception as e:
     print(f"Exception during processing of {msd_id}: {e}")
-  finally:
-    counter.increment()
+    if MANIFEST is not None:
+      MANIFEST.put(msd_id, fingerprint, error=str(e))
+    return Rejected(Rejection.ERROR, str(e))
+
 
+def init_worker(msd_score_matches: Dict):
+  """
+  Initializes the globals of the pool workers, called in the main process
+  before starting the pool.
 
-def app(msd_ids: List[str]):
+  :param msd_score_matches: the best score match of each processed MSD id,
+  see get_best_msd_score_matches
+  """
+  global MSD_SCORE_MATCHES
+  MSD_SCORE_MATCHES = msd_score_matches
+
+
+def app(msd_ids: List[str], tracks_count: int):
   start = timeit.default_timer()
 
-  # Cleanup the output directory
-  shutil.rmtree(args.path_output_dir, ignore_errors=True)
+  # Skips the MSD ids with the same MIDI content as another MSD id of the
+  # sample before parsing them, the duplicates are mapped to the kept MSD ids
+  unique_msd_ids, duplicates = (
+    remove_duplicates(msd_ids, get_input_midi_path, args.dedup, args.pool_size,
+                      None, args.path_duplicates)
+    if args.dedup else (msd_ids, {}))
+
+  if args.resume:
+    # Only processes the new items and the items whose input changed, the
+    # results of the other items are read from the manifest
+    MANIFEST.check_config(MANIFEST_CONFIG)
+    pending_msd_ids, processed_results = get_pending(
+      MANIFEST, unique_msd_ids, get_input_fingerprint, args.retry_errors)
+    print(f"Number of items already processed: "
+          f"{len(unique_msd_ids) - len(pending_msd_ids)}")
+  else:
+    if SHARD is None:
+      # Cleanup the output directory, the shards of a sharded run share
+      # it (the output files are named after the input files)
+      shutil.rmtree(args.path_output_dir, ignore_errors=True)
+    if MANIFEST is not None:
+      MANIFEST.reset(MANIFEST_CONFIG)
+    pending_msd_ids, processed_results = unique_msd_ids, []
+
+  if args.largest_first:
+    # Starts the largest files first, so the pool doesn't wait for a
+    # single worker processing a large file at the end of the run
+    pending_msd_ids = sort_largest_first(pending_msd_ids, get_input_midi_path)
 
   # Starts the threads
-  with Pool(args.pool_size) as pool:
-    manager = Manager()
-    counter = AtomicCounter(manager, len(msd_ids))
+  counter = SharedCounter(len(pending_msd_ids))
+  with Pool(args.pool_size,
+            initializer=init_worker,
+            initargs=(MSD_SCORE_MATCHES,)) as pool:
     print("START")
-    results = pool.starmap(process, zip(msd_ids, cycle([counter])))
-    results = [result for result in results if result]
+    utilization = WorkerUtilization() if args.print_utilization else None
+    results_count = 0
+    rejections = Counter()
+    results_size = 0
+    pm_piano_lengths = []
+    for result in chain(processed_results,
+                        imap_results(pool, process, pending_msd_ids, counter,
+                                     args.chunksize, METRICS,
+                                     rejections,
+                                     utilization=utilization,
+                                     limits=WORKER_LIMITS,
+                                     quarantine=QUARANTINE)):
+      results_count += 1
+      if args.measure_result_size:
+        results_size += get_pickled_size(result)
+      pm_piano_lengths.extend(result["end_times"])
     print("END")
-    results_percentage = len(results) / len(msd_ids) * 100
-    print(f"Number of tracks: {len(MSD_SCORE_MATCHES)}, "
+    # The duplicates aren't processed, the results and rejections are
+    # counted over the unique tracks of the sample
+    results_percentage = results_count / len(unique_msd_ids) * 100
+    print(f"Number of tracks: {tracks_count}, "
           f"number of tracks in sample: {len(msd_ids)}, "
-          f"number of results: {len(results)} "
+          f"number of unique tracks in sample: {len(unique_msd_ids)}, "
+          f"number of results: {results_count} "
           f"({results_percentage:.2f}%)")
+    print_rejections(rejections, len(unique_msd_ids))
+    if args.dedup:
+      print_duplicates(duplicates, len(msd_ids))
+    if utilization is not None:
+      utilization.print()
+    if args.measure_result_size and results_count:
+      print(f"Result size: {results_size // results_count} bytes per result "
+            f"(total: {results_size} bytes)")
 
   # Creates an histogram for the piano lengths
-  pm_pianos_list = [result["pm_pianos"] for result in results]
-  pm_piano_lengths = [pm_piano.get_end_time()
-                      for pm_pianos in pm_pianos_list
-                      for pm_piano in pm_pianos]
   plt.figure(num=None, figsize=(10, 8), dpi=500)
   plt.hist(pm_piano_lengths, bins=100, color="darkmagenta")
   plt.title('Piano lengths')
   plt.ylabel('length (sec)')
   plt.show()
 
+  if METRICS is not None:
+    METRICS.save()
+
+  if args.path_stats:
+    # The statistics of the run, merged with the other shards using the
+    # shard_utils.py file
+    save_stats(args.path_stats, {"tracks": tracks_count,
+                                 "tracks_in_sample": len(msd_ids),
+                                 "unique_tracks_in_sample": len(unique_msd_ids),
+                                 "results": results_count,
+                                 "piano_lengths": pm_piano_lengths,
+                                 "rejections": rejections,
+                                 "duplicates": len(duplicates)})
+
   stop = timeit.default_timer()
   print("Time: ", stop - start)
 
 
 if __name__ == "__main__":
-  if args.sample_size:
-    # Process a sample of it
-    MSD_IDS = random.sample(list(MSD_SCORE_MATCHES), args.sample_size)
-  else:
-    # Process all the dataset
-    MSD_IDS = list(MSD_SCORE_MATCHES)
-  app(MSD_IDS)
+  # The MSD ids to process (we might process only a sample), the match
+  # scores file is streamed by the main process to keep only the scores of
+  # the sample, the pool workers only receive the best match of each
+  # processed MSD id
+  MSD_IDS, msd_score_matches, TRACKS_COUNT = sample_msd_score_matches(
+    args.path_match_scores_file, args.sample_size, SHARD, args.seed)
+  init_worker(get_best_msd_score_matches(msd_score_matches, MSD_IDS))
+  del msd_score_matches
+  app(MSD_IDS, TRACKS_COUNT)
@@ -0,0 +1,557 @@
+"""
+Artists, tags, instrument classes, drums and pianos extraction in a single
+pass, using a pipeline of stages built from the previous examples. Each MSD
+metadata and MIDI file is read and parsed only once, whatever the number of
+requested outputs.
+
+VERSION: Magenta 1.1.7
+"""
+
+import argparse
+import ast
+import os
+import shutil
+import timeit
+from collections import Counter
+from multiprocessing.pool import Pool
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Union
+
+import matplotlib.pyplot as plt
+from bokeh.colors.groups import purple as colors
+from pretty_midi import PrettyMIDI
+from pretty_midi import program_to_instrument_class
+
+from dedup_utils import DEDUP_MODES
+from dedup_utils import print_duplicates
+from dedup_utils import remove_duplicates
+from lakh_utils import get_best_msd_score_matches
+from lakh_utils import get_matched_midi_md5
+from lakh_utils import get_midi_path
+from lakh_utils import sample_msd_score_matches
+from lastfm_utils import LAST_FM_API_URL
+from lastfm_utils import TagCache
+from lastfm_utils import TagFetcher
+from lastfm_utils import get_tags
+from metadata_utils import MetadataIndex
+from metadata_utils import get_song_metadata
+from metrics_utils import init_metrics
+from midi_utils import get_drums_or_rejection
+from midi_utils import get_pianos_or_rejection
+from midi_utils import read_midi
+from midi_utils import write_midi
+from multiprocessing_utils import SharedCounter
+from multiprocessing_utils import WorkerLimits
+from multiprocessing_utils import WorkerUtilization
+from multiprocessing_utils import imap_results
+from multiprocessing_utils import sort_largest_first
+from pipeline_utils import Pipeline
+from pipeline_utils import Stage
+from quarantine_utils import Quarantine
+from rejection_utils import Rejected
+from rejection_utils import Rejection
+from rejection_utils import print_rejections
+from shard_utils import Shard
+from shard_utils import save_stats
+from tfrecord_utils import NoteSequenceWriter
+
+# The outputs that can be computed by the pipeline
+OUTPUTS = ["artist", "tags", "classes", "drums", "pianos"]
+
+# The outputs using the MIDI file, not computed for the duplicates
+MIDI_OUTPUTS = ["classes", "drums", "pianos"]
+
+# The stages using the MIDI file, not run for the duplicates
+MIDI_STAGES = ["midi_path", "pm", "classes", "pm_drums", "drums", "pm_pianos",
+               "pianos"]
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--sample_size", type=int, default=1000)
+parser.add_argument("--seed", type=int)
+parser.add_argument("--pool_size", type=int, default=4)
+parser.add_argument("--chunksize", type=int, default=1)
+parser.add_argument("--outputs", type=str, default="artist,classes,drums",
+                    help=f"Comma separated list of {','.join(OUTPUTS)}")
+parser.add_argument("--path_dataset_dir", type=str, required=True)
+parser.add_argument("--path_match_scores_file", type=str, required=True)
+parser.add_argument("--path_metadata_index", type=str)
+parser.add_argument("--path_output_dir", type=str)
+parser.add_argument("--output_format", type=str, default="midi",
+                    choices=["midi", "tfrecord"])
+parser.add_argument("--last_fm_api_key", type=str)
+parser.add_argument("--last_fm_api_url", type=str, default=LAST_FM_API_URL)
+parser.add_argument("--path_tag_cache", type=str)
+parser.add_argument("--tag_cache_ttl", type=float)
+parser.add_argument("--tag_cache_only", action="store_true")
+parser.add_argument("--fetch_concurrency", type=int, default=0)
+parser.add_argument("--fetch_rate_limit", type=float, default=5)
+parser.add_argument("--tags", type=str,
+                    help="Only extracts the drums and pianos of the songs "
+                         "with one of those tags")
+parser.add_argument("--dedup", type=str, choices=DEDUP_MODES)
+parser.add_argument("--path_duplicates", type=str)
+parser.add_argument("--largest_first", action="store_true")
+parser.add_argument("--print_utilization", action="store_true")
+parser.add_argument("--soft_timeout", type=float)
+parser.add_argument("--hard_timeout", type=float)
+parser.add_argument("--soft_rss_limit", type=float)
+parser.add_argument("--hard_rss_limit", type=float)
+parser.add_argument("--path_quarantine", type=str)
+parser.add_argument("--num_shards", type=int, default=1)
+parser.add_argument("--shard_index", type=int, default=0)
+parser.add_argument("--path_stats", type=str)
+parser.add_argument("--path_metrics", type=str)
+parser.add_argument("--metrics_interval", type=float)
+args = parser.parse_args()
+if not 0 <= args.shard_index < args.num_shards:
+  parser.error("--shard_index must be lower than --num_shards")
+REQUESTED_OUTPUTS = args.outputs.split(",")
+if set(REQUESTED_OUTPUTS) - set(OUTPUTS):
+  parser.error(f"--outputs must be in {','.join(OUTPUTS)}")
+if (("tags" in REQUESTED_OUTPUTS or args.tags)
+    and not args.last_fm_api_key and not args.tag_cache_only):
+  parser.error("--last_fm_api_key is required without --tag_cache_only")
+if (("drums" in REQUESTED_OUTPUTS or "pianos" in REQUESTED_OUTPUTS)
+    and not args.path_output_dir):
+  parser.error("--path_output_dir is required for the drums and pianos")
+if args.fetch_concurrency and not args.path_tag_cache:
+  parser.error("--path_tag_cache is required with --fetch_concurrency")
+if (args.soft_timeout and args.hard_timeout
+    and args.hard_timeout <= args.soft_timeout):
+  parser.error("--hard_timeout must be greater than --soft_timeout")
+
+TAGS = ast.literal_eval(args.tags) if args.tags else None
+
+# The best score match of each processed MSD id, set in the main process and
+# in the pool workers by init_worker
+MSD_SCORE_MATCHES = None
+
+# The MSD ids with the same MIDI content as another MSD id of the sample,
+# mapped to the kept MSD id, set in the pool workers by init_worker
+DUPLICATES = {}
+
+# The shard of the dataset processed by this run, None if not sharded
+SHARD = (Shard(args.num_shards, args.shard_index)
+         if args.num_shards > 1 else None)
+
+# The optional metrics of the run (the durations of the stages, the errors
+# and the bytes read and written), aggregated from the pool workers
+METRICS = (init_metrics(args.path_metrics, args.metrics_interval)
+           if args.path_metrics else None)
+
+# The optional time and memory limits of the pool workers, the inputs
+# exceeding them are rejected and quarantined
+WORKER_LIMITS = (
+  WorkerLimits(args.pool_size, args.soft_timeout, args.hard_timeout,
+               args.soft_rss_limit, args.hard_rss_limit)
+  if any([args.soft_timeout, args.hard_timeout, args.soft_rss_limit,
+          args.hard_rss_limit]) else None)
+
+# The optional skip list of the inputs that exceeded the worker limits,
+# in this run or in the previous runs
+QUARANTINE = (Quarantine(args.path_quarantine)
+              if args.path_quarantine else None)
+
+# The optional NoteSequence writers of the drums and pianos, used instead
+# of writing MIDI files if the output format is TFRecord
+NOTE_SEQUENCE_WRITERS = (
+  {name: NoteSequenceWriter(os.path.join(args.path_output_dir, name), name)
+   for name in ["drums", "pianos"]}
+  if args.output_format == "tfrecord" and args.path_output_dir else None)
+
+# The optional MSD metadata index, used instead of the h5 files if provided
+METADATA_INDEX = (MetadataIndex(args.path_metadata_index)
+                  if args.path_metadata_index else None)
+
+# The optional Last.fm tag cache, used before calling the API if provided
+TAG_CACHE = (TagCache(args.path_tag_cache, args.tag_cache_ttl)
+             if args.path_tag_cache else None)
+
+
+def load_midi_path(msd_id: str) -> str:
+  """
+  Returns the path of the MIDI file matched with the given MSD id.
+
+  :param msd_id: the MSD id
+  :return: the MIDI path
+  """
+  midi_md5 = get_matched_midi_md5(msd_id, MSD_SCORE_MATCHES)
+  return get_midi_path(msd_id, midi_md5, args.path_dataset_dir)
+
+
+def load_unique_midi_path(msd_id: str) -> Optional[str]:
+  """
+  Returns the path of the MIDI file matched with the given MSD id, or None if
+  the MSD id is a duplicate, so only the stages using the metadata are run.
+
+  :param msd_id: the MSD id
+  :return: the MIDI path, or None if the MSD id is a duplicate
+  """
+  if msd_id in DUPLICATES:
+    return None
+  return load_midi_path(msd_id)
+
+
+def load_metadata(msd_id: str) -> dict:
+  """
+  Returns the MSD metadata of the given MSD id.
+
+  :param msd_id: the MSD id
+  :return: the dictionary of metadata
+  """
+  return get_song_metadata(msd_id, args.path_dataset_dir, METADATA_INDEX)
+
+
+def get_artist(metadata: dict) -> str:
+  """
+  Returns the artist of the song.
+
+  :param metadata: the dictionary of metadata
+  :return: the artist name
+  """
+  return metadata["artist_name"]
+
+
+def fetch_tags(metadata: dict) -> List[str]:
+  """
+  Returns the Last.fm tags of the song.
+
+  :param metadata: the dictionary of metadata
+  :return: the list of tags
+  """
+  return get_tags(metadata["artist_name"],
+                  metadata["title"],
+                  args.last_fm_api_key,
+                  tag_cache=TAG_CACHE,
+                  cache_only=args.tag_cache_only,
+                  api_url=args.last_fm_api_url)
+
+
+def filter_by_tags(tags: List[str]) -> Union[List[str], Rejected]:
+  """
+  Returns the tags of the song matching the requested tags.
+
+  :param tags: the list of tags
+  :return: the list of matching tags, or the rejection to filter the song
+  """
+  matching_tags = [tag for tag in tags if tag in TAGS]
+  if not matching_tags:
+    return Rejected(Rejection.NO_MATCHING_TAGS, tags)
+  return matching_tags
+
+
+def parse_midi(midi_path: str) -> PrettyMIDI:
+  """
+  Parses the MIDI file, once for all the stages using it.
+
+  :param midi_path: the MIDI path
+  :return: the PrettyMIDI instance
+  """
+  return read_midi(midi_path)
+
+
+def get_instrument_classes(pm: PrettyMIDI) -> Union[List[str], Rejected]:
+  """
+  Returns the list of instruments classes given by PrettyMIDI.
+
+  :param pm: the PrettyMIDI instance
+  :return: the list of instruments classes, or the rejection if there are no
+  instruments
+  """
+  classes = [program_to_instrument_class(instrument.program)
+             for instrument in pm.instruments
+             if not instrument.is_drum]
+  drums = ["Drums" for instrument in pm.instruments if instrument.is_drum]
+  classes = classes + drums
+  if not classes:
+    return Rejected(Rejection.NO_PROGRAM_CLASSES, len(classes))
+  return classes
+
+
+def write_drums(msd_id: str, pm_drums: PrettyMIDI) -> dict:
+  """
+  Writes the drums MIDI file, or the NoteSequence if the output format is
+  TFRecord.
+
+  :param msd_id: the MSD id
+  :param pm_drums: the PrettyMIDI instance of the drums
+  :return: the dictionary containing the output path, the drums end time and
+  note count
+  """
+  if NOTE_SEQUENCE_WRITERS is not None:
+    output_path = NOTE_SEQUENCE_WRITERS["drums"].write(pm_drums, msd_id)
+  else:
+    output_dir = os.path.join(args.path_output_dir, "drums")
+    os.makedirs(output_dir, exist_ok=True)
+    output_path = os.path.join(output_dir, f"{msd_id}.mid")
+    write_midi(pm_drums, output_path)
+  return {"output_path": output_path,
+          "end_time": pm_drums.get_end_time(),
+          "note_count": len(pm_drums.instruments[0].notes)}
+
+
+def write_pianos(msd_id: str, pm_pianos: List[PrettyMIDI]) -> dict:
+  """
+  Writes the pianos MIDI files, or the NoteSequences if the output format is
+  TFRecord.
+
+  :param msd_id: the MSD id
+  :param pm_pianos: the PrettyMIDI instances of the pianos
+  :return: the dictionary containing the output paths, the pianos end times
+  and note counts
+  """
+  output_dir = os.path.join(args.path_output_dir, "pianos")
+  os.makedirs(output_dir, exist_ok=True)
+  output_paths = []
+  for index, pm_piano in enumerate(pm_pianos):
+    if NOTE_SEQUENCE_WRITERS is not None:
+      output_path = NOTE_SEQUENCE_WRITERS["pianos"].write(pm_piano,
+                                                          f"{msd_id}_{index}")
+    else:
+      output_path = os.path.join(output_dir, f"{msd_id}_{index}.mid")
+      write_midi(pm_piano, output_path)
+    output_paths.append(output_path)
+  return {"output_paths": output_paths,
+          "end_times": [pm_piano.get_end_time() for pm_piano in pm_pianos],
+          "note_counts": [len(pm_piano.instruments[0].notes)
+                          for pm_piano in pm_pianos]}
+
+
+# The drums and pianos are only extracted for the songs that have MSD
+# metadata (and the matching tags if provided)
+EXTRACT_REQUIRES = ["metadata"] + (["matching_tags"] if TAGS else [])
+
+# The pipeline, only the stages needed for the requested outputs are run
+PIPELINE = Pipeline([
+  Stage("midi_path", load_unique_midi_path, ["msd_id"]),
+  Stage("metadata", load_metadata, ["msd_id"]),
+  Stage("artist", get_artist, ["metadata"]),
+  Stage("tags", fetch_tags, ["metadata"]),
+  Stage("matching_tags", filter_by_tags, ["tags"]),
+  Stage("pm", parse_midi, ["midi_path"]),
+  Stage("classes", get_instrument_classes, ["pm"], requires=["metadata"]),
+  Stage("pm_drums", get_drums_or_rejection, ["pm"],
+        requires=EXTRACT_REQUIRES),
+  Stage("drums", write_drums, ["msd_id", "pm_drums"]),
+  Stage("pm_pianos", get_pianos_or_rejection, ["pm"],
+        requires=EXTRACT_REQUIRES),
+  Stage("pianos", write_pianos, ["msd_id", "pm_pianos"]),
+], outputs=REQUESTED_OUTPUTS, inputs=["msd_id"])
+
+
+def prefetch_tags(msd_ids: List[str]):
+  """
+  Fetches the tags of the given MSD ids concurrently from this process,
+  before the processing, and stores them in the tag cache. The processing
+  will then find the tags in the tag cache.
+
+  :param msd_ids: the MSD ids to fetch the tags for
+  """
+  tracks = []
+  for msd_id in msd_ids:
+    try:
+      metadata = load_metadata(msd_id)
+      tracks.append((metadata["artist_name"], metadata["title"]))
+    except Exception:
+      # The exception will be reported during the processing
+      continue
+  fetcher = TagFetcher(args.last_fm_api_key,
+                       TAG_CACHE,
+                       concurrency=args.fetch_concurrency,
+                       rate_limit=args.fetch_rate_limit,
+                       api_url=args.last_fm_api_url)
+  counter = SharedCounter(len(tracks))
+  print("START FETCH")
+  for _ in fetcher.fetch_many(tracks):
+    counter.increment()
+  print("END FETCH")
+
+
+def process(msd_id: str) -> Optional[dict]:
+  """
+  Processes the given MSD id. The method will run the pipeline stages needed
+  for the requested outputs.
+
+  :param msd_id: the MSD id to process
+  :return: the dictionary containing the MSD id and the computed outputs
+  """
+  return PIPELINE.run({"msd_id": msd_id})
+
+
+def _plot_bar(counter: Counter, title: str):
+  most_common = counter.most_common(25)
+  plt.figure(num=None, figsize=(10, 8), dpi=500)
+  plt.bar([name for name, _ in most_common],
+          [count for _, count in most_common],
+          color=[color.name for color in colors
+                 if color.name != "lavender"])
+  plt.title(title)
+  plt.xticks(rotation=30, horizontalalignment="right")
+  plt.ylabel("count")
+  plt.show()
+
+
+def _plot_hist(lengths: List[float], title: str):
+  plt.figure(num=None, figsize=(10, 8), dpi=500)
+  plt.hist(lengths, bins=100, color="darkmagenta")
+  plt.title(title)
+  plt.ylabel("length (sec)")
+  plt.show()
+
+
+def init_worker(msd_score_matches: Dict,
+                duplicates: Optional[Dict[str, str]] = None):
+  """
+  Initializes the globals of the pool workers, called in the main process
+  before starting the pool.
+
+  :param msd_score_matches: the best score match of each processed MSD id,
+  see get_best_msd_score_matches
+  :param duplicates: the optional duplicate MSD ids, see remove_duplicates
+  """
+  global MSD_SCORE_MATCHES, DUPLICATES
+  MSD_SCORE_MATCHES = msd_score_matches
+  DUPLICATES = duplicates or {}
+
+
+def app(msd_ids: List[str], tracks_count: int):
+  start = timeit.default_timer()
+
+  stage_names = [stage.name for stage in PIPELINE.stages]
+  print(f"Stages: {','.join(stage_names)}")
+
+  # Finds the MSD ids with the same MIDI content as another MSD id of the
+  # sample before parsing them, the duplicates are mapped to the kept MSD ids
+  # and only the stages using the metadata are run for them
+  unique_msd_ids, duplicates = (
+    remove_duplicates(msd_ids, load_midi_path, args.dedup, args.pool_size,
+                      None, args.path_duplicates)
+    if args.dedup else (msd_ids, {}))
+
+  if "drums" in stage_names or "pianos" in stage_names:
+    if SHARD is None:
+      # Cleanup the output directory, the shards of a sharded run share
+      # it (the output files are named after the input files)
+      shutil.rmtree(args.path_output_dir, ignore_errors=True)
+
+  if (args.fetch_concurrency and not args.tag_cache_only
+      and "tags" in stage_names):
+    prefetch_tags(msd_ids)
+
+  if args.largest_first:
+    # Starts the largest files first, so the pool doesn't wait for a
+    # single worker processing a large file at the end of the run
+    msd_ids = sort_largest_first(msd_ids, load_midi_path)
+
+  # Starts the threads
+  counter = SharedCounter(len(msd_ids))
+  with Pool(args.pool_size,
+            initializer=init_worker,
+            initargs=(MSD_SCORE_MATCHES, duplicates)) as pool:
+    print("START")
+    utilization = WorkerUtilization() if args.print_utilization else None
+    results_counts = Counter()
+    rejections = Counter()
+    midi_rejections = Counter()
+    artists = Counter()
+    tags = Counter()
+    classes = Counter()
+    drums_lengths = []
+    pianos_lengths = []
+    for result in imap_results(pool, process, msd_ids, counter,
+                               args.chunksize, METRICS,
+                               rejections=rejections,
+                               utilization=utilization,
+                               limits=WORKER_LIMITS,
+                               quarantine=QUARANTINE):
+      results_counts.update(output for output in OUTPUTS if output in result)
+      # The rejections and errors of the stages, an item can be rejected by
+      # a stage and have other outputs, the rejections of the stages using
+      # the MIDI file are counted apart since the duplicates don't run them
+      for stage_name, reason in result.get("rejections", {}).items():
+        (midi_rejections if stage_name in MIDI_STAGES
+         else rejections)[reason] += 1
+      for stage_name in result.get("errors", {}):
+        (midi_rejections if stage_name in MIDI_STAGES
+         else rejections)[Rejection.ERROR.value] += 1
+      if "artist" in result:
+        artists[result["artist"]] += 1
+      if result.get("tags"):
+        # The top tag of each song, like example 02
+        tags[result["tags"][0]] += 1
+      if "classes" in result:
+        classes.update(result["classes"])
+      if "drums" in result:
+        drums_lengths.append(result["drums"]["end_time"])
+      if "pianos" in result:
+        pianos_lengths.extend(result["pianos"]["end_times"])
+    print("END")
+    print(f"Number of tracks: {tracks_count}, "
+          f"number of tracks in sample: {len(msd_ids)}, "
+          f"number of unique tracks in sample: {len(unique_msd_ids)}")
+    for output in REQUESTED_OUTPUTS:
+      # The outputs using the MIDI file are counted over the unique tracks
+      # of the sample, the duplicates aren't parsed
+      output_count = (len(unique_msd_ids) if output in MIDI_OUTPUTS
+                      else len(msd_ids))
+      results_percentage = results_counts[output] / output_count * 100
+      print(f"Number of {output} results: {results_counts[output]} "
+            f"({results_percentage:.2f}%)")
+    print_rejections(rejections, len(msd_ids))
+    if midi_rejections:
+      print(f"Rejections of the stages using the MIDI file, over the "
+            f"{len(unique_msd_ids)} unique tracks:")
+      print_rejections(midi_rejections, len(unique_msd_ids))
+    if args.dedup:
+      print_duplicates(duplicates, len(msd_ids))
+    if utilization is not None:
+      utilization.print()
+
+  if artists:
+    print(f"Most common artists: {artists.most_common(25)}")
+    _plot_bar(artists, "Artist song count")
+  if tags:
+    print(f"Most common tags: {tags.most_common(25)}")
+    _plot_bar(tags, "Most common tags (25)")
+  if classes:
+    print(f"Most common classes: {classes.most_common(25)}")
+    _plot_bar(classes, "Instrument classes")
+  if drums_lengths:
+    _plot_hist(drums_lengths, "Drums lengths")
+  if pianos_lengths:
+    _plot_hist(pianos_lengths, "Piano lengths")
+
+  if METRICS is not None:
+    METRICS.save()
+
+  if args.path_stats:
+    # The statistics of the run, merged with the other shards using the
+    # shard_utils.py file
+    save_stats(args.path_stats, {"tracks": tracks_count,
+                                 "tracks_in_sample": len(msd_ids),
+                                 "unique_tracks_in_sample": len(unique_msd_ids),
+                                 "results": results_counts,
+                                 "artists": artists,
+                                 "tags": tags,
+                                 "classes": classes,
+                                 "drums_lengths": drums_lengths,
+                                 "pianos_lengths": pianos_lengths,
+                                 "rejections": rejections + midi_rejections,
+                                 "duplicates": len(duplicates)})
+
+  stop = timeit.default_timer()
+  print("Time: ", stop - start)
+
+
+if __name__ == "__main__":
+  # The MSD ids to process (we might process only a sample), the match
+  # scores file is streamed by the main process to keep only the scores of
+  # the sample, the pool workers only receive the best match of each
+  # processed MSD id
+  MSD_IDS, msd_score_matches, TRACKS_COUNT = sample_msd_score_matches(
+    args.path_match_scores_file, args.sample_size, SHARD, args.seed)
+  init_worker(get_best_msd_score_matches(msd_score_matches, MSD_IDS))
+  del msd_score_matches
+  app(MSD_IDS, TRACKS_COUNT)
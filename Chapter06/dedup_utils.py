@@ -0,0 +1,227 @@
+"""
+Deduplication utilities, to skip the MIDI files having the same content as
+another file of the run before parsing them.
+
+The Lakh MIDI Dataset (LMD) contains many copies of the same MIDI file
+matched with different MSD ids, and files that only differ by their meta
+events (track names, tempo markings, etc.) or by their velocities. Each item
+of a run is fingerprinted in the pool, by the hash of its bytes ("content")
+or by the hash of its normalized notes ("notes"), and only the first item of
+each fingerprint (in key order) is processed. The duplicates are mapped to
+the processed item, so their results can be found in its outputs.
+"""
+
+import argparse
+import glob
+import hashlib
+import json
+import os
+import timeit
+from collections import Counter
+from multiprocessing.pool import Pool
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+import numpy as np
+
+from manifest_utils import get_fingerprint
+from metrics_utils import timed
+from midi_utils import read_midi
+from note_cache_utils import NoteCache
+from note_cache_utils import get_midi_arrays
+
+# The fingerprints of the deduplication, see get_midi_fingerprint
+DEDUP_MODES = ["content", "notes"]
+
+# The resolution of the note times in the notes fingerprint in seconds
+NOTES_TIME_RESOLUTION = 0.01
+
+
+def get_notes_fingerprint(notes: np.ndarray) -> str:
+  """
+  Returns the fingerprint of the given notes, independent of the tracks
+  order, the velocities, the leading silence and the small time differences.
+
+  :param notes: the notes, see note_cache_utils.NOTE_DTYPE
+  :return: the fingerprint
+  """
+  if not len(notes):
+    return get_fingerprint_of_bytes(b"")
+  origin = notes["start"].min()
+  normalized = np.zeros((len(notes), 5), dtype=np.int64)
+  normalized[:, 0] = np.round((notes["start"] - origin)
+                              / NOTES_TIME_RESOLUTION)
+  normalized[:, 1] = np.round((notes["end"] - origin)
+                              / NOTES_TIME_RESOLUTION)
+  normalized[:, 2] = notes["pitch"]
+  # The program of the drums doesn't change the sound
+  normalized[:, 3] = np.where(notes["is_drum"], 0, notes["program"])
+  normalized[:, 4] = notes["is_drum"]
+  normalized = normalized[np.lexsort(normalized.T[::-1])]
+  return get_fingerprint_of_bytes(normalized.tobytes())
+
+
+def get_fingerprint_of_bytes(content: bytes) -> str:
+  """
+  :param content: the bytes to fingerprint
+  :return: the MD5 of the bytes
+  """
+  return hashlib.md5(content).hexdigest()
+
+
+def get_midi_fingerprint(midi_path: str,
+                         mode: str,
+                         note_cache: Optional[NoteCache] = None) -> str:
+  """
+  Returns the fingerprint of the given MIDI file.
+
+  :param midi_path: the path to the MIDI file
+  :param mode: "content" for the hash of the bytes, "notes" for the hash of
+  the normalized notes (see get_notes_fingerprint)
+  :param note_cache: the optional note cache, used instead of parsing the
+  MIDI file for the "notes" mode
+  :return: the fingerprint
+  """
+  if mode == "content":
+    with timed("dedup_content"):
+      return get_fingerprint(midi_path, hash_content=True)
+  if mode == "notes":
+    with timed("dedup_notes"):
+      midi_md5 = os.path.splitext(os.path.basename(midi_path))[0]
+      cached_midi = note_cache.get(midi_md5) if note_cache else None
+      notes = (cached_midi.notes if cached_midi
+               else get_midi_arrays(read_midi(midi_path))[1])
+      return get_notes_fingerprint(notes)
+  raise Exception(f"Unknown deduplication mode: {mode}")
+
+
+class _Fingerprinter(object):
+  """
+  The process function of find_duplicates, returning the (key, fingerprint)
+  tuple of an item, the fingerprint is None if the file can't be read.
+  """
+
+  def __init__(self, mode: str, note_cache: Optional[NoteCache]):
+    self.mode = mode
+    self.note_cache = note_cache
+
+  def __call__(self, item: Tuple[str, str]) -> Tuple[str, Optional[str]]:
+    key, midi_path = item
+    try:
+      return key, get_midi_fingerprint(midi_path, self.mode, self.note_cache)
+    except Exception as e:
+      print(f"Exception during processing of {midi_path}: {e}")
+      return key, None
+
+
+def find_duplicates(items: List[Tuple[str, str]],
+                    mode: str,
+                    pool_size: int = 4,
+                    note_cache: Optional[NoteCache] = None) -> Dict[str, str]:
+  """
+  Finds the items having the same fingerprint as another item. The kept
+  item of each fingerprint is the first in key order, so the result doesn't
+  depend on the order of the items or of the pool. The items that can't be
+  read are never duplicates, their processing will report the error.
+
+  :param items: the (key, MIDI path) tuples, the key being the MSD id or the
+  MIDI path
+  :param mode: the fingerprint, see get_midi_fingerprint
+  :param pool_size: the number of processes
+  :param note_cache: the optional note cache, see get_midi_fingerprint
+  :return: the key of the kept item for each duplicate key
+  """
+  with Pool(pool_size) as pool:
+    fingerprints = dict(pool.imap_unordered(_Fingerprinter(mode, note_cache),
+                                            items, chunksize=16))
+  kept_keys = {}
+  duplicates = {}
+  for key in sorted(fingerprints):
+    fingerprint = fingerprints[key]
+    if fingerprint is None:
+      continue
+    if fingerprint in kept_keys:
+      duplicates[key] = kept_keys[fingerprint]
+    else:
+      kept_keys[fingerprint] = key
+  return duplicates
+
+
+def remove_duplicates(
+    keys: List[str],
+    get_midi_path: Callable[[str], str],
+    mode: str,
+    pool_size: int = 4,
+    note_cache: Optional[NoteCache] = None,
+    duplicates_path: Optional[str] = None) -> Tuple[List[str], Dict[str, str]]:
+  """
+  Removes the duplicates from the keys of a run, see find_duplicates.
+
+  :param keys: the keys of the run, the MSD ids or the MIDI paths
+  :param get_midi_path: the function returning the MIDI path of a key,
+  called in this process
+  :param mode: the fingerprint, see get_midi_fingerprint
+  :param pool_size: the number of processes
+  :param note_cache: the optional note cache, see get_midi_fingerprint
+  :param duplicates_path: the optional path to the JSON file of the
+  duplicates, mapping each duplicate key to the kept key
+  :return: the (kept keys in the same order, duplicates) tuple
+  """
+  items = []
+  for key in keys:
+    try:
+      items.append((key, get_midi_path(key)))
+    except Exception:
+      # The item is kept, its processing will report the error
+      continue
+  duplicates = find_duplicates(items, mode, pool_size, note_cache)
+  if duplicates_path:
+    with open(duplicates_path, "w") as file:
+      json.dump(duplicates, file, indent=2, sort_keys=True)
+  return [key for key in keys if key not in duplicates], duplicates
+
+
+def print_duplicates(duplicates: Dict[str, str], total_count: int):
+  """
+  Prints the number of duplicates.
+
+  :param duplicates: the duplicates, see find_duplicates
+  :param total_count: the number of items before deduplication
+  """
+  percentage = len(duplicates) / total_count * 100 if total_count else 0
+  print(f"Number of duplicates: {len(duplicates)} ({percentage:.2f}%)")
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--pool_size", type=int, default=4)
+  parser.add_argument("--path_dataset_dir", type=str, required=True)
+  parser.add_argument("--dedup", type=str, default="content",
+                      choices=DEDUP_MODES)
+  parser.add_argument("--path_note_cache", type=str)
+  parser.add_argument("--path_duplicates", type=str)
+  args = parser.parse_args()
+
+  start = timeit.default_timer()
+  midi_paths = glob.glob(os.path.join(args.path_dataset_dir, "**", "*.mid"),
+                         recursive=True)
+  note_cache = (NoteCache(args.path_note_cache)
+                if args.path_note_cache else None)
+  _, duplicates = remove_duplicates(midi_paths, lambda path: path,
+                                    args.dedup, args.pool_size, note_cache,
+                                    args.path_duplicates)
+  print(f"Number of MIDI files: {len(midi_paths)}, "
+        f"number of unique files: {len(midi_paths) - len(duplicates)}")
+  print_duplicates(duplicates, len(midi_paths))
+  most_duplicated = Counter(duplicates.values()).most_common(10)
+  for midi_path, count in most_duplicated:
+    print(f"{midi_path}: {count} duplicates")
+  stop = timeit.default_timer()
+  print("Time: ", stop - start)
+
+
+if __name__ == "__main__":
+  main()
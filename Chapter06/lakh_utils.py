@@ -2,10 +2,48 @@
 The Lakh MIDI Dataset utilities
 """
 
+import argparse
 import json
 import os
-
+import random
+import re
+from collections import deque
+from itertools import islice
+from typing import Container
 from typing import Dict
+from typing import Iterable
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Tuple
+from typing import Union
+
+import numpy as np
+
+# The header of the best match table file, followed by the sorted MSD ids,
+# the MIDI MD5s (empty if not matched) and the scores, the MSD ids and MIDI
+# MD5s are stored with the fixed size of the longest
+_BEST_MATCH_HEADER_DTYPE = np.dtype([("magic", "S8"),
+                                     ("version", "<u4"),
+                                     ("msd_id_size", "<u4"),
+                                     ("midi_md5_size", "<u4"),
+                                     ("count", "<u8")])
+_BEST_MATCH_MAGIC = b"LMDMATCH"
+BEST_MATCH_TABLE_VERSION = 1
+
+# The size of the chunks read by the streaming parser of the match scores
+_STREAM_CHUNK_SIZE = 1 << 20
+
+# The start of the match scores file object (with its end if it is empty),
+# and an entry of the object: the MSD id and the object of scores (flat,
+# the scores are numbers), followed by the separator or the end of the file
+# object
+_MATCH_SCORES_START = re.compile(r"\s*\{\s*(\})?")
+_MATCH_SCORES_ENTRY = re.compile(
+  r'\s*"([^"\\]*(?:\\.[^"\\]*)*)"\s*:\s*(\{[^}]*\})\s*([,}])')
+
+# The samplings of the MIDI files of the dataset, see sample_midi_paths
+SAMPLING_MODES = ["reservoir", "directories"]
 
 
 def msd_id_to_dirs(msd_id: str) -> str:
@@ -50,31 +88,490 @@ def msd_id_to_h5(msd_id: str,
                       msd_id_to_dirs(msd_id) + ".h5")
 
 
-def get_msd_score_matches(match_scores_path: str) -> Dict:
+class BestMatchTable(object):
+  """
+  A read only table of the best MIDI match of each MSD id, built from the
+  match scores file using build_best_match_table. The MSD ids are sorted
+  and looked up using a binary search, the table file is memory mapped
+  lazily for each process, so the table can be shared with the pool workers.
+  Iterating the table gives the MSD ids, like the dictionary of scores.
+  """
+
+  def __init__(self, table_path: str):
+    """
+    Constructs the table from an existing table file.
+
+    :param table_path: the path to the table file
+    """
+    if not os.path.exists(table_path):
+      raise Exception(f"Best match table not found {table_path}")
+    self._table_path = table_path
+    self._columns = None
+    self._pid = None
+
+  def __getstate__(self):
+    # The memory maps would be copied when pickled, they are opened again
+    return {"_table_path": self._table_path,
+            "_columns": None,
+            "_pid": None}
+
+  def _get_columns(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    if self._columns is None or self._pid != os.getpid():
+      header = np.fromfile(self._table_path,
+                           dtype=_BEST_MATCH_HEADER_DTYPE,
+                           count=1)
+      if (not len(header)
+          or header["magic"][0] != _BEST_MATCH_MAGIC
+          or header["version"][0] != BEST_MATCH_TABLE_VERSION):
+        raise Exception(f"Invalid best match table {self._table_path}")
+      count = int(header["count"][0])
+      columns = []
+      for offset, dtype in _get_best_match_columns(
+          count,
+          int(header["msd_id_size"][0]),
+          int(header["midi_md5_size"][0])):
+        # Plain array views of the memory maps, faster to index
+        columns.append(np.memmap(self._table_path,
+                                 dtype=dtype,
+                                 mode="r",
+                                 offset=offset,
+                                 shape=(count,)).view(np.ndarray)
+                       if count else np.zeros(0, dtype=dtype))
+      self._columns = tuple(columns)
+      self._pid = os.getpid()
+    return self._columns
+
+  def get(self, msd_id: str) -> Optional[Tuple[Optional[str], float]]:
+    """
+    Returns the best match of the given MSD id.
+
+    :param msd_id: the MSD id
+    :return: the (MIDI MD5, score) tuple, the MD5 is None if the MSD id
+    isn't matched, None if the MSD id isn't in the table
+    """
+    msd_ids, midi_md5s, scores = self._get_columns()
+    key = msd_id.encode("ascii")
+    position = int(msd_ids.searchsorted(key))
+    if position == len(msd_ids) or msd_ids[position] != key:
+      return None
+    midi_md5 = midi_md5s[position].decode("ascii")
+    return midi_md5 or None, float(scores[position])
+
+  def get_matched_midi_md5(self, msd_id: str) -> str:
+    """
+    Returns the MD5 of the matched MIDI from its MSD id.
+
+    :param msd_id: the MSD id
+    :return: the matched MIDI MD5
+    """
+    match = self.get(msd_id)
+    if match is None:
+      raise Exception(f"Unknown MSD id {msd_id}")
+    if match[0] is None:
+      raise Exception(f"Not matched {msd_id}")
+    return match[0]
+
+  def __contains__(self, msd_id: str) -> bool:
+    return self.get(msd_id) is not None
+
+  def __iter__(self) -> Iterator[str]:
+    msd_ids, _, _ = self._get_columns()
+    return (msd_id.decode("ascii") for msd_id in msd_ids.tolist())
+
+  def __len__(self) -> int:
+    return len(self._get_columns()[0])
+
+
+# The MSD score dict or the best match table
+MsdScoreMatches = Union[Dict, BestMatchTable]
+
+# The (sampled MSD ids, score matches, number of MSD ids) tuple
+MsdSample = Tuple[List[str], MsdScoreMatches, int]
+
+
+def _get_best_match_columns(count: int,
+                            msd_id_size: int,
+                            midi_md5_size: int) -> List[Tuple[int, np.dtype]]:
+  # The (offset, dtype) of each column for the given number of MSD ids, the
+  # scores are aligned on 8 bytes
+  msd_ids_offset = 64
+  midi_md5s_offset = msd_ids_offset + msd_id_size * count
+  scores_offset = midi_md5s_offset + midi_md5_size * count
+  return [(msd_ids_offset, np.dtype(f"S{msd_id_size}")),
+          (midi_md5s_offset, np.dtype(f"S{midi_md5_size}")),
+          (scores_offset + (-scores_offset % 8), np.dtype("<f8"))]
+
+
+def _is_best_match_table(path: str) -> bool:
+  with open(path, "rb") as file:
+    return file.read(len(_BEST_MATCH_MAGIC)) == _BEST_MATCH_MAGIC
+
+
+def get_msd_score_matches(match_scores_path: str) -> MsdScoreMatches:
   """
-  Returns the dictionary of scores from the match scores file.
+  Returns the dictionary of scores from the match scores file, or the best
+  match table if the file is a table built using build_best_match_table,
+  which is much smaller in memory and supports the same usages (iterating
+  the MSD ids and get_matched_midi_md5).
 
   :param match_scores_path: the match scores path
-  :return: the dictionary of scores
+  :return: the dictionary of scores or the best match table
   """
+  if _is_best_match_table(match_scores_path):
+    return BestMatchTable(match_scores_path)
   with open(match_scores_path) as f:
     return json.load(f)
 
 
-def get_matched_midi_md5(msd_id: str, msd_score_matches: dict):
+def _iter_raw_msd_score_matches(
+    match_scores_path: str) -> Iterator[Tuple[str, str]]:
+  # Iterates the (MSD id, JSON scores) entries of the match scores file,
+  # reading the file by chunks, the scores are only decoded by the callers
+  # that need them
+  with open(match_scores_path) as file:
+    buffer = ""
+    position = 0
+    eof = False
+    pattern = _MATCH_SCORES_START
+    while True:
+      match = pattern.match(buffer, position)
+      if match is None or (match.end() == len(buffer) and not eof):
+        # The match could be incomplete, reads the next chunk
+        if eof:
+          raise Exception(f"Invalid match scores file {match_scores_path}")
+        chunk = file.read(_STREAM_CHUNK_SIZE)
+        eof = not chunk
+        buffer = buffer[position:] + chunk
+        position = 0
+        continue
+      position = match.end()
+      if pattern is _MATCH_SCORES_START:
+        if match.group(1):
+          return
+        pattern = _MATCH_SCORES_ENTRY
+        continue
+      msd_id = match.group(1)
+      if "\\" in msd_id:
+        msd_id = json.loads(f'"{msd_id}"')
+      yield msd_id, match.group(2)
+      if match.group(3) == "}":
+        return
+
+
+def iter_msd_ids(match_scores_path: str) -> Iterator[str]:
   """
-  Returns the MD5 of the matched MIDI from its MSD id.
+  Iterates the MSD ids of the match scores file lazily, reading the file by
+  chunks without decoding the scores.
 
-  :param msd_id: the MSD id
-  :param msd_score_matches: the MSD score dict, use get_msd_score_matches
-  :return: the matched MIDI MD5
+  :param match_scores_path: the match scores path, or the best match table
+  path
+  :return: the iterator of MSD ids
   """
+  if _is_best_match_table(match_scores_path):
+    yield from BestMatchTable(match_scores_path)
+    return
+  for msd_id, _ in _iter_raw_msd_score_matches(match_scores_path):
+    yield msd_id
+
+
+def iter_msd_score_matches(
+    match_scores_path: str,
+    msd_ids: Optional[Container[str]] = None) -> Iterator[Tuple[str, Dict]]:
+  """
+  Iterates the scores of the match scores file lazily, reading the file by
+  chunks instead of loading the whole dictionary of scores.
+
+  :param match_scores_path: the match scores path
+  :param msd_ids: only the given MSD ids if provided, the scores of the
+  other MSD ids are not decoded
+  :return: the iterator of (MSD id, scores) tuples
+  """
+  for msd_id, scores in _iter_raw_msd_score_matches(match_scores_path):
+    if msd_ids is None or msd_id in msd_ids:
+      yield msd_id, json.loads(scores)
+
+
+def reservoir_sample(items: Iterable,
+                     sample_size: int,
+                     rng: Optional[random.Random] = None) -> Tuple[List, int]:
+  """
+  Returns a uniform random sample of the items, consuming the items lazily
+  and only keeping the sample in memory (reservoir sampling).
+
+  :param items: the items, for example an iterator on the dataset
+  :param sample_size: the number of items of the sample
+  :param rng: the optional random generator, for a reproducible sample
+  :return: the (sample, number of items) tuple
+  """
+  rng = rng or random.Random()
+  reservoir = []
+  count = 0
+  for item in items:
+    count += 1
+    if len(reservoir) < sample_size:
+      reservoir.append(item)
+    else:
+      position = rng.randrange(count)
+      if position < sample_size:
+        reservoir[position] = item
+  return reservoir, count
+
+
+def sample_msd_score_matches(
+    match_scores_path: str,
+    sample_size: int,
+    msd_ids: Optional[Container[str]] = None,
+    seed: Optional[int] = None) -> MsdSample:
+  """
+  Returns a random sample of MSD ids with their scores. The match scores
+  file (or the best match table) is streamed and only the scores of the
+  sample are kept (reservoir sampling), so the whole dictionary of scores
+  (or the list of MSD ids) is never loaded.
+
+  :param match_scores_path: the match scores path, or the best match table
+  path
+  :param sample_size: the number of MSD ids, 0 for all the MSD ids
+  :param msd_ids: only samples the given MSD ids if provided, for example a
+  shard (see shard_utils)
+  :param seed: the optional seed of the sampling, the same seed gives the
+  same sample of the same file
+  :return: the (MSD ids, score matches, number of MSD ids before sampling)
+  tuple, the score matches are the dictionary of scores of the MSD ids, or
+  the best match table if the file is a table
+  """
+  rng = random.Random(seed)
+  if _is_best_match_table(match_scores_path):
+    best_match_table = BestMatchTable(match_scores_path)
+    table_msd_ids = (msd_id for msd_id in best_match_table
+                     if msd_ids is None or msd_id in msd_ids)
+    if not sample_size:
+      sampled_msd_ids = list(table_msd_ids)
+      return sampled_msd_ids, best_match_table, len(sampled_msd_ids)
+    sampled_msd_ids, count = reservoir_sample(table_msd_ids, sample_size, rng)
+    return sampled_msd_ids, best_match_table, count
+  if not sample_size:
+    msd_score_matches = (get_msd_score_matches(match_scores_path)
+                         if msd_ids is None
+                         else dict(iter_msd_score_matches(match_scores_path,
+                                                          msd_ids)))
+    return list(msd_score_matches), msd_score_matches, len(msd_score_matches)
+  reservoir, count = reservoir_sample(
+    ((msd_id, scores)
+     for msd_id, scores in _iter_raw_msd_score_matches(match_scores_path)
+     if msd_ids is None or msd_id in msd_ids),
+    sample_size, rng)
+  msd_score_matches = {msd_id: json.loads(scores)
+                       for msd_id, scores in reservoir}
+  return list(msd_score_matches), msd_score_matches, count
+
+
+def _list_dir(path: str) -> Tuple[List[str], List[str]]:
+  # The sorted (MIDI files, subdirectories) paths of the directory, the
+  # hidden entries are skipped like glob
+  midi_paths = []
+  dir_paths = []
+  with os.scandir(path) as entries:
+    for entry in entries:
+      if entry.name.startswith("."):
+        continue
+      if entry.is_dir():
+        dir_paths.append(entry.path)
+      elif entry.name.endswith(".mid"):
+        midi_paths.append(entry.path)
+  return sorted(midi_paths), sorted(dir_paths)
+
+
+def iter_midi_paths(dataset_dir: str) -> Iterator[str]:
+  """
+  Iterates the MIDI files of the dataset directory and its subdirectories
+  lazily, in the same order on every machine, only keeping the listing of
+  the current directories in memory.
+
+  :param dataset_dir: the dataset directory, for example "lmd_matched"
+  :return: the iterator of MIDI paths
+  """
+  midi_paths, dir_paths = _list_dir(dataset_dir)
+  yield from midi_paths
+  for dir_path in dir_paths:
+    yield from iter_midi_paths(dir_path)
+
+
+def _iter_midi_paths_by_directory(dir_path: str,
+                                  rng: random.Random) -> Iterator[str]:
+  # Iterates the MIDI files of the directory in random order, taking each
+  # file or subdirectory in turn, the subdirectories are only listed when
+  # they are reached
+  midi_paths, dir_paths = _list_dir(dir_path)
+  iterators = ([iter([midi_path]) for midi_path in midi_paths]
+               + [_iter_midi_paths_by_directory(path, rng)
+                  for path in dir_paths])
+  rng.shuffle(iterators)
+  iterators = deque(iterators)
+  while iterators:
+    iterator = iterators.popleft()
+    midi_path = next(iterator, None)
+    if midi_path is not None:
+      yield midi_path
+      iterators.append(iterator)
+
+
+def sample_midi_paths(
+    dataset_dir: str,
+    sample_size: int,
+    relative_paths: Optional[Container[str]] = None,
+    sampling: str = "reservoir",
+    seed: Optional[int] = None) -> Tuple[List[str], Optional[int]]:
+  """
+  Returns a random sample of the MIDI files of the dataset directory, the
+  directory is walked lazily (see iter_midi_paths) and only the sample is
+  kept in memory:
+
+  - "reservoir" walks the whole dataset for a uniform sample
+  - "directories" takes the files of the subdirectories in turn, at each
+    level in a random order (stratified by directory), and stops as soon as
+    the sample is complete, so the time to get the sample doesn't depend on
+    the size of the dataset. The sample isn't uniform, it is spread over the
+    directories (with the LMD, the first characters of the MSD ids, or of
+    the MD5s for lmd_full)
+
+  :param dataset_dir: the dataset directory
+  :param sample_size: the number of MIDI files, 0 for all the MIDI files
+  :param relative_paths: only samples the MIDI files whose path relative to
+  the dataset directory is in the container, for example a shard (see
+  shard_utils)
+  :param sampling: the sampling, see SAMPLING_MODES
+  :param seed: the optional seed of the sampling, the same seed gives the
+  same sample of the same dataset
+  :return: the (MIDI paths, number of MIDI files) tuple, the number of MIDI
+  files is None for the "directories" sampling, which doesn't walk the
+  whole dataset
+  """
+  rng = random.Random(seed)
+  if sampling == "directories" and sample_size:
+    midi_paths = _iter_midi_paths_by_directory(dataset_dir, rng)
+  elif sampling in SAMPLING_MODES:
+    midi_paths = iter_midi_paths(dataset_dir)
+  else:
+    raise Exception(f"Unknown sampling: {sampling}")
+  if relative_paths is not None:
+    midi_paths = (midi_path for midi_path in midi_paths
+                  if os.path.relpath(midi_path, dataset_dir) in relative_paths)
+  if not sample_size:
+    sampled_midi_paths = list(midi_paths)
+    return sampled_midi_paths, len(sampled_midi_paths)
+  if sampling == "directories":
+    return list(islice(midi_paths, sample_size)), None
+  return reservoir_sample(midi_paths, sample_size, rng)
+
+
+def _get_best_match(scores: Dict[str, float]) -> Tuple[Optional[str], float]:
+  # The first MIDI MD5 with the highest strictly positive score
   max_score = 0
   matched_midi_md5 = None
-  for midi_md5, score in msd_score_matches[msd_id].items():
+  for midi_md5, score in scores.items():
     if score > max_score:
       max_score = score
       matched_midi_md5 = midi_md5
+  return matched_midi_md5, max_score
+
+
+def get_matched_midi_md5(msd_id: str, msd_score_matches: MsdScoreMatches):
+  """
+  Returns the MD5 of the matched MIDI from its MSD id.
+
+  :param msd_id: the MSD id
+  :param msd_score_matches: the MSD score dict or the best match table, use
+  get_msd_score_matches
+  :return: the matched MIDI MD5
+  """
+  if isinstance(msd_score_matches, BestMatchTable):
+    return msd_score_matches.get_matched_midi_md5(msd_id)
+  matched_midi_md5, _ = _get_best_match(msd_score_matches[msd_id])
   if not matched_midi_md5:
     raise Exception(f"Not matched {msd_id}: {msd_score_matches[msd_id]}")
   return matched_midi_md5
+
+
+def get_best_msd_score_matches(msd_score_matches: MsdScoreMatches,
+                               msd_ids: Iterable[str]) -> MsdScoreMatches:
+  """
+  Returns the score matches of the given MSD ids reduced to their best
+  match, a small dictionary usable with get_matched_midi_md5 instead of the
+  whole match scores file (for example to initialize the pool workers).
+
+  :param msd_score_matches: the MSD score dict or the best match table, use
+  get_msd_score_matches
+  :param msd_ids: the MSD ids to keep
+  :return: the MSD score dict, with only the best match of each MSD id (or
+  all its scores if it isn't matched, for the error message), or the best
+  match table unchanged since it is already shared between the processes
+  """
+  if isinstance(msd_score_matches, BestMatchTable):
+    return msd_score_matches
+  best_msd_score_matches = {}
+  for msd_id in msd_ids:
+    scores = msd_score_matches[msd_id]
+    matched_midi_md5, max_score = _get_best_match(scores)
+    if matched_midi_md5:
+      best_msd_score_matches[msd_id] = {matched_midi_md5: max_score}
+    else:
+      best_msd_score_matches[msd_id] = scores
+  return best_msd_score_matches
+
+
+def build_best_match_table(match_scores_path: str, table_path: str) -> int:
+  """
+  Builds the best match table from the match scores file, keeping only the
+  best MIDI match of each MSD id, see BestMatchTable.
+
+  :param match_scores_path: the match scores path
+  :param table_path: the path to the table file, replaced at the end
+  :return: the number of MSD ids in the table
+  """
+  best_matches = sorted(
+    (msd_id, _get_best_match(scores))
+    for msd_id, scores in iter_msd_score_matches(match_scores_path))
+  msd_ids = [msd_id for msd_id, _ in best_matches]
+  matches = [match for _, match in best_matches]
+  # The bytes are sorted like the strings since the MSD ids are ASCII
+  columns = [np.array([msd_id.encode("ascii") for msd_id in msd_ids]),
+             np.array([(midi_md5 or "").encode("ascii")
+                       for midi_md5, _ in matches]),
+             np.array([score for _, score in matches], dtype="<f8")]
+  count = len(msd_ids)
+  msd_id_size = columns[0].dtype.itemsize if count else 1
+  midi_md5_size = columns[1].dtype.itemsize if count else 1
+
+  header = np.zeros(1, dtype=_BEST_MATCH_HEADER_DTYPE)
+  header["magic"] = _BEST_MATCH_MAGIC
+  header["version"] = BEST_MATCH_TABLE_VERSION
+  header["msd_id_size"] = msd_id_size
+  header["midi_md5_size"] = midi_md5_size
+  header["count"] = count
+  temp_path = table_path + ".tmp"
+  with open(temp_path, "wb") as file:
+    header.tofile(file)
+    for (offset, _), column in zip(
+        _get_best_match_columns(count, msd_id_size, midi_md5_size), columns):
+      file.write(b"\0" * (offset - file.tell()))
+      column.tofile(file)
+  os.replace(temp_path, table_path)
+  return count
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--path_match_scores_file", type=str, required=True)
+  parser.add_argument("--path_best_match_table", type=str, required=True)
+  args = parser.parse_args()
+
+  count = build_best_match_table(args.path_match_scores_file,
+                                 args.path_best_match_table)
+  table = BestMatchTable(args.path_best_match_table)
+  matched_count = sum(1 for msd_id in table if table.get(msd_id)[0])
+  print(f"Number of MSD ids: {count}, number of matched: {matched_count}, "
+        f"table size: {os.path.getsize(args.path_best_match_table)} bytes")
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,345 @@
+"""
+Last.fm API utilities, with a persistent on disk cache for the track tags
+and a concurrent fetcher for many tracks.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable
+from typing import Iterator
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+from typing import Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics_utils import add_bytes_read
+from metrics_utils import timed
+
+# The Last.fm API root, can be changed to point to a local server
+LAST_FM_API_URL = "https://ws.audioscrobbler.com/2.0/"
+
+# The Last.fm API error codes that are temporary (operation failed, service
+# offline, temporarily unavailable, rate limit exceeded), never cached
+TRANSIENT_ERROR_CODES = {8, 11, 16, 29}
+
+# The (artist, title, tags, error) tuple returned by the fetcher
+FetchedTags = Tuple[str, str, Optional[List[str]], Optional[str]]
+
+
+class CachedTags(NamedTuple):
+  """
+  A tag cache entry, either the list of tags or the error message
+  returned by the API for the track (negative caching).
+  """
+  tags: Optional[List[str]]
+  error: Optional[str]
+
+
+class TagCache(object):
+  """
+  A SQLite cache of the Last.fm top tags, keyed by (artist, title). The
+  connection is opened lazily for each process, so the cache can be shared
+  with pool workers.
+  """
+
+  def __init__(self,
+               cache_path: str,
+               ttl: Optional[float] = None):
+    """
+    Constructs the cache, creating the cache file if necessary.
+
+    :param cache_path: the path to the cache file
+    :param ttl: the time to live of the entries in seconds, entries never
+    expire if not provided
+    """
+    self._cache_path = cache_path
+    self._ttl = ttl
+    self._connection = None
+    self._pid = None
+    os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok=True)
+    self._get_connection().execute(
+      "CREATE TABLE IF NOT EXISTS tags ("
+      "artist TEXT, title TEXT, tags TEXT, error TEXT, timestamp REAL, "
+      "PRIMARY KEY (artist, title))")
+    self._get_connection().commit()
+
+  def __getstate__(self):
+    # SQLite connections cannot be pickled or shared between processes
+    return {"_cache_path": self._cache_path,
+            "_ttl": self._ttl,
+            "_connection": None,
+            "_pid": None}
+
+  def _get_connection(self) -> sqlite3.Connection:
+    if self._connection is None or self._pid != os.getpid():
+      # The timeout lets concurrent writers from the pool wait on each other
+      self._connection = sqlite3.connect(self._cache_path, timeout=60)
+      self._connection.execute("PRAGMA journal_mode=WAL")
+      self._pid = os.getpid()
+    return self._connection
+
+  def get(self,
+          artist: str,
+          title: str,
+          allow_expired: bool = False) -> Optional[CachedTags]:
+    """
+    Returns the cache entry for the given track.
+
+    :param artist: the artist name
+    :param title: the song title
+    :param allow_expired: returns the entry even if it is older than the ttl
+    :return: the cache entry, None if not cached or expired
+    """
+    with timed("tag_cache"):
+      row = self._get_connection().execute(
+        "SELECT tags, error, timestamp FROM tags "
+        "WHERE artist = ? AND title = ?",
+        (artist, title)).fetchone()
+    if not row:
+      return None
+    tags, error, timestamp = row
+    if (not allow_expired
+        and self._ttl is not None
+        and time.time() - timestamp > self._ttl):
+      return None
+    return CachedTags(json.loads(tags) if tags is not None else None, error)
+
+  def put(self,
+          artist: str,
+          title: str,
+          tags: Optional[List[str]] = None,
+          error: Optional[str] = None):
+    """
+    Stores the tags, or the error message, for the given track.
+
+    :param artist: the artist name
+    :param title: the song title
+    :param tags: the list of tags
+    :param error: the error message, if the API returned no tags
+    """
+    connection = self._get_connection()
+    connection.execute(
+      "INSERT OR REPLACE INTO tags VALUES (?, ?, ?, ?, ?)",
+      (artist,
+       title,
+       json.dumps(tags) if tags is not None else None,
+       error,
+       time.time()))
+    connection.commit()
+
+  def __len__(self) -> int:
+    return self._get_connection().execute(
+      "SELECT COUNT(*) FROM tags").fetchone()[0]
+
+
+def parse_tags(artist: str, title: str, response_json: dict) -> List[str]:
+  """
+  Returns the top tags (ordered most popular first) from the JSON response
+  of the "track.gettoptags" method.
+
+  :param artist: the artist name, for the error message
+  :param title: the song title, for the error message
+  :param response_json: the JSON response
+  :return: the list of tags, raises an exception if the response is an
+  error or has no tags
+  """
+  if "error" in response_json:
+    raise Exception(f"Error in request for '{artist}' - '{title}': "
+                    f"'{response_json['message']}'")
+  if "toptags" not in response_json:
+    raise Exception(f"Error in request for '{artist}' - '{title}': "
+                    f"no top tags")
+  tags = [tag["name"] for tag in response_json["toptags"]["tag"]]
+  tags = [tag.lower().strip() for tag in tags if tag]
+  return tags
+
+
+def _request_tags(artist: str,
+                  title: str,
+                  api_key: Optional[str],
+                  api_url: str,
+                  session=requests) -> dict:
+  with timed("http"):
+    response = session.get(api_url,
+                           params={"method": "track.gettoptags",
+                                   "artist": artist,
+                                   "track": title,
+                                   "api_key": api_key,
+                                   "format": "json"},
+                           timeout=10)
+  add_bytes_read(len(response.content))
+  return response.json()
+
+
+def _parse_and_cache_tags(artist: str,
+                          title: str,
+                          response_json: dict,
+                          tag_cache: Optional[TagCache]) -> List[str]:
+  try:
+    tags = parse_tags(artist, title, response_json)
+  except Exception as e:
+    # Only the permanent API errors are cached, the network errors
+    # are raised before
+    if (tag_cache is not None
+        and response_json.get("error") not in TRANSIENT_ERROR_CODES):
+      tag_cache.put(artist, title, error=str(e))
+    raise
+  if tag_cache is not None:
+    tag_cache.put(artist, title, tags=tags)
+  return tags
+
+
+@timed("tags")
+def get_tags(artist: str,
+             title: str,
+             api_key: Optional[str],
+             tag_cache: Optional[TagCache] = None,
+             cache_only: bool = False,
+             api_url: str = LAST_FM_API_URL) -> List[str]:
+  """
+  Returns the top tags (ordered most popular first) from the Last.fm API
+  using the title and the artist name of the song. If a tag cache is
+  provided, it is used before calling the API, and the API response is
+  stored in it, including the "no tags" errors.
+
+  :param artist: the artist name
+  :param title: the song title
+  :param api_key: the Last.fm API key
+  :param tag_cache: the optional tag cache
+  :param cache_only: never calls the API, only uses the tag cache
+  :param api_url: the Last.fm API root
+  :return: the list of tags
+  """
+  if tag_cache is not None:
+    cached_tags = tag_cache.get(artist, title, allow_expired=cache_only)
+    if cached_tags:
+      if cached_tags.error:
+        raise Exception(cached_tags.error)
+      return cached_tags.tags
+  if cache_only:
+    raise Exception(f"Not in tag cache '{artist}' - '{title}'")
+  response_json = _request_tags(artist, title, api_key, api_url)
+  return _parse_and_cache_tags(artist, title, response_json, tag_cache)
+
+
+class TokenBucket(object):
+  """
+  A thread safe token bucket rate limiter, each request takes a token and
+  the tokens are refilled at a fixed rate.
+  """
+
+  def __init__(self,
+               rate: float,
+               capacity: Optional[float] = None):
+    """
+    Constructs the bucket, initially full.
+
+    :param rate: the number of tokens added per second
+    :param capacity: the maximum number of tokens (the burst size),
+    defaults to the rate
+    """
+    self._rate = rate
+    self._capacity = capacity if capacity else max(1., rate)
+    self._tokens = self._capacity
+    self._timestamp = time.monotonic()
+    self._lock = threading.Lock()
+
+  def acquire(self):
+    """
+    Takes a token, blocking until one is available.
+    """
+    while True:
+      with self._lock:
+        now = time.monotonic()
+        self._tokens = min(self._capacity,
+                           self._tokens + (now - self._timestamp) * self._rate)
+        self._timestamp = now
+        if self._tokens >= 1:
+          self._tokens -= 1
+          return
+        wait_time = (1 - self._tokens) / self._rate
+      time.sleep(wait_time)
+
+
+class TagFetcher(object):
+  """
+  Fetches the tags of many tracks concurrently from a single process, using
+  a pool of threads sharing a single HTTP session (with persistent
+  connections) and a single token bucket rate limiter for the whole job.
+  """
+
+  def __init__(self,
+               api_key: str,
+               tag_cache: Optional[TagCache] = None,
+               concurrency: int = 100,
+               rate_limit: float = 5.,
+               api_url: str = LAST_FM_API_URL):
+    """
+    Constructs the fetcher.
+
+    :param api_key: the Last.fm API key
+    :param tag_cache: the optional tag cache, used before calling the API
+    and populated with the API responses
+    :param concurrency: the maximum number of requests in flight
+    :param rate_limit: the maximum number of requests per second
+    :param api_url: the Last.fm API root
+    """
+    self._api_key = api_key
+    self._tag_cache = tag_cache
+    self._concurrency = concurrency
+    self._rate_limiter = TokenBucket(rate_limit)
+    self._api_url = api_url
+    self._session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+    self._session.mount("http://", adapter)
+    self._session.mount("https://", adapter)
+
+  def _request(self, artist: str, title: str) -> dict:
+    self._rate_limiter.acquire()
+    return _request_tags(artist, title, self._api_key, self._api_url,
+                         self._session)
+
+  def fetch_many(self,
+                 tracks: Iterable[Tuple[str, str]]) -> Iterator[FetchedTags]:
+    """
+    Fetches the tags of the given tracks, the cached tracks are returned
+    without calling the API. The tag cache is only accessed from the calling
+    thread.
+
+    :param tracks: the (artist, title) tuples to fetch
+    :return: an iterator on the (artist, title, tags, error) tuples, not
+    necessarily in the tracks order, where either the tags or the error
+    is None
+    """
+    in_flight = deque()
+    with ThreadPoolExecutor(self._concurrency) as executor:
+      for artist, title in tracks:
+        if self._tag_cache is not None:
+          cached_tags = self._tag_cache.get(artist, title)
+          if cached_tags:
+            yield artist, title, cached_tags.tags, cached_tags.error
+            continue
+        future = executor.submit(self._request, artist, title)
+        in_flight.append((artist, title, future))
+        # Bounds the number of pending futures (and responses in memory)
+        while len(in_flight) >= 2 * self._concurrency:
+          yield self._result(*in_flight.popleft())
+      while in_flight:
+        yield self._result(*in_flight.popleft())
+
+  def _result(self, artist: str, title: str, future) -> FetchedTags:
+    try:
+      response_json = future.result()
+      tags = _parse_and_cache_tags(artist, title, response_json,
+                                   self._tag_cache)
+      return artist, title, tags, None
+    except Exception as e:
+      return artist, title, None, str(e)
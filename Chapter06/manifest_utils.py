@@ -0,0 +1,294 @@
+"""
+Run manifest utilities, to resume the extraction examples.
+
+The manifest is a SQLite file recording the outcome of every processed item
+(a MSD id or a MIDI path): the compact result and the output files, or the
+error message, along with a fingerprint of the input file. A resumed run
+skips the items whose input didn't change since they were processed.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from collections import Counter
+from typing import Callable
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+from typing import Tuple
+
+from multiprocessing_utils import deferred_soft_timeout
+
+# The number of keys per "IN" query, below the SQLite variable limit
+_QUERY_CHUNK_SIZE = 500
+
+# The (pending keys, results of the processed items) tuple for a new run
+PendingItems = Tuple[List[str], List[dict]]
+
+
+class ManifestEntry(NamedTuple):
+  """
+  A manifest entry, either the result and the output files, or the error
+  message if the item couldn't be processed.
+  """
+  fingerprint: Optional[str]
+  result: Optional[dict]
+  output_paths: List[str]
+  error: Optional[str]
+
+
+def get_fingerprint(path: str, hash_content: bool = False) -> str:
+  """
+  Returns a fingerprint of the given input file, changing when the file
+  is modified.
+
+  :param path: the path to the input file
+  :param hash_content: uses the MD5 of the content instead of the
+  modification time and the size, slower but independent of the file
+  system (the LMD files are already named by their MD5)
+  :return: the fingerprint
+  """
+  if hash_content:
+    with open(path, "rb") as file:
+      return hashlib.md5(file.read()).hexdigest()
+  stat = os.stat(path)
+  return f"{stat.st_mtime_ns}:{stat.st_size}"
+
+
+class Manifest(object):
+  """
+  A SQLite manifest of the processed items, keyed by MSD id or MIDI path.
+  The connection is opened lazily for each process, so the pool workers
+  can record their own items.
+  """
+
+  def __init__(self, manifest_path: str):
+    """
+    Constructs the manifest, creating the manifest file if necessary.
+
+    :param manifest_path: the path to the manifest file
+    """
+    self._manifest_path = manifest_path
+    self._connection = None
+    self._pid = None
+    os.makedirs(os.path.dirname(os.path.abspath(manifest_path)),
+                exist_ok=True)
+    connection = self._get_connection()
+    connection.execute(
+      "CREATE TABLE IF NOT EXISTS items ("
+      "key TEXT PRIMARY KEY, fingerprint TEXT, result TEXT, "
+      "output_paths TEXT, error TEXT, timestamp REAL)")
+    connection.execute(
+      "CREATE TABLE IF NOT EXISTS config (name TEXT PRIMARY KEY, value TEXT)")
+    connection.commit()
+
+  def __getstate__(self):
+    # SQLite connections cannot be pickled or shared between processes
+    return {"_manifest_path": self._manifest_path,
+            "_connection": None,
+            "_pid": None}
+
+  def _get_connection(self) -> sqlite3.Connection:
+    if self._connection is None or self._pid != os.getpid():
+      # The timeout lets concurrent writers from the pool wait on each other
+      self._connection = sqlite3.connect(self._manifest_path, timeout=60)
+      self._connection.execute("PRAGMA journal_mode=WAL")
+      self._connection.execute("PRAGMA synchronous=NORMAL")
+      self._pid = os.getpid()
+    return self._connection
+
+  def reset(self, config: Optional[Dict] = None):
+    """
+    Removes all the entries, for a new run with the given configuration.
+
+    :param config: the arguments changing the outputs of the run
+    """
+    connection = self._get_connection()
+    connection.execute("DELETE FROM items")
+    connection.execute("DELETE FROM config")
+    connection.execute("INSERT INTO config VALUES (?, ?)",
+                       ("config", json.dumps(config, sort_keys=True)))
+    connection.commit()
+
+  def check_config(self, config: Optional[Dict] = None):
+    """
+    Checks that the manifest was recorded with the given configuration, the
+    previous outputs cannot be reused otherwise.
+
+    :param config: the arguments changing the outputs of the run
+    """
+    recorded_config = self._get_config()
+    if (recorded_config is not None
+        and recorded_config != json.dumps(config, sort_keys=True)):
+      raise Exception(f"Manifest {self._manifest_path} was recorded with "
+                      f"a different configuration: {recorded_config}")
+
+  def _get_config(self) -> Optional[str]:
+    row = self._get_connection().execute(
+      "SELECT value FROM config WHERE name = 'config'").fetchone()
+    return row[0] if row else None
+
+  def merge(self, manifest_path: str):
+    """
+    Adds the entries of another manifest, for example recorded by another
+    shard of the same run, which must have the same configuration.
+
+    :param manifest_path: the path to the other manifest
+    """
+    config = self._get_config()
+    other_config = Manifest(manifest_path)._get_config()
+    if (config is not None and other_config is not None
+        and config != other_config):
+      raise Exception(f"Manifest {manifest_path} was recorded with a "
+                      f"different configuration: {other_config}")
+    connection = self._get_connection()
+    connection.execute("ATTACH DATABASE ? AS other", (manifest_path,))
+    try:
+      connection.execute(
+        "INSERT OR REPLACE INTO items SELECT * FROM other.items")
+      if config is None and other_config is not None:
+        connection.execute("INSERT INTO config VALUES (?, ?)",
+                           ("config", other_config))
+      connection.commit()
+    finally:
+      connection.execute("DETACH DATABASE other")
+
+  def get(self, key: str) -> Optional[ManifestEntry]:
+    """
+    Returns the manifest entry for the given key.
+
+    :param key: the MSD id or MIDI path
+    :return: the manifest entry, None if the item wasn't processed
+    """
+    return self.get_many([key]).get(key)
+
+  def get_many(self, keys: Iterable[str]) -> Dict[str, ManifestEntry]:
+    """
+    Returns the manifest entries for the given keys, the keys that weren't
+    processed are skipped.
+
+    :param keys: the MSD ids or MIDI paths
+    :return: the dictionary of manifest entries, keyed by key
+    """
+    keys = list(keys)
+    connection = self._get_connection()
+    entries = {}
+    for index in range(0, len(keys), _QUERY_CHUNK_SIZE):
+      chunk = keys[index:index + _QUERY_CHUNK_SIZE]
+      placeholders = ",".join("?" * len(chunk))
+      rows = connection.execute(
+        f"SELECT key, fingerprint, result, output_paths, error FROM items "
+        f"WHERE key IN ({placeholders})", chunk)
+      for key, fingerprint, result, output_paths, error in rows:
+        entries[key] = ManifestEntry(
+          fingerprint,
+          json.loads(result) if result is not None else None,
+          json.loads(output_paths),
+          error)
+    return entries
+
+  def put(self,
+          key: str,
+          fingerprint: Optional[str],
+          result: Optional[dict] = None,
+          output_paths: Optional[List[str]] = None,
+          error: Optional[str] = None):
+    """
+    Records the outcome of the given item, either the result and the output
+    files, or the error message. The output files should be written before.
+
+    :param key: the MSD id or MIDI path
+    :param fingerprint: the fingerprint of the input file, see
+    get_fingerprint, None if the input couldn't be found
+    :param result: the compact result, serializable to JSON
+    :param output_paths: the paths to the output files
+    :param error: the error message, if the item couldn't be processed
+    """
+    connection = self._get_connection()
+    with deferred_soft_timeout():
+      connection.execute(
+        "INSERT OR REPLACE INTO items VALUES (?, ?, ?, ?, ?, ?)",
+        (key,
+         fingerprint,
+         json.dumps(result) if result is not None else None,
+         json.dumps(output_paths or []),
+         error,
+         time.time()))
+      connection.commit()
+
+  def get_errors(self) -> Counter:
+    """
+    Returns the error messages of the failed items.
+
+    :return: the counter of error messages
+    """
+    rows = self._get_connection().execute(
+      "SELECT error FROM items WHERE error IS NOT NULL")
+    return Counter(error for error, in rows)
+
+  def __len__(self) -> int:
+    return self._get_connection().execute(
+      "SELECT COUNT(*) FROM items").fetchone()[0]
+
+
+def get_pending(manifest: Manifest,
+                keys: List[str],
+                get_input_fingerprint: Callable[[str], str],
+                retry_errors: bool = False) -> PendingItems:
+  """
+  Splits the given keys between the items that need processing (never
+  processed, input changed or output files missing) and the items that were
+  already processed, for which the recorded results are returned.
+
+  :param manifest: the manifest of the previous runs
+  :param keys: the MSD ids or MIDI paths to process
+  :param get_input_fingerprint: returns the fingerprint of the input file of
+  a key, see get_fingerprint
+  :param retry_errors: also processes the items that failed, for example
+  after a network error
+  :return: the keys to process and the results of the processed items (the
+  failed items have no results)
+  """
+  entries = manifest.get_many(keys)
+  pending_keys = []
+  results = []
+  for key in keys:
+    entry = entries.get(key)
+    if (entry is None
+        or entry.fingerprint is None
+        or (retry_errors and entry.error is not None)):
+      pending_keys.append(key)
+      continue
+    try:
+      fingerprint = get_input_fingerprint(key)
+    except Exception:
+      # The processing will report the missing input
+      pending_keys.append(key)
+      continue
+    if (fingerprint != entry.fingerprint
+        or not all(map(os.path.exists, entry.output_paths))):
+      pending_keys.append(key)
+    elif entry.result is not None:
+      results.append(entry.result)
+  return pending_keys, results
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--path_manifest", type=str, required=True)
+  args = parser.parse_args()
+
+  manifest = Manifest(args.path_manifest)
+  errors = manifest.get_errors()
+  print(f"Number of items: {len(manifest)}, "
+        f"number of errors: {sum(errors.values())}")
+  print(f"Most common errors: {errors.most_common(10)}")
+
+
+if __name__ == "__main__":
+  main()
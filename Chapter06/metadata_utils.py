@@ -0,0 +1,256 @@
+"""
+Million Song Dataset (MSD) metadata index utilities.
+
+The MSD metadata for each track of the Lakh MIDI Dataset (LMD) is stored in
+a separate h5 file, opening one file per track is slow on the full dataset.
+This module builds a single SQLite index, keyed by MSD id, containing the
+metadata columns of every song, which can be queried instead of the h5 files.
+"""
+
+import argparse
+import os
+import sqlite3
+import timeit
+from functools import partial
+from multiprocessing.pool import Pool
+from typing import Dict
+from typing import Iterable
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+import tables
+
+from lakh_utils import iter_msd_ids
+from lakh_utils import msd_id_to_h5
+from metrics_utils import timed
+from multiprocessing_utils import SharedCounter
+from multiprocessing_utils import imap_results
+
+# The columns of the "metadata.songs" table of the MSD h5 files
+METADATA_COLUMNS = [
+  "analyzer_version",
+  "artist_7digitalid",
+  "artist_familiarity",
+  "artist_hotttnesss",
+  "artist_id",
+  "artist_latitude",
+  "artist_location",
+  "artist_longitude",
+  "artist_mbid",
+  "artist_name",
+  "artist_playmeid",
+  "genre",
+  "idx_artist_terms",
+  "idx_similar_artists",
+  "release",
+  "release_7digitalid",
+  "song_hotttnesss",
+  "song_id",
+  "title",
+  "track_7digitalid",
+]
+
+# The number of MSD ids per "IN" query, below the SQLite variable limit
+_QUERY_CHUNK_SIZE = 500
+
+
+@timed("h5_read")
+def read_h5_metadata(msd_id: str, dataset_path: str) -> Dict:
+  """
+  Reads the metadata columns of the song from its h5 file.
+
+  :param msd_id: the MSD id
+  :param dataset_path: the dataset path
+  :return: the dictionary of metadata, keyed by column name
+  """
+  with tables.open_file(msd_id_to_h5(msd_id, dataset_path)) as h5:
+    songs = h5.root.metadata.songs
+    row = songs[0]
+    metadata = {}
+    for column in METADATA_COLUMNS:
+      if column not in songs.colnames:
+        continue
+      value = row[column]
+      if isinstance(value, bytes):
+        value = value.decode("utf-8")
+      elif hasattr(value, "item"):
+        value = value.item()
+      metadata[column] = value
+    return metadata
+
+
+class MetadataIndex(object):
+  """
+  A read only SQLite index of the MSD metadata, keyed by MSD id. The
+  connection is opened lazily for each process, so the index can be shared
+  with pool workers.
+  """
+
+  def __init__(self, index_path: str):
+    """
+    Constructs the index from an existing index file.
+
+    :param index_path: the path to the index file, use build_metadata_index
+    """
+    if not os.path.exists(index_path):
+      raise Exception(f"Metadata index not found {index_path}")
+    self._index_path = index_path
+    self._connection = None
+    self._pid = None
+
+  def __getstate__(self):
+    # SQLite connections cannot be pickled or shared between processes
+    return {"_index_path": self._index_path,
+            "_connection": None,
+            "_pid": None}
+
+  def _get_connection(self) -> sqlite3.Connection:
+    if self._connection is None or self._pid != os.getpid():
+      self._connection = sqlite3.connect(
+        f"file:{self._index_path}?mode=ro", uri=True)
+      self._connection.row_factory = sqlite3.Row
+      self._pid = os.getpid()
+    return self._connection
+
+  def get(self, msd_id: str) -> Optional[Dict]:
+    """
+    Returns the metadata for the given MSD id.
+
+    :param msd_id: the MSD id
+    :return: the dictionary of metadata, None if the MSD id is not indexed
+    """
+    with timed("metadata_index"):
+      row = self._get_connection().execute(
+        "SELECT * FROM songs WHERE msd_id = ?", (msd_id,)).fetchone()
+    return dict(row) if row else None
+
+  def get_many(self, msd_ids: Iterable[str]) -> Iterator[Dict]:
+    """
+    Returns the metadata for the given MSD ids, MSD ids that are not indexed
+    are skipped. The order of the results is not guaranteed.
+
+    :param msd_ids: the MSD ids
+    :return: an iterator on the dictionaries of metadata
+    """
+    msd_ids = list(msd_ids)
+    connection = self._get_connection()
+    for index in range(0, len(msd_ids), _QUERY_CHUNK_SIZE):
+      chunk = msd_ids[index:index + _QUERY_CHUNK_SIZE]
+      placeholders = ",".join("?" * len(chunk))
+      rows = connection.execute(
+        f"SELECT * FROM songs WHERE msd_id IN ({placeholders})", chunk)
+      for row in rows:
+        yield dict(row)
+
+  def __getitem__(self, msd_id: str) -> Dict:
+    metadata = self.get(msd_id)
+    if metadata is None:
+      raise Exception(f"Not indexed {msd_id}")
+    return metadata
+
+  def __contains__(self, msd_id: str) -> bool:
+    row = self._get_connection().execute(
+      "SELECT 1 FROM songs WHERE msd_id = ?", (msd_id,)).fetchone()
+    return row is not None
+
+  def __len__(self) -> int:
+    return self._get_connection().execute(
+      "SELECT COUNT(*) FROM songs").fetchone()[0]
+
+
+def get_song_metadata(msd_id: str,
+                      dataset_path: str,
+                      metadata_index: Optional[MetadataIndex] = None) -> Dict:
+  """
+  Returns the metadata for the given MSD id, from the metadata index if
+  provided, or from the h5 file otherwise.
+
+  :param msd_id: the MSD id
+  :param dataset_path: the dataset path
+  :param metadata_index: the optional metadata index
+  :return: the dictionary of metadata, raises an exception if the song
+  has no metadata
+  """
+  if metadata_index is not None:
+    return metadata_index[msd_id]
+  return read_h5_metadata(msd_id, dataset_path)
+
+
+def _read(msd_id: str, dataset_path: str) -> Optional[Tuple[str, Dict]]:
+  try:
+    return msd_id, read_h5_metadata(msd_id, dataset_path)
+  except Exception as e:
+    print(f"Exception during processing of {msd_id}: {e}")
+
+
+def build_metadata_index(msd_ids: List[str],
+                         dataset_path: str,
+                         index_path: str,
+                         pool_size: int = 4,
+                         chunksize: int = 64) -> int:
+  """
+  Builds the metadata index by reading the h5 file of every given MSD id
+  once. An existing index at the same path is replaced.
+
+  :param msd_ids: the MSD ids to index
+  :param dataset_path: the dataset path
+  :param index_path: the path to the index file to write
+  :param pool_size: the number of processes reading the h5 files
+  :param chunksize: the number of h5 files sent to a process at once
+  :return: the number of indexed songs
+  """
+  tmp_index_path = index_path + ".tmp"
+  if os.path.exists(tmp_index_path):
+    os.remove(tmp_index_path)
+  columns = ", ".join(["msd_id TEXT PRIMARY KEY"] + METADATA_COLUMNS)
+  placeholders = ", ".join("?" * (len(METADATA_COLUMNS) + 1))
+  count = 0
+  connection = sqlite3.connect(tmp_index_path)
+  try:
+    connection.execute(f"CREATE TABLE songs ({columns})")
+    counter = SharedCounter(len(msd_ids))
+    with Pool(pool_size) as pool:
+      results = imap_results(pool,
+                             partial(_read, dataset_path=dataset_path),
+                             msd_ids,
+                             counter,
+                             chunksize)
+      for msd_id, metadata in results:
+        connection.execute(
+          f"INSERT OR REPLACE INTO songs VALUES ({placeholders})",
+          [msd_id] + [metadata.get(column) for column in METADATA_COLUMNS])
+        count += 1
+    connection.execute("CREATE INDEX songs_artist_name ON songs (artist_name)")
+    connection.commit()
+  finally:
+    connection.close()
+  os.replace(tmp_index_path, index_path)
+  return count
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--pool_size", type=int, default=4)
+  parser.add_argument("--path_dataset_dir", type=str, required=True)
+  parser.add_argument("--path_match_scores_file", type=str, required=True)
+  parser.add_argument("--path_metadata_index", type=str, required=True)
+  args = parser.parse_args()
+
+  start = timeit.default_timer()
+  msd_ids = list(iter_msd_ids(args.path_match_scores_file))
+  print("START")
+  count = build_metadata_index(msd_ids,
+                               args.path_dataset_dir,
+                               args.path_metadata_index,
+                               args.pool_size)
+  print("END")
+  print(f"Number of tracks: {len(msd_ids)}, "
+        f"number of indexed tracks: {count}")
+  stop = timeit.default_timer()
+  print("Time: ", stop - start)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,308 @@
+"""
+Metrics utilities, to find which stages of the processing (reading the h5
+files, requesting the Last.fm API, parsing and writing the MIDI files, etc.)
+take the most time.
+
+Each process records the duration of the timed stages in a log scale
+histogram, the errors by stage and the bytes read and written. The metrics
+of each item processed in a pool worker are sent back with its result and
+aggregated in the main process (see imap_results), which saves the report
+as JSON or CSV at the end of the run, and optionally periodically during
+the run.
+"""
+
+import csv
+import json
+import math
+import os
+import time
+from collections import Counter
+from contextlib import contextmanager
+from typing import Callable
+from typing import Dict
+from typing import Iterator
+from typing import Optional
+from typing import Tuple
+
+# The upper bound of the first bucket of the histograms in seconds, the
+# upper bound of the bucket i is _HISTOGRAM_BASE * 2 ** i
+_HISTOGRAM_BASE = 1e-6
+
+# The percentiles of the stage durations in the report
+PERCENTILES = [50, 95, 99]
+
+
+class StageMetrics(object):
+  """
+  The durations of a stage, the histogram buckets are powers of 2, so the
+  percentiles are upper bounds within a factor of 2.
+  """
+
+  def __init__(self):
+    self.count = 0
+    self.total = 0.
+    self.min = math.inf
+    self.max = 0.
+    self.buckets = Counter()
+
+  def add(self, duration: float):
+    """
+    Adds a duration to the stage.
+
+    :param duration: the duration in seconds
+    """
+    self.count += 1
+    self.total += duration
+    self.min = min(self.min, duration)
+    self.max = max(self.max, duration)
+    self.buckets[max(math.frexp(duration / _HISTOGRAM_BASE)[1], 0)] += 1
+
+  def merge(self, other: "StageMetrics"):
+    """
+    Adds the durations of the other stage metrics to the stage.
+
+    :param other: the other stage metrics
+    """
+    self.count += other.count
+    self.total += other.total
+    self.min = min(self.min, other.min)
+    self.max = max(self.max, other.max)
+    self.buckets.update(other.buckets)
+
+  def get_percentile(self, percentile: float) -> float:
+    """
+    Returns the upper bound of the percentile of the durations.
+
+    :param percentile: the percentile, between 0 and 100
+    :return: the upper bound in seconds, at most the maximum duration
+    """
+    rank = math.ceil(self.count * percentile / 100)
+    count = 0
+    for bucket in sorted(self.buckets):
+      count += self.buckets[bucket]
+      if count >= rank:
+        return min(_HISTOGRAM_BASE * 2 ** bucket, self.max)
+    return self.max
+
+  def to_dict(self) -> Dict[str, float]:
+    """
+    :return: the count, the total, mean, min, percentiles and max durations
+    """
+    stage = {"count": self.count,
+             "total": self.total,
+             "mean": self.total / self.count if self.count else 0.,
+             "min": self.min if self.count else 0.}
+    for percentile in PERCENTILES:
+      stage[f"p{percentile}"] = self.get_percentile(percentile)
+    stage["max"] = self.max
+    return stage
+
+
+class Metrics(object):
+  """
+  The metrics of a process, or of an item processed in a pool worker.
+  """
+
+  def __init__(self,
+               report_path: Optional[str] = None,
+               snapshot_interval: Optional[float] = None):
+    """
+    Constructs the metrics.
+
+    :param report_path: the path of the report written by save, a CSV file
+    if the extension is ".csv", a JSON file otherwise
+    :param snapshot_interval: the minimum number of seconds between two
+    reports written by snapshot, no periodic report if not provided
+    """
+    self.report_path = report_path
+    self.snapshot_interval = snapshot_interval
+    self.stages = {}
+    self.errors = Counter()
+    self.bytes_read = 0
+    self.bytes_written = 0
+    self._start_time = time.time()
+    self._snapshot_time = self._start_time
+
+  def __getstate__(self):
+    # Only the measures are sent back from the pool workers
+    return {"stages": self.stages,
+            "errors": self.errors,
+            "bytes_read": self.bytes_read,
+            "bytes_written": self.bytes_written}
+
+  def __setstate__(self, state):
+    self.__init__()
+    self.__dict__.update(state)
+
+  def add_duration(self, stage: str, duration: float):
+    """
+    Adds the duration of a stage, see timed.
+
+    :param stage: the stage name
+    :param duration: the duration in seconds
+    """
+    if stage not in self.stages:
+      self.stages[stage] = StageMetrics()
+    self.stages[stage].add(duration)
+
+  def merge(self, other: "Metrics"):
+    """
+    Adds the measures of the other metrics, for example the metrics of an
+    item processed in a pool worker.
+
+    :param other: the other metrics
+    """
+    for stage, stage_metrics in other.stages.items():
+      if stage not in self.stages:
+        self.stages[stage] = StageMetrics()
+      self.stages[stage].merge(stage_metrics)
+    self.errors.update(other.errors)
+    self.bytes_read += other.bytes_read
+    self.bytes_written += other.bytes_written
+
+  def to_dict(self) -> Dict:
+    """
+    :return: the report, with the stages sorted by total duration
+    """
+    stages = sorted(self.stages.items(),
+                    key=lambda item: item[1].total,
+                    reverse=True)
+    return {"elapsed": time.time() - self._start_time,
+            "bytes_read": self.bytes_read,
+            "bytes_written": self.bytes_written,
+            "stages": {stage: stage_metrics.to_dict()
+                       for stage, stage_metrics in stages},
+            "errors": dict(self.errors.most_common())}
+
+  def save(self, report_path: Optional[str] = None):
+    """
+    Writes the report, the file is replaced atomically so a snapshot can be
+    read during the run.
+
+    :param report_path: the path of the report, the report path of the
+    metrics if not provided
+    """
+    report_path = report_path or self.report_path
+    if not report_path:
+      raise Exception("No path for the metrics report")
+    report = self.to_dict()
+    tmp_report_path = report_path + ".tmp"
+    with open(tmp_report_path, "w", newline="") as file:
+      if report_path.endswith(".csv"):
+        columns = (["type", "name", "count", "total", "mean", "min"]
+                   + [f"p{percentile}" for percentile in PERCENTILES]
+                   + ["max"])
+        writer = csv.DictWriter(file, columns)
+        writer.writeheader()
+        writer.writerow({"type": "elapsed", "total": report["elapsed"]})
+        writer.writerow({"type": "bytes", "name": "read",
+                         "count": report["bytes_read"]})
+        writer.writerow({"type": "bytes", "name": "written",
+                         "count": report["bytes_written"]})
+        for stage, stage_metrics in report["stages"].items():
+          writer.writerow(dict(stage_metrics, type="stage", name=stage))
+        for category, count in report["errors"].items():
+          writer.writerow({"type": "error", "name": category, "count": count})
+      else:
+        json.dump(report, file, indent=2)
+    os.replace(tmp_report_path, report_path)
+    self._snapshot_time = time.time()
+
+  def snapshot(self):
+    """
+    Writes the report if the snapshot interval is elapsed since the last
+    report, called for each result in the main process.
+    """
+    if (self.report_path
+        and self.snapshot_interval
+        and time.time() - self._snapshot_time >= self.snapshot_interval):
+      self.save()
+
+
+# The metrics of this process, or of the current item in a pool worker
+_METRICS = Metrics()
+
+
+def get_metrics() -> Metrics:
+  """
+  :return: the metrics of this process
+  """
+  return _METRICS
+
+
+def init_metrics(report_path: str,
+                 snapshot_interval: Optional[float] = None) -> Metrics:
+  """
+  Replaces the metrics of this process, call in the main process before
+  the processing.
+
+  :param report_path: the path of the report, see Metrics
+  :param snapshot_interval: the minimum number of seconds between two
+  periodic reports, see Metrics
+  :return: the new metrics of this process
+  """
+  global _METRICS
+  _METRICS = Metrics(report_path, snapshot_interval)
+  return _METRICS
+
+
+@contextmanager
+def timed(stage: str) -> Iterator[None]:
+  """
+  Records the duration of the code in the with block (or of the decorated
+  function) in the given stage. An exception raised in the block is counted
+  in the errors of the innermost stage.
+
+  :param stage: the stage name
+  """
+  start = time.perf_counter()
+  try:
+    yield
+  except Exception as e:
+    if not hasattr(e, "_metrics_stage"):
+      e._metrics_stage = stage
+      _METRICS.errors[f"{stage} ({type(e).__name__})"] += 1
+    raise
+  finally:
+    _METRICS.add_duration(stage, time.perf_counter() - start)
+
+
+def add_bytes_read(count: int):
+  """
+  :param count: the number of bytes read by this process
+  """
+  _METRICS.bytes_read += count
+
+
+def add_bytes_written(count: int):
+  """
+  :param count: the number of bytes written by this process
+  """
+  _METRICS.bytes_written += count
+
+
+class MeasuredProcess(object):
+  """
+  A process function returning the metrics of each item with its result,
+  see imap_results.
+  """
+
+  def __init__(self, process: Callable):
+    """
+    Constructs the measured process.
+
+    :param process: the function to call for each element, must be
+    picklable
+    """
+    self.process = process
+
+  def __call__(self, element) -> Tuple[object, Metrics]:
+    global _METRICS
+    metrics = _METRICS
+    _METRICS = Metrics()
+    try:
+      with timed("item"):
+        result = self.process(element)
+      return result, _METRICS
+    finally:
+      _METRICS = metrics
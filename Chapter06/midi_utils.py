@@ -0,0 +1,326 @@
+"""
+MIDI extraction and analysis utilities.
+"""
+
+import copy
+import io
+from typing import List
+from typing import Sequence
+from typing import Union
+
+import numpy as np
+from pretty_midi import Instrument
+from pretty_midi import PrettyMIDI
+
+from metrics_utils import add_bytes_read
+from metrics_utils import add_bytes_written
+from metrics_utils import timed
+from multiprocessing_utils import deferred_soft_timeout
+from rejection_utils import Rejected
+from rejection_utils import Rejection
+
+# The bass drum pitches (acoustic and electric)
+BASS_DRUM_PITCHES = [35, 36]
+
+# The piano programs (acoustic, electric, harpsichord, clavinet, etc.)
+PIANO_PROGRAMS = list(range(0, 8))
+
+
+def read_midi(midi_path: str) -> PrettyMIDI:
+  """
+  Reads and parses the given MIDI file, the reading and the parsing are
+  recorded separately in the metrics, see metrics_utils.
+
+  :param midi_path: the path to the MIDI file
+  :return: the PrettyMIDI instance
+  """
+  with timed("midi_read"):
+    with open(midi_path, "rb") as midi_file:
+      content = midi_file.read()
+  add_bytes_read(len(content))
+  with timed("midi_parse"):
+    return PrettyMIDI(io.BytesIO(content))
+
+
+def write_midi(pm: PrettyMIDI, output_path: str):
+  """
+  Encodes and writes the given PrettyMIDI instance, the encoding and the
+  writing are recorded separately in the metrics, see metrics_utils.
+
+  :param pm: the PrettyMIDI instance
+  :param output_path: the path to the MIDI file to write
+  """
+  with timed("midi_encode"):
+    midi_file = io.BytesIO()
+    pm.write(midi_file)
+  with timed("midi_write"), deferred_soft_timeout():
+    with open(output_path, "wb") as output_file:
+      output_file.write(midi_file.getvalue())
+  add_bytes_written(len(midi_file.getvalue()))
+
+
+def copy_with_instruments(pm: PrettyMIDI,
+                          instruments: List[Instrument]) -> PrettyMIDI:
+  """
+  Returns a new PrettyMIDI instance containing only the given instruments.
+  The timing data (tempo changes, time and key signatures, lyrics, etc.) is
+  shared with the original instance instead of copied, so the original
+  instance shouldn't be modified afterwards.
+
+  :param pm: the original PrettyMIDI instance
+  :param instruments: the instruments of the new instance
+  :return: the new PrettyMIDI instance
+  """
+  pm_copy = copy.copy(pm)
+  pm_copy.instruments = instruments
+  return pm_copy
+
+
+def is_drum_instrument(instrument) -> bool:
+  """
+  :param instrument: the PrettyMIDI instrument, or the scanned instrument
+  (see smf_utils.scan_midi)
+  :return: True if the instrument is a drum instrument
+  """
+  return instrument.is_drum
+
+
+def is_piano_instrument(instrument) -> bool:
+  """
+  :param instrument: the PrettyMIDI instrument, or the scanned instrument
+  (see smf_utils.scan_midi)
+  :return: True if the instrument is a piano instrument
+  """
+  return instrument.program in PIANO_PROGRAMS and not instrument.is_drum
+
+
+@timed("drums")
+def get_drums_or_rejection(pm: PrettyMIDI) -> Union[PrettyMIDI, Rejected]:
+  """
+  Returns a PrettyMIDI instance of all the merged drum tracks of the given
+  PrettyMIDI instance, without copying the rest of the instance.
+
+  :param pm: the PrettyMIDI instance
+  :return: the PrettyMIDI instance of the merged drum tracks, or the
+  rejection if there are no drums
+  """
+  instruments = [instrument for instrument in pm.instruments
+                 if is_drum_instrument(instrument)]
+  if len(instruments) > 1:
+    # Some drum tracks are split, we can merge them
+    drums = Instrument(program=0, is_drum=True)
+    for instrument in instruments:
+      drums.notes.extend(instrument.notes)
+    instruments = [drums]
+  if len(instruments) != 1:
+    return Rejected(Rejection.NO_DRUMS, len(instruments))
+  return copy_with_instruments(pm, instruments)
+
+
+def get_drums(pm: PrettyMIDI) -> PrettyMIDI:
+  """
+  Returns a PrettyMIDI instance of all the merged drum tracks of the given
+  PrettyMIDI instance, see get_drums_or_rejection.
+
+  :param pm: the PrettyMIDI instance
+  :return: the PrettyMIDI instance of the merged drum tracks, raises an
+  exception if there are no drums
+  """
+  pm_drums = get_drums_or_rejection(pm)
+  if isinstance(pm_drums, Rejected):
+    raise Exception(pm_drums.message)
+  return pm_drums
+
+
+@timed("pianos")
+def get_pianos_or_rejection(
+    pm: PrettyMIDI,
+    max_length: float = 1000) -> Union[List[PrettyMIDI], Rejected]:
+  """
+  Returns a list of PrettyMIDI instances of all the separate piano tracks
+  of the given PrettyMIDI instance, without copying the rest of the instance.
+
+  :param pm: the PrettyMIDI instance
+  :param max_length: the maximum length of a piano track in seconds
+  :return: the list of PrettyMIDI instances of the separate piano tracks,
+  or the rejection if there are no pianos or if a piano is too long
+  """
+  instruments = [instrument for instrument in pm.instruments
+                 if is_piano_instrument(instrument)]
+  if len(instruments) != 1:
+    # Each piano track is put in a new instrument (and a new MIDI file)
+    pianos = []
+    for instrument in instruments:
+      piano = Instrument(program=instrument.program)
+      piano.notes.extend(instrument.notes)
+      pianos.append(piano)
+    instruments = pianos
+  if not instruments:
+    return Rejected(Rejection.NO_PIANOS, len(instruments))
+  pm_pianos = [copy_with_instruments(pm, [instrument])
+               for instrument in instruments]
+  for pm_piano in pm_pianos:
+    if pm_piano.get_end_time() > max_length:
+      return Rejected(Rejection.PIANO_TOO_LONG, pm_piano.get_end_time())
+  return pm_pianos
+
+
+def get_pianos(pm: PrettyMIDI,
+               max_length: float = 1000) -> List[PrettyMIDI]:
+  """
+  Returns a list of PrettyMIDI instances of all the separate piano tracks
+  of the given PrettyMIDI instance, see get_pianos_or_rejection.
+
+  :param pm: the PrettyMIDI instance
+  :param max_length: the maximum length of a piano track in seconds
+  :return: the list of PrettyMIDI instances of the separate piano tracks,
+  raises an exception if there are no pianos or if a piano is too long
+  """
+  pm_pianos = get_pianos_or_rejection(pm, max_length)
+  if isinstance(pm_pianos, Rejected):
+    raise Exception(pm_pianos.message)
+  return pm_pianos
+
+
+def get_bass_drums(pm_drums: PrettyMIDI) -> np.ndarray:
+  """
+  Returns the sorted start times of the bass drums of the first instrument.
+
+  :param pm_drums: the PrettyMIDI instance of the drums
+  :return: the sorted array of bass drum start times
+  """
+  bass_drums = np.array([note.start for note in pm_drums.instruments[0].notes
+                         if note.pitch in BASS_DRUM_PITCHES], dtype=np.float64)
+  bass_drums.sort()
+  return bass_drums
+
+
+def _is_close(a: np.ndarray,
+              b: np.ndarray,
+              rel_tol: float,
+              abs_tol: float) -> np.ndarray:
+  # Same definition as math.isclose, element-wise
+  tolerance = np.maximum(rel_tol * np.maximum(np.abs(a), np.abs(b)), abs_tol)
+  return np.abs(a - b) <= tolerance
+
+
+def get_bass_drums_on_beat_ratio(beats: np.ndarray,
+                                 bass_drums: np.ndarray,
+                                 rel_tol: float = 1e-09,
+                                 abs_tol: float = 0.0) -> float:
+  """
+  Returns the ratio of the beats that have a bass drum on them, a bass drum
+  is on a beat if their times are close (see math.isclose) given the
+  tolerances. Only the nearest bass drum on each side of a beat is compared,
+  found by binary search, so the cost is O(beats * log(bass drums)).
+
+  :param beats: the beat times
+  :param bass_drums: the sorted bass drum start times
+  :param rel_tol: the relative tolerance, the default is the one of
+  math.isclose
+  :param abs_tol: the absolute tolerance in seconds, the default is the one
+  of math.isclose
+  :return: the ratio of the bass drums that fall on a beat
+  """
+  if not len(bass_drums):
+    return 0 / len(beats)
+  indexes = np.searchsorted(bass_drums, beats)
+  previous_indexes = np.clip(indexes - 1, 0, len(bass_drums) - 1)
+  next_indexes = np.clip(indexes, 0, len(bass_drums) - 1)
+  on_beat = (_is_close(beats, bass_drums[previous_indexes], rel_tol, abs_tol)
+             | _is_close(beats, bass_drums[next_indexes], rel_tol, abs_tol))
+  return int(np.count_nonzero(on_beat)) / len(beats)
+
+
+def get_bass_drums_on_beat(pm_drums: PrettyMIDI,
+                           rel_tol: float = 1e-09,
+                           abs_tol: float = 0.0) -> float:
+  """
+  Returns the ratio of the bass drums that fall directly on a beat.
+
+  :param pm_drums: the PrettyMIDI instance to analyse
+  :param rel_tol: the relative tolerance, see get_bass_drums_on_beat_ratio
+  :param abs_tol: the absolute tolerance, see get_bass_drums_on_beat_ratio
+  :return: the ratio of the bass drums that fall on a beat
+  """
+  return get_bass_drums_on_beat_ratio(pm_drums.get_beats(),
+                                      get_bass_drums(pm_drums),
+                                      rel_tol,
+                                      abs_tol)
+
+
+def get_bass_drums_on_beat_ratios(beats_list: Sequence[np.ndarray],
+                                  bass_drums_list: Sequence[np.ndarray],
+                                  rel_tol: float = 1e-09,
+                                  abs_tol: float = 0.0) -> np.ndarray:
+  """
+  Returns the ratio of the beats that have a bass drum on them for many
+  files at once, see get_bass_drums_on_beat_ratio. The beats and bass
+  drums of all the files are merged in a single sort, then the nearest bass
+  drum on each side of every beat is found without any Python loop.
+
+  :param beats_list: the beat times, for each file
+  :param bass_drums_list: the bass drum start times, for each file
+  :param rel_tol: the relative tolerance
+  :param abs_tol: the absolute tolerance in seconds
+  :return: the array of ratios, NaN for the files without beats
+  """
+  # The counts are integers even for an empty batch, for np.repeat
+  beats_counts = np.array([len(beats) for beats in beats_list],
+                          dtype=np.int64)
+  bass_drums_counts = np.array([len(bass_drums)
+                                for bass_drums in bass_drums_list],
+                               dtype=np.int64)
+  num_files = len(beats_list)
+  times = np.concatenate([np.concatenate(beats_list or [[]]),
+                          np.concatenate(bass_drums_list or [[]])])
+  files = np.concatenate([np.repeat(np.arange(num_files), beats_counts),
+                          np.repeat(np.arange(num_files), bass_drums_counts)])
+  is_beat = np.concatenate([np.ones(beats_counts.sum(), dtype=bool),
+                            np.zeros(bass_drums_counts.sum(), dtype=bool)])
+
+  # Sorts by file, then by time
+  order = np.lexsort((times, files))
+  times, files, is_beat = times[order], files[order], is_beat[order]
+
+  # For each position, the index of the nearest bass drum before (or at)
+  # and after (or at) it, -1 or len(times) if there is none
+  positions = np.arange(len(times))
+  previous_indexes = np.maximum.accumulate(np.where(is_beat, -1, positions))
+  next_indexes = np.minimum.accumulate(
+    np.where(is_beat, len(times), positions)[::-1])[::-1]
+
+  beat_positions = positions[is_beat]
+  beat_times = times[beat_positions]
+  beat_files = files[beat_positions]
+  on_beat = np.zeros(len(beat_positions), dtype=bool)
+  for indexes in (previous_indexes[beat_positions],
+                  next_indexes[beat_positions]):
+    valid = (indexes >= 0) & (indexes < len(times))
+    indexes = np.clip(indexes, 0, max(len(times) - 1, 0))
+    valid &= files[indexes] == beat_files
+    on_beat |= valid & _is_close(beat_times, times[indexes], rel_tol, abs_tol)
+
+  on_beat_counts = np.bincount(beat_files, weights=on_beat,
+                               minlength=num_files)
+  with np.errstate(invalid="ignore", divide="ignore"):
+    return on_beat_counts / beats_counts
+
+
+def get_bass_drums_on_beat_batch(pm_drums_list: List[PrettyMIDI],
+                                 rel_tol: float = 1e-09,
+                                 abs_tol: float = 0.0) -> np.ndarray:
+  """
+  Returns the ratio of the bass drums that fall directly on a beat for
+  many PrettyMIDI instances at once, see get_bass_drums_on_beat_ratios.
+
+  :param pm_drums_list: the PrettyMIDI instances to analyse
+  :param rel_tol: the relative tolerance
+  :param abs_tol: the absolute tolerance in seconds
+  :return: the array of ratios, NaN for the instances without beats
+  """
+  return get_bass_drums_on_beat_ratios(
+    [pm_drums.get_beats() for pm_drums in pm_drums_list],
+    [get_bass_drums(pm_drums) for pm_drums in pm_drums_list],
+    rel_tol,
+    abs_tol)
@@ -3,34 +3,61 @@ Threading (multiprocessing) utilities.
 """
 
 import math
+import multiprocessing
+import os
+import queue
+import signal
+import sys
 import time
-from itertools import cycle
+import uuid
 from multiprocessing import Manager
+from multiprocessing.context import get_spawning_popen
 from multiprocessing.pool import Pool
+from multiprocessing.reduction import ForkingPickler
+from collections import Counter
+from collections import deque
+from contextlib import contextmanager
+from itertools import chain
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import Iterable
+from typing import Iterator
+from typing import List
+from typing import NamedTuple
 from typing import Optional
+from typing import Tuple
 
+from metrics_utils import MeasuredProcess
+from metrics_utils import Metrics
+from quarantine_utils import Quarantine
+from quarantine_utils import is_quarantined
+from rejection_utils import Rejected
+from rejection_utils import Rejection
+from rejection_utils import count_rejection
 
-class AtomicCounter(object):
+# The shared counters known by this process, by id, see SharedCounter
+_SHARED_COUNTERS = {}
+
+# The worker limits known by this process, by id, see WorkerLimits
+_WORKER_LIMITS = {}
+
+# The states of the slots of the worker limits, see WorkerLimits
+_SLOT_QUEUED = 0
+_SLOT_RUNNING = 1
+_SLOT_DONE = 2
+_SLOT_RECYCLED = 3
+
+
+class _ProgressCounter(object):
   """
-  A thread safe (atomic) counter with automatic printing
-  of global progression.
+  The base class of the counters with automatic printing of global
+  progression, the subclasses provide the "_lock" and "_value" attributes.
   """
 
   def __init__(self,
-               manager: Manager,
                total_count: int,
                print_step: Optional[int] = None):
-    """
-    Constructs the counter with the given arguments
-
-    :param manager: the manager has to be instanciated outside for shared
-    resources
-    :param total_count: the total number of elements to process
-    :param print_step: the number of step between each print, initialized
-    to sensible default if not provided
-    """
-    self._lock = manager.Lock()
-    self._value = manager.Value('i', 0)
     self._total_count = total_count
     self._start_time = time.time()
     if print_step:
@@ -77,26 +104,622 @@ class AtomicCounter(object):
       return self._value.value
 
 
-def _process(x: int, counter: AtomicCounter):
+class AtomicCounter(_ProgressCounter):
+  """
+  A thread safe (atomic) counter with automatic printing
+  of global progression.
+  """
+
+  def __init__(self,
+               manager: Manager,
+               total_count: int,
+               print_step: Optional[int] = None):
+    """
+    Constructs the counter with the given arguments
+
+    :param manager: the manager has to be instanciated outside for shared
+    resources
+    :param total_count: the total number of elements to process
+    :param print_step: the number of step between each print, initialized
+    to sensible default if not provided
+    """
+    super().__init__(total_count, print_step)
+    self._lock = manager.Lock()
+    self._value = manager.Value('i', 0)
+
+
+class SharedCounter(_ProgressCounter):
+  """
+  A process safe (atomic) counter with automatic printing of global
+  progression, in shared memory. Unlike the AtomicCounter, it doesn't need
+  a manager process, an increment is a lock and a memory write instead of
+  multiple round-trips to the manager process.
+
+  The counter has to be created before the pool and given to the pool
+  initializer, see init_shared_counters, it can then be passed as an argument
+  to the pool methods like the AtomicCounter.
+  """
+
+  def __init__(self,
+               total_count: int,
+               print_step: Optional[int] = None):
+    """
+    Constructs the counter with the given arguments
+
+    :param total_count: the total number of elements to process
+    :param print_step: the number of step between each print, initialized
+    to sensible default if not provided
+    """
+    super().__init__(total_count, print_step)
+    self._id = uuid.uuid4().hex
+    self._lock = multiprocessing.Lock()
+    self._value = multiprocessing.RawValue('i', 0)
+    _SHARED_COUNTERS[self._id] = self
+
+  def __getstate__(self):
+    if get_spawning_popen() is not None:
+      # Sent to a new process (pool initializer), the shared memory is sent
+      return self.__dict__
+    # Sent to an existing process (pool task), only the id is sent, the
+    # counter is found in the process' shared counters
+    return {"_id": self._id}
+
+  def __setstate__(self, state):
+    if "_value" not in state:
+      if state["_id"] not in _SHARED_COUNTERS:
+        raise Exception(f"Unknown shared counter {state['_id']}, use "
+                        f"init_shared_counters as the pool initializer")
+      state = _SHARED_COUNTERS[state["_id"]].__dict__
+    self.__dict__.update(state)
+    _SHARED_COUNTERS.setdefault(self._id, self)
+
+
+def init_shared_counters(*counters: SharedCounter):
+  """
+  Registers the shared counters in the pool worker process, use as
+  the pool initializer with the counters as the initializer arguments.
+
+  :param counters: the shared counters
+  """
+  for counter in counters:
+    _SHARED_COUNTERS[counter._id] = counter
+
+
+class WorkerTiming(NamedTuple):
+  """
+  The worker and the wall clock start and end times of an element, see
+  TimedProcess.
+  """
+  pid: int
+  start: float
+  end: float
+
+
+class TimedProcess(object):
+  """
+  A process function returning the worker timing of each element with its
+  result, see WorkerUtilization.
+  """
+
+  def __init__(self, process: Callable):
+    """
+    Constructs the timed process.
+
+    :param process: the function to call for each element, must be
+    picklable
+    """
+    self.process = process
+
+  def __call__(self, element) -> Tuple[object, WorkerTiming]:
+    start = time.time()
+    result = self.process(element)
+    return result, WorkerTiming(os.getpid(), start, time.time())
+
+
+class WorkerUtilization(object):
+  """
+  The utilization of each pool worker, from the timings of the elements
+  (see imap_results): the number of elements, the busy time and the idle
+  time at the end of the run, which shows the stragglers.
+  """
+
+  def __init__(self):
+    self.start = time.time()
+    self.counts = Counter()
+    self.busy_times = Counter()
+    self.end_times = {}
+
+  def add(self, timing: WorkerTiming):
+    """
+    Adds the timing of an element.
+
+    :param timing: the worker timing of the element
+    """
+    self.counts[timing.pid] += 1
+    self.busy_times[timing.pid] += timing.end - timing.start
+    self.end_times[timing.pid] = max(timing.end,
+                                     self.end_times.get(timing.pid, 0))
+
+  def to_dict(self) -> Dict[int, Dict[str, float]]:
+    """
+    :return: the count, busy time, utilization and idle time at the end of
+    the run of each worker, by pid
+    """
+    end = max(self.end_times.values(), default=self.start)
+    elapsed = end - self.start
+    return {pid: {"count": self.counts[pid],
+                  "busy": self.busy_times[pid],
+                  "utilization": (self.busy_times[pid] / elapsed
+                                  if elapsed else 0.),
+                  "idle_at_end": end - self.end_times[pid]}
+            for pid in sorted(self.counts)}
+
+  def print(self):
+    """
+    Prints the utilization of each worker and of the pool.
+    """
+    workers = self.to_dict()
+    for pid, worker in workers.items():
+      print(f"Worker {pid}: {worker['count']} elements, "
+            f"busy: {worker['busy']:.2f}s "
+            f"({worker['utilization'] * 100:.1f}%), "
+            f"idle at end: {worker['idle_at_end']:.2f}s")
+    if workers:
+      utilization = (sum(worker["utilization"] for worker in workers.values())
+                     / len(workers))
+      tail = max(worker["idle_at_end"] for worker in workers.values())
+      print(f"Pool utilization: {utilization * 100:.1f}%, "
+            f"tail (longest idle at end): {tail:.2f}s")
+
+
+def sort_largest_first(elements: List, get_path: Callable[[Any], str]) -> List:
+  """
+  Sorts the elements by decreasing size of their input file, so the largest
+  files are started first and the end of the run isn't spent waiting for a
+  single worker processing a large file. Use with a small chunksize so the
+  workers take the next elements as they finish.
+
+  :param elements: the elements to process
+  :param get_path: the function returning the path to the input file of an
+  element, the elements without file are processed last
+  :return: the sorted elements
+  """
+
+  def get_size(element) -> int:
+    try:
+      return os.path.getsize(get_path(element))
+    except Exception:
+      return 0
+
+  return sorted(elements, key=get_size, reverse=True)
+
+
+class SoftTimeout(BaseException):
+  """
+  Raised in a pool worker when the processing of an element exceeds the soft
+  timeout, see WorkerLimits. It isn't an Exception, so it isn't caught by the
+  error handling of the process functions.
+  """
+  pass
+
+
+def _raise_soft_timeout(signum, frame):
+  raise SoftTimeout()
+
+
+@contextmanager
+def deferred_soft_timeout():
+  """
+  Blocks SIGALRM in the block, so a soft timeout (see WorkerLimits) can't
+  interrupt a write and leave a truncated output file, the soft timeout is
+  raised at the end of the block.
+  """
+  if not hasattr(signal, "pthread_sigmask"):
+    yield
+    return
+  mask = signal.pthread_sigmask(signal.SIG_BLOCK, [signal.SIGALRM])
+  try:
+    yield
+  finally:
+    signal.pthread_sigmask(signal.SIG_SETMASK, mask)
+
+
+def get_rss(pid: int) -> Optional[float]:
+  """
+  Returns the resident memory of the given process, from the "/proc"
+  filesystem (Linux only).
+
+  :param pid: the process id
+  :return: the resident memory in MB, or None if unknown
+  """
+  try:
+    with open(f"/proc/{pid}/statm") as file:
+      pages = int(file.read().split()[1])
+  except Exception:
+    return None
+  return pages * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+
+
+def _is_alive(pid: int) -> bool:
+  try:
+    os.kill(pid, 0)
+    return True
+  except ProcessLookupError:
+    return False
+
+
+class WorkerLimits(object):
+  """
+  The time and memory limits of the pool workers, so a single pathological
+  input (a corrupt or giant MIDI file) can't stall or crash the run:
+
+  - the soft timeout interrupts the processing of an element in the worker
+    (with SIGALRM, on Unix), the element is rejected and the worker goes on,
+    the writes are finished first, see deferred_soft_timeout
+  - the hard timeout kills the worker from the main process if the element
+    is stuck where it can't be interrupted, the pool replaces the worker
+  - the soft RSS limit recycles a worker between two elements (like the
+    maxtasksperchild of the pool), so the memory kept by the previous
+    elements is released, the next element is sent to another worker
+  - the hard RSS limit kills the worker from the main process if an element
+    makes its memory grow over the limit (Linux only)
+
+  The elements exceeding the limits (or whose worker exited during their
+  processing) are rejected and quarantined, see quarantine_utils. The
+  elements are sent one at a time with at most one element in flight by
+  worker, each in its own slot in shared memory, where the worker writes its
+  pid as soon as it receives the element, and its start time, for the main
+  process. An element that isn't received by a worker within the queue
+  timeout (its worker exited before recording its pid) is rejected.
+
+  The limits have to be created before the pool, like the SharedCounter, and
+  given to the pool initializer with the spawn start method, see
+  init_worker_limits.
+  """
+
+  def __init__(self,
+               pool_size: int,
+               soft_timeout: Optional[float] = None,
+               hard_timeout: Optional[float] = None,
+               soft_rss_limit: Optional[float] = None,
+               hard_rss_limit: Optional[float] = None,
+               poll_interval: float = 0.1,
+               queue_timeout: float = 60):
+    """
+    Constructs the limits with the given arguments, the limits are disabled
+    if None.
+
+    :param pool_size: the number of processes of the pool
+    :param soft_timeout: the soft timeout in seconds
+    :param hard_timeout: the hard timeout in seconds
+    :param soft_rss_limit: the resident memory of a worker in MB over which
+    it is recycled before its next element
+    :param hard_rss_limit: the resident memory of a worker in MB over which
+    it is killed
+    :param poll_interval: the interval in seconds between the checks of the
+    workers in the main process
+    :param queue_timeout: the time in seconds after which an element that
+    isn't received by a worker is rejected
+    """
+    if soft_timeout and not hasattr(signal, "setitimer"):
+      raise Exception("The soft timeout requires SIGALRM (Unix only)")
+    self.pool_size = pool_size
+    self.soft_timeout = soft_timeout
+    self.hard_timeout = hard_timeout
+    self.soft_rss_limit = soft_rss_limit
+    self.hard_rss_limit = hard_rss_limit
+    self.poll_interval = poll_interval
+    self.queue_timeout = queue_timeout
+    self._id = uuid.uuid4().hex
+    self._states = multiprocessing.RawArray('i', pool_size)
+    self._pids = multiprocessing.RawArray('i', pool_size)
+    self._starts = multiprocessing.RawArray('d', pool_size)
+    self._pid = None
+    self._processed_count = 0
+    _WORKER_LIMITS[self._id] = self
+
+  def __getstate__(self):
+    if get_spawning_popen() is not None:
+      # Sent to a new process (pool initializer), the shared memory is sent
+      return {**self.__dict__, "_pid": None, "_processed_count": 0}
+    # Sent to an existing process (pool task), only the id is sent, the
+    # limits are found in the process' worker limits
+    return {"_id": self._id}
+
+  def __setstate__(self, state):
+    if "_states" not in state:
+      if state["_id"] not in _WORKER_LIMITS:
+        raise Exception(f"Unknown worker limits {state['_id']}, use "
+                        f"init_worker_limits in the pool initializer")
+      # Shares the state of the limits known by the process, which counts
+      # the elements processed by the worker
+      self.__dict__ = _WORKER_LIMITS[state["_id"]].__dict__
+      return
+    self.__dict__.update(state)
+    _WORKER_LIMITS.setdefault(self._id, self)
+
+  def run(self, slot: int, process: Callable, element) -> object:
+    """
+    Processes the element in the pool worker within the limits.
+
+    :param slot: the slot of the element
+    :param process: the function to call for the element
+    :param element: the element to process
+    :return: the result, or the rejection if the element exceeds the soft
+    timeout
+    """
+    pid = os.getpid()
+    # Recorded first, so the main process notices if the worker exits before
+    # the processing of the element
+    self._pids[slot] = pid
+    if self._pid != pid:
+      # First element of the worker
+      self._pid = pid
+      self._processed_count = 0
+      if self.soft_timeout:
+        signal.signal(signal.SIGALRM, _raise_soft_timeout)
+    if (self.soft_rss_limit and self._processed_count
+        and (get_rss(pid) or 0) > self.soft_rss_limit):
+      # Recycles the worker, the main process sends the element again and
+      # the pool replaces the worker
+      self._states[slot] = _SLOT_RECYCLED
+      sys.stdout.flush()
+      os._exit(0)
+    self._starts[slot] = time.time()
+    self._states[slot] = _SLOT_RUNNING
+    self._processed_count += 1
+    try:
+      if self.soft_timeout:
+        signal.setitimer(signal.ITIMER_REAL, self.soft_timeout)
+      return process(element)
+    except SoftTimeout:
+      print(f"Exception during processing of {element}: soft timeout after "
+            f"{self.soft_timeout} sec")
+      return Rejected(Rejection.TIMEOUT, self.soft_timeout)
+    finally:
+      if self.soft_timeout:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+      self._states[slot] = _SLOT_DONE
+
+  def reset(self, slot: int):
+    """
+    Resets the slot before sending an element, in the main process.
+
+    :param slot: the slot
+    """
+    self._states[slot] = _SLOT_QUEUED
+    self._pids[slot] = 0
+    self._starts[slot] = time.time()
+
+  def is_recycled(self, slot: int) -> bool:
+    """
+    :param slot: the slot
+    :return: True if the worker exited without processing the element of the
+    slot, which must be sent again
+    """
+    return self._states[slot] == _SLOT_RECYCLED
+
+  def check(self, slot: int) -> Optional[Rejected]:
+    """
+    Checks the worker processing the element of the slot, in the main
+    process, the worker is killed if it exceeds the hard limits.
+
+    :param slot: the slot
+    :return: the rejection of the element if its worker exceeded the hard
+    limits or exited, or if no worker received it, None otherwise
+    """
+    state = self._states[slot]
+    if state in [_SLOT_DONE, _SLOT_RECYCLED]:
+      # The worker sent the result or exited on purpose
+      return None
+    pid = self._pids[slot]
+    if not pid:
+      if time.time() - self._starts[slot] > self.queue_timeout:
+        return Rejected(Rejection.WORKER_EXIT,
+                        f"not received after {self.queue_timeout} sec")
+      return None
+    if not _is_alive(pid):
+      return Rejected(Rejection.WORKER_EXIT, f"pid {pid}")
+    if state != _SLOT_RUNNING:
+      return None
+    if (self.hard_timeout
+        and time.time() - self._starts[slot] > self.hard_timeout):
+      rejected = Rejected(Rejection.TIMEOUT, self.hard_timeout)
+    elif (self.hard_rss_limit
+          and (get_rss(pid) or 0) > self.hard_rss_limit):
+      rejected = Rejected(Rejection.MEMORY_LIMIT, self.hard_rss_limit)
+    else:
+      return None
+    try:
+      os.kill(pid, signal.SIGKILL)
+    except ProcessLookupError:
+      pass
+    return rejected
+
+
+def init_worker_limits(limits: WorkerLimits):
+  """
+  Registers the worker limits in the pool worker process, call it in the
+  pool initializer with the spawn start method.
+
+  :param limits: the worker limits
+  """
+  _WORKER_LIMITS[limits._id] = limits
+
+
+class _LimitedProcess(object):
+  """
+  The process function of the elements sent with worker limits, the elements
+  are (slot, element) tuples, see WorkerLimits.
+  """
+
+  def __init__(self, process: Callable, limits: WorkerLimits):
+    self.process = process
+    self.limits = limits
+
+  def __call__(self, task: Tuple[int, Any]) -> object:
+    slot, element = task
+    return self.limits.run(slot, self.process, element)
+
+
+def _unwrap_result(result,
+                   metrics: Optional[Metrics],
+                   utilization: Optional[WorkerUtilization]) -> object:
+  """
+  Returns the result of the process function, adding the metrics and the
+  timing sent back with it, see imap_results.
+  """
+  if metrics is not None:
+    result, element_metrics = result
+    metrics.merge(element_metrics)
+    metrics.snapshot()
+  if utilization is not None:
+    result, timing = result
+    utilization.add(timing)
+  return result
+
+
+def _imap_limited(pool: Pool,
+                  process: Callable,
+                  elements: Iterable,
+                  limits: WorkerLimits,
+                  unwrap: Callable,
+                  quarantine: Optional[Quarantine]) -> Iterator:
+  """
+  Processes the elements in the pool within the worker limits, with at most
+  one element in flight by worker, and yields the results (or the
+  rejections of the elements exceeding the limits) in completion order.
+  """
+  pending_elements = deque(elements)
+  running = {}
+  free_slots = list(range(limits.pool_size))
+  # Wakes up this process when an element completes
+  completions = queue.Queue()
+  while pending_elements or running:
+    while pending_elements and free_slots:
+      slot = free_slots.pop()
+      element = pending_elements.popleft()
+      limits.reset(slot)
+      running[slot] = element, pool.apply_async(
+        process, ((slot, element),),
+        callback=completions.put, error_callback=completions.put)
+    try:
+      completions.get(timeout=limits.poll_interval)
+    except queue.Empty:
+      pass
+    for slot, (element, async_result) in list(running.items()):
+      if async_result.ready():
+        result = unwrap(async_result.get())
+      elif limits.is_recycled(slot):
+        pending_elements.appendleft(element)
+        result = None
+      else:
+        result = limits.check(slot)
+        if result is None:
+          continue
+        print(f"Exception during processing of {element}: {result.message}")
+      del running[slot]
+      free_slots.append(slot)
+      if (quarantine is not None and isinstance(result, Rejected)
+          and is_quarantined(result)):
+        quarantine.add(element, result)
+      if result is not None:
+        yield result
+
+
+def imap_results(pool: Pool,
+                 process: Callable,
+                 elements: Iterable,
+                 counter: _ProgressCounter,
+                 chunksize: int = 1,
+                 metrics: Optional[Metrics] = None,
+                 rejections: Optional[Counter] = None,
+                 utilization: Optional[WorkerUtilization] = None,
+                 limits: Optional[WorkerLimits] = None,
+                 quarantine: Optional[Quarantine] = None) -> Iterator:
+  """
+  Processes the elements in the pool and yields the results as they arrive,
+  in completion order, so the results can be consumed without waiting for
+  all the elements and without keeping all the results in memory. The
+  counter is incremented for each element in this process, the empty results
+  are skipped.
+
+  :param pool: the pool
+  :param process: the function to call for each element, must be picklable
+  :param elements: the elements to process
+  :param counter: the counter to increment
+  :param chunksize: the number of elements sent to a worker at once, bigger
+  chunks are faster for small processing times, ignored with limits
+  :param metrics: the optional metrics of the run, the metrics of each
+  element are sent back with its result and added to it, see metrics_utils
+  :param rejections: the optional counter of the rejected elements by
+  reason, see rejection_utils
+  :param utilization: the optional utilization of the workers, the timing
+  of each element is sent back with its result and added to it
+  :param limits: the optional time and memory limits of the workers, see
+  WorkerLimits
+  :param quarantine: the optional quarantine, the quarantined elements are
+  skipped and the elements exceeding the limits are quarantined
+  :return: an iterator on the non empty results
+  """
+  if limits is not None:
+    process = _LimitedProcess(process, limits)
+  if utilization is not None:
+    process = TimedProcess(process)
+  if metrics is not None:
+    process = MeasuredProcess(process)
+  skipped_results = []
+  if quarantine is not None:
+    elements, quarantined_elements = quarantine.split(elements)
+    skipped_results = [Rejected(Rejection.QUARANTINED,
+                                quarantine.get(element)["reason"])
+                       for element in quarantined_elements]
+  if limits is not None:
+    results = _imap_limited(
+      pool, process, elements, limits,
+      lambda result: _unwrap_result(result, metrics, utilization),
+      quarantine)
+  else:
+    results = (_unwrap_result(result, metrics, utilization)
+               for result in pool.imap_unordered(process, elements, chunksize))
+  for result in chain(skipped_results, results):
+    counter.increment()
+    if result:
+      yield result
+    elif rejections is not None:
+      count_rejection(rejections, result)
+
+
+def get_pickled_size(obj) -> int:
+  """
+  Returns the size of the object once pickled, which is the number of bytes
+  transferred between the processes when the object is sent to or returned
+  from a worker.
+
+  :param obj: the object to measure
+  :return: the size in bytes
+  """
+  return len(ForkingPickler.dumps(obj))
+
+
+def _process(x: int):
   try:
     # Process here, you can return None
     pass
   except Exception as e:
     print(f"Exception during processing of {x}: {e}")
-  finally:
-    counter.increment()
 
 
 def main():
   # Example usage
+  # Add elements to process here
+  elements = []
+  counter = SharedCounter(len(elements))
   with Pool(4) as pool:
-    # Add elements to process here
-    elements = []
-    manager = Manager()
-    counter = AtomicCounter(manager, len(elements))
     print("START")
-    results = pool.starmap(_process, zip(elements, cycle([counter])))
-    results = [result for result in results if result]
+    for result in imap_results(pool, _process, elements, counter):
+      # Consume the result here
+      pass
     print("END")
 
 
@@ -0,0 +1,422 @@
+"""
+Binary note cache utilities, to analyse the Lakh MIDI Dataset (LMD) without
+parsing the MIDI files.
+
+The cache builder parses each MIDI file once and stores its tracks, notes,
+beats and tempo changes as NumPy structured arrays in a single file, with an
+index keyed by MIDI MD5. The cache file is memory mapped, so reading the
+notes of a file doesn't copy or parse anything.
+"""
+
+import argparse
+import glob
+import os
+import shutil
+import timeit
+from multiprocessing.pool import Pool
+from typing import Dict
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+from typing import Tuple
+from typing import Union
+
+import numpy as np
+from pretty_midi import PrettyMIDI
+from pretty_midi import program_to_instrument_class
+
+from metrics_utils import timed
+from midi_utils import BASS_DRUM_PITCHES
+from midi_utils import get_bass_drums_on_beat_ratio
+from midi_utils import read_midi
+from multiprocessing_utils import SharedCounter
+from multiprocessing_utils import imap_results
+from rejection_utils import Rejected
+from rejection_utils import Rejection
+
+# The cache file format version, increment on incompatible changes
+CACHE_VERSION = 1
+
+# The note of a MIDI file, the notes of a track are contiguous
+NOTE_DTYPE = np.dtype([("start", "<f8"),
+                       ("end", "<f8"),
+                       ("pitch", "u1"),
+                       ("velocity", "u1"),
+                       ("program", "u1"),
+                       ("is_drum", "?"),
+                       ("track", "<u2")])
+
+# The track (PrettyMIDI instrument) of a MIDI file, the end time includes
+# the pitch bends and control changes
+TRACK_DTYPE = np.dtype([("program", "u1"),
+                        ("is_drum", "?"),
+                        ("end_time", "<f8")])
+
+# The tempo change of a MIDI file
+TEMPO_DTYPE = np.dtype([("time", "<f8"),
+                        ("qpm", "<f8")])
+
+# The index entry of a MIDI file, the offsets are in elements of each
+# section, the meta end time is the time of the last meta event or tempo
+# change (0 if none)
+INDEX_DTYPE = np.dtype([("md5", "S32"),
+                        ("tracks_offset", "<i8"),
+                        ("tracks_count", "<i8"),
+                        ("notes_offset", "<i8"),
+                        ("notes_count", "<i8"),
+                        ("beats_offset", "<i8"),
+                        ("beats_count", "<i8"),
+                        ("tempos_offset", "<i8"),
+                        ("tempos_count", "<i8"),
+                        ("meta_end_time", "<f8")])
+
+# The sections of the cache file, in order
+SECTIONS = {"index": INDEX_DTYPE,
+            "tracks": TRACK_DTYPE,
+            "notes": NOTE_DTYPE,
+            "beats": np.dtype("<f8"),
+            "tempos": TEMPO_DTYPE}
+
+# The header of the cache file, with the byte offset and the number of
+# elements of each section
+HEADER_DTYPE = np.dtype([("magic", "S8"),
+                         ("version", "<u4"),
+                         ("padding", "<u4"),
+                         ("offsets", "<u8", (len(SECTIONS),)),
+                         ("counts", "<u8", (len(SECTIONS),))])
+
+_MAGIC = b"LMDNOTES"
+
+# The sections start on a multiple of this size, for aligned reads
+_ALIGNMENT = 64
+
+
+class CachedMidi(NamedTuple):
+  """
+  The cached arrays of a MIDI file, read only views on the cache file.
+  """
+  tracks: np.ndarray
+  notes: np.ndarray
+  beats: np.ndarray
+  tempo_changes: np.ndarray
+  meta_end_time: float
+
+
+def get_midi_arrays(pm: PrettyMIDI) -> Tuple[np.ndarray, ...]:
+  """
+  Returns the arrays of the given PrettyMIDI instance, as stored in the
+  cache.
+
+  :param pm: the PrettyMIDI instance
+  :return: the tracks, notes, beats and tempo changes arrays, and the meta
+  end time
+  """
+  tracks = np.zeros(len(pm.instruments), dtype=TRACK_DTYPE)
+  notes = np.zeros(sum(len(instrument.notes) for instrument in pm.instruments),
+                   dtype=NOTE_DTYPE)
+  index = 0
+  for track, instrument in enumerate(pm.instruments):
+    tracks[track] = (instrument.program,
+                     instrument.is_drum,
+                     instrument.get_end_time())
+    count = len(instrument.notes)
+    track_notes = notes[index:index + count]
+    track_notes["start"] = [note.start for note in instrument.notes]
+    track_notes["end"] = [note.end for note in instrument.notes]
+    track_notes["pitch"] = [note.pitch for note in instrument.notes]
+    track_notes["velocity"] = [note.velocity for note in instrument.notes]
+    track_notes["program"] = instrument.program
+    track_notes["is_drum"] = instrument.is_drum
+    track_notes["track"] = track
+    index += count
+  tempo_change_times, tempi = pm.get_tempo_changes()
+  tempos = np.zeros(len(tempo_change_times), dtype=TEMPO_DTYPE)
+  tempos["time"] = tempo_change_times
+  tempos["qpm"] = tempi
+  meta_events = [pm.time_signature_changes, pm.key_signature_changes,
+                 pm.lyrics, pm.text_events]
+  meta_times = ([event.time for events in meta_events for event in events]
+                + tempo_change_times.tolist())
+  meta_end_time = max(meta_times) if meta_times else 0.
+  beats = np.asarray(pm.get_beats(), dtype=np.float64)
+  return tracks, notes, beats, tempos, meta_end_time
+
+
+def _parse(midi_path: str) -> Optional[tuple]:
+  try:
+    midi_md5 = os.path.splitext(os.path.basename(midi_path))[0]
+    return (midi_md5,) + get_midi_arrays(read_midi(midi_path))
+  except Exception as e:
+    print(f"Exception during processing of {midi_path}: {e}")
+
+
+def build_note_cache(midi_paths: List[str],
+                     cache_path: str,
+                     pool_size: int = 4,
+                     chunksize: int = 8) -> int:
+  """
+  Builds the note cache by parsing every given MIDI file once, the MIDI
+  files are keyed by their file name (the MD5 for the LMD). An existing
+  cache at the same path is replaced.
+
+  :param midi_paths: the MIDI paths to cache, the duplicate MD5 are parsed
+  once
+  :param cache_path: the path to the cache file to write
+  :param pool_size: the number of processes parsing the MIDI files
+  :param chunksize: the number of MIDI files sent to a process at once
+  :return: the number of cached MIDI files
+  """
+  unique_midi_paths = {}
+  for midi_path in midi_paths:
+    midi_md5 = os.path.splitext(os.path.basename(midi_path))[0]
+    unique_midi_paths.setdefault(midi_md5, midi_path)
+
+  # The sections are written to separate files, then concatenated
+  tmp_cache_path = cache_path + ".tmp"
+  section_paths = {name: f"{cache_path}.{name}.tmp" for name in SECTIONS}
+  section_files = {name: open(path, "wb")
+                   for name, path in section_paths.items() if name != "index"}
+  counts = {name: 0 for name in SECTIONS}
+  index = []
+  try:
+    counter = SharedCounter(len(unique_midi_paths))
+    with Pool(pool_size) as pool:
+      results = imap_results(pool,
+                             _parse,
+                             list(unique_midi_paths.values()),
+                             counter,
+                             chunksize)
+      for midi_md5, tracks, notes, beats, tempos, meta_end_time in results:
+        entry = [midi_md5.encode("ascii")]
+        for name, array in (("tracks", tracks),
+                            ("notes", notes),
+                            ("beats", beats),
+                            ("tempos", tempos)):
+          section_files[name].write(array.astype(SECTIONS[name]).tobytes())
+          entry += [counts[name], len(array)]
+          counts[name] += len(array)
+        index.append(tuple(entry + [meta_end_time]))
+    for section_file in section_files.values():
+      section_file.close()
+    counts["index"] = len(index)
+    with open(section_paths["index"], "wb") as index_file:
+      index_file.write(np.array(index, dtype=INDEX_DTYPE).tobytes())
+
+    header = np.zeros(1, dtype=HEADER_DTYPE)
+    header["magic"] = _MAGIC
+    header["version"] = CACHE_VERSION
+    with open(tmp_cache_path, "wb") as cache_file:
+      cache_file.write(header.tobytes())
+      for position, name in enumerate(SECTIONS):
+        cache_file.write(b"\0" * (-cache_file.tell() % _ALIGNMENT))
+        header["offsets"][0, position] = cache_file.tell()
+        header["counts"][0, position] = counts[name]
+        with open(section_paths[name], "rb") as section_file:
+          shutil.copyfileobj(section_file, cache_file)
+      cache_file.seek(0)
+      cache_file.write(header.tobytes())
+  finally:
+    for section_file in section_files.values():
+      section_file.close()
+    for section_path in section_paths.values():
+      if os.path.exists(section_path):
+        os.remove(section_path)
+  os.replace(tmp_cache_path, cache_path)
+  return len(index)
+
+
+class NoteCache(object):
+  """
+  A read only note cache, keyed by MIDI MD5. The cache file is memory mapped
+  lazily for each process, so the cache can be shared with pool workers.
+  """
+
+  def __init__(self, cache_path: str):
+    """
+    Constructs the cache from an existing cache file.
+
+    :param cache_path: the path to the cache file, use build_note_cache
+    """
+    if not os.path.exists(cache_path):
+      raise Exception(f"Note cache not found {cache_path}")
+    self._cache_path = cache_path
+    self._sections = None
+    self._md5_to_index = None
+    self._pid = None
+
+  def __getstate__(self):
+    # The memory maps would be copied when pickled, they are opened again
+    return {"_cache_path": self._cache_path,
+            "_sections": None,
+            "_md5_to_index": None,
+            "_pid": None}
+
+  def _get_sections(self) -> Dict[str, np.ndarray]:
+    if self._sections is None or self._pid != os.getpid():
+      header = np.fromfile(self._cache_path, dtype=HEADER_DTYPE, count=1)
+      if (not len(header)
+          or header["magic"][0] != _MAGIC
+          or header["version"][0] != CACHE_VERSION):
+        raise Exception(f"Invalid note cache {self._cache_path}")
+      self._sections = {}
+      for position, (name, dtype) in enumerate(SECTIONS.items()):
+        offset = int(header["offsets"][0, position])
+        count = int(header["counts"][0, position])
+        self._sections[name] = (np.memmap(self._cache_path,
+                                          dtype=dtype,
+                                          mode="r",
+                                          offset=offset,
+                                          shape=(count,))
+                                if count else np.zeros(0, dtype=dtype))
+      self._md5_to_index = {
+        midi_md5.decode("ascii"): position
+        for position, midi_md5 in enumerate(self._sections["index"]["md5"])}
+      self._pid = os.getpid()
+    return self._sections
+
+  @timed("note_cache")
+  def get(self, midi_md5: str) -> Optional[CachedMidi]:
+    """
+    Returns the cached arrays for the given MIDI MD5.
+
+    :param midi_md5: the MIDI MD5
+    :return: the cached arrays, None if the MIDI file is not cached
+    """
+    sections = self._get_sections()
+    position = self._md5_to_index.get(midi_md5)
+    if position is None:
+      return None
+    entry = sections["index"][position]
+
+    def view(name: str) -> np.ndarray:
+      offset = int(entry[f"{name}_offset"])
+      return sections[name][offset:offset + int(entry[f"{name}_count"])]
+
+    return CachedMidi(view("tracks"),
+                      view("notes"),
+                      view("beats"),
+                      view("tempos"),
+                      float(entry["meta_end_time"]))
+
+  def __getitem__(self, midi_md5: str) -> CachedMidi:
+    cached_midi = self.get(midi_md5)
+    if cached_midi is None:
+      raise Exception(f"Not cached {midi_md5}")
+    return cached_midi
+
+  def __contains__(self, midi_md5: str) -> bool:
+    self._get_sections()
+    return midi_md5 in self._md5_to_index
+
+  def __len__(self) -> int:
+    return len(self._get_sections()["index"])
+
+
+def get_cached_instrument_classes(
+    cached_midi: CachedMidi) -> Union[List[str], Rejected]:
+  """
+  Returns the list of instruments classes given by PrettyMIDI for the
+  cached MIDI file, see chapter_06_example_04.get_instrument_classes.
+
+  :param cached_midi: the cached arrays
+  :return: the list of instruments classes, or the rejection if there are
+  no instruments
+  """
+  tracks = cached_midi.tracks
+  classes = [program_to_instrument_class(int(program))
+             for program in tracks["program"][~tracks["is_drum"]]]
+  drums = ["Drums"] * int(np.count_nonzero(tracks["is_drum"]))
+  classes = classes + drums
+  if not classes:
+    return Rejected(Rejection.NO_PROGRAM_CLASSES, len(classes))
+  return classes
+
+
+def get_cached_drum_tracks_count(cached_midi: CachedMidi) -> int:
+  """
+  Returns the number of drum tracks of the cached MIDI file, to filter the
+  files without drums before get_cached_drums.
+
+  :param cached_midi: the cached arrays
+  :return: the number of drum tracks
+  """
+  return int(np.count_nonzero(cached_midi.tracks["is_drum"]))
+
+
+def get_cached_drums(cached_midi: CachedMidi) -> np.ndarray:
+  """
+  Returns the notes of all the merged drum tracks of the cached MIDI file,
+  see midi_utils.get_drums.
+
+  :param cached_midi: the cached arrays
+  :return: the notes of the drums, raises an exception if there are no drums
+  """
+  drum_tracks_count = get_cached_drum_tracks_count(cached_midi)
+  if drum_tracks_count == 0:
+    raise Exception(f"Invalid number of drums: {drum_tracks_count}")
+  return cached_midi.notes[cached_midi.notes["is_drum"]]
+
+
+def get_cached_drums_end_time(cached_midi: CachedMidi) -> float:
+  """
+  Returns the end time of the PrettyMIDI instance of the merged drum tracks
+  of the cached MIDI file, see midi_utils.get_drums.
+
+  :param cached_midi: the cached arrays
+  :return: the end time of the drums, in seconds
+  """
+  drums = get_cached_drums(cached_midi)
+  drum_tracks = cached_midi.tracks[cached_midi.tracks["is_drum"]]
+  if len(drum_tracks) == 1:
+    # The drum track is kept as is, with its pitch bends and control changes
+    drums_end_time = float(drum_tracks["end_time"][0])
+  else:
+    # The merged drum track only contains the notes
+    drums_end_time = float(drums["end"].max()) if len(drums) else 0.
+  return max(drums_end_time, cached_midi.meta_end_time)
+
+
+def get_cached_bass_drums_on_beat(cached_midi: CachedMidi,
+                                  rel_tol: float = 1e-09,
+                                  abs_tol: float = 0.0) -> float:
+  """
+  Returns the ratio of the bass drums that fall directly on a beat for the
+  cached MIDI file, identical to midi_utils.get_bass_drums_on_beat on the
+  extracted drums. The beats of the drums are the beats of the whole file
+  before the end of the drums.
+
+  :param cached_midi: the cached arrays
+  :param rel_tol: the relative tolerance, see get_bass_drums_on_beat_ratio
+  :param abs_tol: the absolute tolerance, see get_bass_drums_on_beat_ratio
+  :return: the ratio of the bass drums that fall on a beat
+  """
+  drums = get_cached_drums(cached_midi)
+  end_time = get_cached_drums_end_time(cached_midi)
+  beats = cached_midi.beats[cached_midi.beats < end_time]
+  bass_drums = np.sort(
+    drums["start"][np.isin(drums["pitch"], BASS_DRUM_PITCHES)])
+  return get_bass_drums_on_beat_ratio(beats, bass_drums, rel_tol, abs_tol)
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--pool_size", type=int, default=4)
+  parser.add_argument("--path_dataset_dir", type=str, required=True)
+  parser.add_argument("--path_note_cache", type=str, required=True)
+  args = parser.parse_args()
+
+  start = timeit.default_timer()
+  midi_paths = glob.glob(os.path.join(args.path_dataset_dir, "**", "*.mid"),
+                         recursive=True)
+  print("START")
+  count = build_note_cache(midi_paths, args.path_note_cache, args.pool_size)
+  print("END")
+  print(f"Number of MIDI files: {len(midi_paths)}, "
+        f"number of cached MIDI files: {count}, "
+        f"cache size: {os.path.getsize(args.path_note_cache)} bytes")
+  stop = timeit.default_timer()
+  print("Time: ", stop - start)
+
+
+if __name__ == "__main__":
+  main()
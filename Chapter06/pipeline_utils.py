@@ -0,0 +1,173 @@
+"""
+Pipeline utilities, to compute many values for each item in a single pass.
+
+A pipeline is a graph of stages, each stage computing one named value of the
+item (the metadata, the parsed MIDI file, the extracted drums, etc.) from the
+values of the other stages. Each stage is run at most once per item, so
+every input file is read and parsed once, whatever the number of stages
+using it.
+"""
+
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Optional
+
+from metrics_utils import timed
+from rejection_utils import Rejected
+
+
+class Stage(object):
+  """
+  A pipeline stage, calling its function with the values of its inputs.
+  The function can return a Rejected result to filter the item, in which
+  case the rejection reason is recorded and the stages depending on it are
+  skipped, or None to skip them silently, without recording a reason. It
+  can also raise an exception, in which case the error is recorded and the
+  stages depending on it are skipped. The duration of the stage is recorded
+  as "pipeline.<name>" in the metrics.
+  """
+
+  def __init__(self,
+               name: str,
+               function: Callable[..., Any],
+               inputs: Iterable[str] = (),
+               requires: Iterable[str] = ()):
+    """
+    Constructs the stage.
+
+    :param name: the name of the value computed by the stage
+    :param function: the function computing the value, called with the
+    values of the inputs as positional arguments, must be a module level
+    function to be sent to the pool workers
+    :param inputs: the names of the values passed to the function
+    :param requires: the names of the values that must be computed before,
+    without being passed to the function (for example a filter)
+    """
+    self.name = name
+    self.function = function
+    self.inputs = list(inputs)
+    self.requires = list(requires)
+
+  def __repr__(self):
+    return f"Stage({self.name}, inputs={self.inputs})"
+
+
+class Pipeline(object):
+  """
+  A graph of stages, run in dependency order for each item. Only the stages
+  needed to compute the outputs are run.
+  """
+
+  def __init__(self,
+               stages: List[Stage],
+               outputs: List[str],
+               inputs: Iterable[str] = ("key",)):
+    """
+    Constructs the pipeline, ordering the stages.
+
+    :param stages: the available stages
+    :param outputs: the names of the values returned for each item
+    :param inputs: the names of the values given for each item
+    """
+    self._inputs = list(inputs)
+    self._outputs = list(outputs)
+    self._stages = _sort_stages({stage.name: stage for stage in stages},
+                                self._outputs,
+                                self._inputs)
+
+  @property
+  def stages(self) -> List[Stage]:
+    """
+    :return: the stages run for each item, in order
+    """
+    return self._stages
+
+  def run(self, inputs: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Runs the stages for the given item.
+
+    :param inputs: the values given for the item, the first one identifies
+    the item in the error messages
+    :return: the dictionary containing the given values, the outputs that
+    could be computed, the "rejections" reasons of the filtering stages and
+    the "errors" of the failed stages, keyed by stage name
+    """
+    key = inputs[self._inputs[0]]
+    values = dict(inputs)
+    rejections = {}
+    errors = {}
+    for stage in self._stages:
+      if any(values.get(name) is None
+             for name in stage.inputs + stage.requires):
+        # Filtered or failed before
+        continue
+      try:
+        with timed(f"pipeline.{stage.name}"):
+          value = stage.function(*[values[name] for name in stage.inputs])
+        if isinstance(value, Rejected):
+          rejections[stage.name] = value.reason.value
+        else:
+          values[stage.name] = value
+      except Exception as e:
+        print(f"Exception during processing of {key} ({stage.name}): {e}")
+        errors[stage.name] = str(e)
+    result = {name: values[name] for name in self._inputs}
+    for name in self._outputs:
+      if values.get(name) is not None:
+        result[name] = values[name]
+    if rejections:
+      result["rejections"] = rejections
+    if errors:
+      result["errors"] = errors
+    return result
+
+
+def _sort_stages(stages: Dict[str, Stage],
+                 outputs: List[str],
+                 inputs: List[str]) -> List[Stage]:
+  # Depth first search from the outputs, so that the stages unused by the
+  # outputs are dropped, each stage coming after its dependencies
+  sorted_stages = []
+  visiting = set()
+  visited = set(inputs)
+
+  def visit(name: str, parent: Optional[str]):
+    if name in visited:
+      return
+    if name in visiting:
+      raise Exception(f"Cycle in pipeline at stage {name}")
+    if name not in stages:
+      raise Exception(f"Unknown stage {name}"
+                      + (f" required by {parent}" if parent else ""))
+    visiting.add(name)
+    stage = stages[name]
+    for dependency in stage.inputs + stage.requires:
+      visit(dependency, name)
+    visiting.remove(name)
+    visited.add(name)
+    sorted_stages.append(stage)
+
+  for output in outputs:
+    visit(output, None)
+  return sorted_stages
+
+
+def main():
+  # Example pipeline, squares and filters odd numbers, then formats them
+  pipeline = Pipeline([Stage("square", lambda x: x * x, ["key"]),
+                       Stage("even", lambda x: x if x % 2 == 0 else None,
+                             ["square"]),
+                       Stage("text", lambda x: f"even square {x}", ["key"],
+                             requires=["even"]),
+                       Stage("unused", lambda x: 1 / 0, ["key"])],
+                      outputs=["square", "text"])
+  print(f"Stages: {pipeline.stages}")
+  for key in range(5):
+    print(pipeline.run({"key": key}))
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,131 @@
+"""
+Quarantine utilities, to skip the inputs that exceeded the worker limits
+(see multiprocessing_utils.WorkerLimits) in a previous run.
+
+The quarantine is a JSON lines file, each line recording an input (a MSD id
+or a MIDI path) with the reason and the message of its rejection. The lines
+are appended and flushed as soon as an input is quarantined, so the file is
+complete even if the run is interrupted.
+"""
+
+import argparse
+import json
+import os
+import time
+from collections import Counter
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+from rejection_utils import Rejected
+from rejection_utils import Rejection
+
+# The rejections quarantining their input, the other rejections depend on the
+# content of the input and are found again at each run
+QUARANTINE_REASONS = [Rejection.TIMEOUT,
+                      Rejection.MEMORY_LIMIT,
+                      Rejection.WORKER_EXIT]
+
+
+class Quarantine(object):
+  """
+  The skip list of the inputs exceeding the worker limits, loaded from and
+  appended to a JSON lines file, used in the main process only.
+  """
+
+  def __init__(self, path: str):
+    """
+    Constructs the quarantine, loading the file if it exists.
+
+    :param path: the path to the JSON lines file
+    """
+    self._path = path
+    self._entries = {}
+    if os.path.exists(path):
+      with open(path) as file:
+        for line in file:
+          if line.strip():
+            entry = json.loads(line)
+            self._entries[entry["key"]] = entry
+
+  def __contains__(self, key: str) -> bool:
+    return key in self._entries
+
+  def __len__(self) -> int:
+    return len(self._entries)
+
+  def get(self, key: str) -> Optional[Dict]:
+    """
+    :param key: the MSD id or the MIDI path
+    :return: the entry of the key, with the reason and the message of the
+    rejection, or None if the key isn't quarantined
+    """
+    return self._entries.get(key)
+
+  def add(self, key: str, rejected: Rejected):
+    """
+    Quarantines the given key, the next runs will skip it.
+
+    :param key: the MSD id or the MIDI path
+    :param rejected: the rejection of the key, see QUARANTINE_REASONS
+    """
+    entry = {"key": key,
+             "reason": rejected.reason.value,
+             "message": rejected.message,
+             "time": time.time()}
+    self._entries[key] = entry
+    os.makedirs(os.path.dirname(os.path.abspath(self._path)), exist_ok=True)
+    with open(self._path, "a") as file:
+      file.write(json.dumps(entry) + "\n")
+
+  def split(self, keys: Iterable[str]) -> Tuple[List[str], List[str]]:
+    """
+    Splits the given keys into the keys to process and the quarantined keys.
+
+    :param keys: the MSD ids or the MIDI paths
+    :return: the (keys to process, quarantined keys) tuple, in the same order
+    """
+    kept_keys = []
+    quarantined_keys = []
+    for key in keys:
+      (quarantined_keys if key in self._entries else kept_keys).append(key)
+    return kept_keys, quarantined_keys
+
+  def get_entries(self) -> List[Dict]:
+    """
+    :return: the entries of the quarantined keys, in quarantine order
+    """
+    return sorted(self._entries.values(), key=lambda entry: entry["time"])
+
+  def get_reasons(self) -> Counter:
+    """
+    :return: the number of quarantined keys by reason
+    """
+    return Counter(entry["reason"] for entry in self._entries.values())
+
+
+def is_quarantined(rejected: Rejected) -> bool:
+  """
+  :param rejected: the rejection of an input
+  :return: True if the input of the rejection must be quarantined
+  """
+  return rejected.reason in QUARANTINE_REASONS
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--path_quarantine", type=str, required=True)
+  args = parser.parse_args()
+
+  quarantine = Quarantine(args.path_quarantine)
+  print(f"Number of quarantined items: {len(quarantine)}")
+  for reason, count in quarantine.get_reasons().most_common():
+    print(f"Number of quarantined items ({reason}): {count}")
+  for entry in quarantine.get_entries()[-10:]:
+    print(f"{entry['key']}: {entry['message']}")
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,91 @@
+"""
+Rejection utilities, to filter the items without raising exceptions.
+
+Most items of a screening run are dropped by a filter (no drums, not on
+beat, no matching tags, etc.), raising and formatting an exception for each
+of them is costly. The filters return a Rejected result instead, carrying
+the reason and the measured value, and the message is only formatted if it
+is printed or stored. The rejections are falsy, so they are skipped like
+the empty results by imap_results, which counts them by reason.
+"""
+
+from collections import Counter
+from enum import Enum
+from typing import Any
+from typing import NamedTuple
+
+
+class Rejection(Enum):
+  """
+  The reasons for dropping an item, the value is the key in the counters.
+  """
+  ERROR = "error"
+  NO_DRUMS = "no_drums"
+  NOT_ON_BEAT = "not_on_beat"
+  NO_PIANOS = "no_pianos"
+  PIANO_TOO_LONG = "piano_too_long"
+  NO_PROGRAM_CLASSES = "no_program_classes"
+  NO_MATCHING_TAGS = "no_matching_tags"
+  TIMEOUT = "timeout"
+  MEMORY_LIMIT = "memory_limit"
+  WORKER_EXIT = "worker_exit"
+  QUARANTINED = "quarantined"
+
+
+# The messages of the rejections, formatted with the value
+_MESSAGES = {
+  Rejection.ERROR: "{}",
+  Rejection.NO_DRUMS: "Invalid number of drums: {}",
+  Rejection.NOT_ON_BEAT: "Not on beat: {}",
+  Rejection.NO_PIANOS: "Invalid number of piano: {}",
+  Rejection.PIANO_TOO_LONG: "Piano track too long: {}",
+  Rejection.NO_PROGRAM_CLASSES: "No program classes: {}",
+  Rejection.NO_MATCHING_TAGS: "No matching tags: {}",
+  Rejection.TIMEOUT: "Processing time over {} sec",
+  Rejection.MEMORY_LIMIT: "Worker memory over {} MB",
+  Rejection.WORKER_EXIT: "Worker exited during processing: {}",
+  Rejection.QUARANTINED: "Quarantined in a previous run: {}",
+}
+
+
+class Rejected(NamedTuple):
+  """
+  A dropped item, returned instead of the result. The value is the measure
+  that failed the filter (the number of drums, the ratio of bass drums on
+  beat, etc.), or the message of the exception for the errors.
+  """
+  reason: Rejection
+  value: Any = None
+
+  def __bool__(self) -> bool:
+    return False
+
+  @property
+  def message(self) -> str:
+    """
+    :return: the message of the rejection, formatted on demand
+    """
+    return _MESSAGES[self.reason].format(self.value)
+
+
+def count_rejection(rejections: Counter, result: Any):
+  """
+  Counts the given result by reason if it is a rejection.
+
+  :param rejections: the counter of the rejections by reason
+  :param result: the result returned by a worker
+  """
+  if isinstance(result, Rejected):
+    rejections[result.reason.value] += 1
+
+
+def print_rejections(rejections: Counter, total_count: int):
+  """
+  Prints the number of dropped items for each reason.
+
+  :param rejections: the counter of the rejections by reason
+  :param total_count: the number of processed items
+  """
+  for reason, count in rejections.most_common():
+    percentage = count / total_count * 100 if total_count else 0
+    print(f"Number of rejections ({reason}): {count} ({percentage:.2f}%)")
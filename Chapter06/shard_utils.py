@@ -0,0 +1,175 @@
+"""
+Sharding utilities, to split the processing of the dataset between machines
+or independent processes.
+
+The keys (MSD ids or MIDI paths) are partitioned by a stable hash, so every
+machine and every run computes the same partition. Each shard saves the
+statistics of its run (the counts, the counters and the histogram values)
+using save_stats, then the statistics and the manifests of the shards are
+merged using the main of this file.
+"""
+
+import argparse
+import hashlib
+import json
+from collections import Counter
+from typing import Dict
+from typing import List
+from typing import Union
+
+import matplotlib.pyplot as plt
+from bokeh.colors.groups import purple as colors
+
+from manifest_utils import Manifest
+
+# A statistic of a run: a count, a counter or the values of an histogram
+Stat = Union[int, float, Counter, List[float]]
+
+
+def get_shard_index(key: str, num_shards: int) -> int:
+  """
+  Returns the shard of the given key, using the MD5 of the key since the
+  hash function of Python is randomized for each process.
+
+  :param key: the MSD id or MIDI path (relative to the dataset directory)
+  :param num_shards: the number of shards
+  :return: the index of the shard, between 0 and num_shards - 1
+  """
+  digest = hashlib.md5(key.encode("utf-8")).digest()
+  return int.from_bytes(digest[:8], "big") % num_shards
+
+
+class Shard(object):
+  """
+  A shard of the keys (MSD ids or MIDI paths), use "key in shard" to filter
+  the keys of the shard.
+  """
+
+  def __init__(self, num_shards: int, index: int):
+    """
+    Constructs the shard.
+
+    :param num_shards: the number of shards
+    :param index: the index of the shard, between 0 and num_shards - 1
+    """
+    if not 0 <= index < num_shards:
+      raise Exception(f"Invalid shard index {index} for {num_shards} shards")
+    self.num_shards = num_shards
+    self.index = index
+
+  def __contains__(self, key: str) -> bool:
+    return get_shard_index(key, self.num_shards) == self.index
+
+  def __repr__(self):
+    return f"Shard({self.index}/{self.num_shards})"
+
+
+def save_stats(stats_path: str, stats: Dict[str, Stat]):
+  """
+  Saves the statistics of a run, to merge them with the other shards.
+
+  :param stats_path: the path to the statistics JSON file
+  :param stats: the statistics by name, the counts are summed, the counters
+  are added and the histogram values are concatenated by merge_stats
+  """
+  with open(stats_path, "w") as file:
+    json.dump(stats, file, default=float)
+
+
+def load_stats(stats_path: str) -> Dict[str, Stat]:
+  """
+  Loads the statistics of a run, see save_stats.
+
+  :param stats_path: the path to the statistics JSON file
+  :return: the statistics by name
+  """
+  with open(stats_path) as file:
+    stats = json.load(file)
+  return {name: Counter(stat) if isinstance(stat, dict) else stat
+          for name, stat in stats.items()}
+
+
+def merge_stats(stats_list: List[Dict[str, Stat]]) -> Dict[str, Stat]:
+  """
+  Merges the statistics of the shards of a run, the result is the same as
+  the statistics of the whole run.
+
+  :param stats_list: the statistics of each shard, see load_stats
+  :return: the merged statistics by name
+  """
+  merged_stats = {}
+  for stats in stats_list:
+    for name, stat in stats.items():
+      if name not in merged_stats:
+        merged_stats[name] = (Counter(stat) if isinstance(stat, dict)
+                              else list(stat) if isinstance(stat, list)
+                              else stat)
+      elif isinstance(stat, dict):
+        merged_stats[name].update(stat)
+      elif isinstance(stat, list):
+        merged_stats[name].extend(stat)
+      else:
+        merged_stats[name] += stat
+  return merged_stats
+
+
+def merge_manifests(manifest_paths: List[str], merged_manifest_path: str):
+  """
+  Merges the manifests of the shards of a run, the merged manifest can be
+  used to resume the whole run.
+
+  :param manifest_paths: the paths to the manifests of the shards
+  :param merged_manifest_path: the path to the merged manifest, the entries
+  are added to the existing entries
+  """
+  merged_manifest = Manifest(merged_manifest_path)
+  for manifest_path in manifest_paths:
+    merged_manifest.merge(manifest_path)
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--path_stats", type=str, nargs="+")
+  parser.add_argument("--path_merged_stats", type=str)
+  parser.add_argument("--path_manifests", type=str, nargs="+")
+  parser.add_argument("--path_merged_manifest", type=str)
+  args = parser.parse_args()
+  if not args.path_stats and not args.path_manifests:
+    parser.error("--path_stats or --path_manifests is required")
+  if args.path_manifests and not args.path_merged_manifest:
+    parser.error("--path_merged_manifest is required with --path_manifests")
+
+  if args.path_manifests:
+    merge_manifests(args.path_manifests, args.path_merged_manifest)
+    print(f"Number of items in merged manifest: "
+          f"{len(Manifest(args.path_merged_manifest))}")
+
+  if args.path_stats:
+    stats = merge_stats([load_stats(path) for path in args.path_stats])
+    if args.path_merged_stats:
+      save_stats(args.path_merged_stats, stats)
+    for name, stat in stats.items():
+      if isinstance(stat, Counter):
+        most_common = stat.most_common(25)
+        print(f"Most common {name}: {most_common}")
+        plt.figure(num=None, figsize=(10, 8), dpi=500)
+        plt.bar([key for key, _ in most_common],
+                [count for _, count in most_common],
+                color=[color.name for color in colors
+                       if color.name != "lavender"])
+        plt.title(name)
+        plt.xticks(rotation=30, horizontalalignment="right")
+        plt.ylabel("count")
+        plt.show()
+      elif isinstance(stat, list):
+        print(f"Number of {name}: {len(stat)}")
+        plt.figure(num=None, figsize=(10, 8), dpi=500)
+        plt.hist(stat, bins=100, color="darkmagenta")
+        plt.title(name)
+        plt.show()
+      else:
+        print(f"Number of {name}: {stat}")
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,457 @@
+"""
+Standard MIDI File (SMF) scanner utilities, to find the instruments of a
+MIDI file without parsing it with PrettyMIDI.
+
+PrettyMIDI (and mido under it) builds an object for every event and note
+of the file, and converts every tick to a time, where the instrument
+classes only need the program and the channel of each instrument. The
+scanner walks the bytes of the chunks, keeps the program of each channel
+and the ticks of the open notes, and returns the instruments in the same
+order as PrettyMIDI.instruments. An instrument is created by PrettyMIDI for
+a (program, channel, track) when one of its notes ends after its start, so
+the note events are still decoded, but nothing is allocated for them.
+
+The scanner raises for the files mido or PrettyMIDI can't load (invalid
+chunks, status or data bytes, truncated events, meta events that can't be
+decoded, corrupt tempos or time signatures), use the main of this file to
+compare the scanner with PrettyMIDI on a dataset.
+"""
+
+import argparse
+import io
+import struct
+import timeit
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import NamedTuple
+from typing import Set
+from typing import Tuple
+from typing import Union
+
+from pretty_midi import PrettyMIDI
+from pretty_midi import program_to_instrument_class
+
+from lakh_utils import sample_midi_paths
+from metrics_utils import add_bytes_read
+from metrics_utils import timed
+from rejection_utils import Rejected
+from rejection_utils import Rejection
+
+# The maximum tick of a file, PrettyMIDI considers the file corrupt above
+MAX_TICK = 1e7
+
+# The maximum length of a meta or sysex event, mido doesn't read them above
+MAX_MESSAGE_LENGTH = 1000000
+
+# The drum channel (channel 10)
+DRUM_CHANNEL = 9
+
+# The length in bytes (including the status byte) of the system messages
+# allowed in a track by mido, the sysex and meta events have their own length
+_SYSTEM_MESSAGE_LENGTHS = {0xf1: 2, 0xf2: 3, 0xf3: 2, 0xf6: 1,
+                           0xf8: 1, 0xfa: 1, 0xfb: 1, 0xfc: 1, 0xfe: 1}
+
+# The minimum length of the data of the meta events decoded by mido
+_META_MIN_LENGTHS = {0x20: 1, 0x51: 3, 0x54: 5, 0x58: 4, 0x59: 2}
+
+
+class ScannedInstrument(NamedTuple):
+  """
+  An instrument of a MIDI file, as created by PrettyMIDI.
+  """
+  program: int
+  channel: int
+  track: int
+
+  @property
+  def is_drum(self) -> bool:
+    return self.channel == DRUM_CHANNEL
+
+
+def _check_meta(meta_type: int,
+                data: bytes,
+                track: int,
+                tick: int,
+                resolution: int):
+  # Raises for the meta events mido can't decode, and for the tempo and
+  # signatures of the first track PrettyMIDI can't load
+  if len(data) < _META_MIN_LENGTHS.get(meta_type, 0):
+    raise Exception(f"Invalid meta event 0x{meta_type:02x} length: "
+                    f"{len(data)}")
+  if meta_type == 0x00 and len(data) == 1:
+    raise Exception("Invalid sequence number length: 1")
+  if meta_type == 0x54 and data[0] >> 5 > 3:
+    raise Exception(f"Invalid SMPTE frame rate: {data[0] >> 5}")
+  if meta_type == 0x59:
+    key = data[0] - 256 if data[0] > 127 else data[0]
+    if not -7 <= key <= 7 or data[1] > 1:
+      raise Exception(f"Could not decode key {key} with mode {data[1]}")
+  if track == 0:
+    if meta_type == 0x51 and not (data[0] or data[1] or data[2]):
+      raise Exception("Invalid tempo: 0")
+    if meta_type == 0x58 and not data[0]:
+      raise Exception("Invalid time signature numerator: 0")
+    if meta_type in (0x58, 0x59) and resolution < 0 and tick > 0:
+      raise Exception(f"Invalid signature time at tick {tick}")
+
+
+def _read_variable_int(content: bytes, position: int) -> Tuple[int, int]:
+  value = 0
+  while True:
+    byte = content[position]
+    position += 1
+    value = (value << 7) | (byte & 0x7f)
+    if byte < 0x80:
+      return value, position
+
+
+def _scan_track(content: bytes,
+                position: int,
+                track: int,
+                resolution: int,
+                instruments: Dict[ScannedInstrument, None]) -> Tuple[int, int]:
+  # Scans the track chunk at the given position, adds the instruments of
+  # the track and returns the (position after the track, last tick) tuple
+  name, size = struct.unpack_from(">4sL", content, position)
+  if name != b"MTrk":
+    raise Exception("No MTrk header at start of track")
+  position += 8
+  end = position + size
+  programs = [0] * 16
+  # The (first, last) ticks of the open notes of each channel and pitch,
+  # PrettyMIDI closes the notes started before the note off and keeps the
+  # notes started at the same tick
+  open_notes = {}
+  tick = 0
+  last_status = None
+  events_count = 0
+  while position != end:
+    delta = content[position]
+    if delta < 0x80:
+      # Most deltas are a single byte
+      position += 1
+    else:
+      delta, position = _read_variable_int(content, position)
+    tick += delta
+    events_count += 1
+    status = content[position]
+    running = status < 0x80
+    if running:
+      # Running status, the byte is the first data byte
+      if last_status is None:
+        raise Exception("Running status without last status")
+      status = last_status
+      if status in (0xf0, 0xf7):
+        # mido drops the data byte of a running sysex
+        position += 1
+    else:
+      position += 1
+      if status != 0xff:
+        last_status = status
+
+    if status < 0xf0:
+      kind = status & 0xf0
+      channel = status & 0x0f
+      if kind == 0xc0 or kind == 0xd0:
+        data = content[position]
+        position += 1
+        if data > 127:
+          raise Exception("Data byte must be in range 0..127")
+        if kind == 0xc0:
+          programs[channel] = data
+        continue
+      pitch = content[position]
+      velocity = content[position + 1]
+      position += 2
+      if pitch > 127 or velocity > 127:
+        raise Exception("Data byte must be in range 0..127")
+      if kind == 0x90 and velocity:
+        key = channel << 7 | pitch
+        ticks = open_notes.get(key)
+        open_notes[key] = (tick, tick) if ticks is None else (ticks[0], tick)
+      elif kind == 0x80 or kind == 0x90:
+        key = channel << 7 | pitch
+        ticks = open_notes.pop(key, None)
+        if ticks is not None and ticks[0] != tick:
+          if resolution < 0:
+            # The times decrease with the ticks for a negative resolution
+            raise Exception("Note end time must be greater than start time")
+          instruments[ScannedInstrument(programs[channel],
+                                        channel,
+                                        track)] = None
+          if ticks[1] == tick:
+            open_notes[key] = (tick, tick)
+    elif status == 0xff:
+      meta_type = content[position]
+      length, position = _read_variable_int(content, position + 1)
+      if length > MAX_MESSAGE_LENGTH:
+        raise Exception(f"Message length {length} exceeds maximum length")
+      data = content[position:position + length]
+      if len(data) < length:
+        raise IndexError()
+      position += length
+      _check_meta(meta_type, data, track, tick, resolution)
+    elif status == 0xf0 or status == 0xf7:
+      length, position = _read_variable_int(content, position)
+      if length > MAX_MESSAGE_LENGTH:
+        raise Exception(f"Message length {length} exceeds maximum length")
+      if position + length > len(content):
+        raise IndexError()
+      position += length
+    else:
+      length = _SYSTEM_MESSAGE_LENGTHS.get(status)
+      if length is None:
+        raise Exception(f"Undefined status byte 0x{status:02x}")
+      if running and length == 1:
+        raise Exception(f"Wrong number of bytes for 0x{status:02x}")
+      data = content[position:position + length - 1]
+      if len(data) < length - 1:
+        raise IndexError()
+      position += length - 1
+      if any(byte > 127 for byte in data):
+        raise Exception("Data byte must be in range 0..127")
+  if not events_count:
+    raise Exception(f"Empty track {track}")
+  return position, tick
+
+
+def scan_midi(content: bytes) -> List[ScannedInstrument]:
+  """
+  Returns the instruments of the given MIDI file content, in the same order
+  as the instruments of PrettyMIDI, see the module documentation.
+
+  :param content: the content of the MIDI file
+  :return: the instruments
+  """
+  try:
+    name, size = struct.unpack_from(">4sL", content, 0)
+    if name != b"MThd":
+      raise Exception("MThd not found. Probably not a MIDI file")
+    if size < 6 or len(content) < 14:
+      raise IndexError()
+    _, tracks_count, resolution = struct.unpack_from(">hhh", content, 8)
+    position = 8 + size
+    instruments = {}
+    max_tick = None
+    for track in range(tracks_count):
+      position, tick = _scan_track(content, position, track, resolution,
+                                   instruments)
+      max_tick = tick if max_tick is None else max(max_tick, tick)
+  except (IndexError, struct.error):
+    raise Exception("Unexpected end of file")
+  if max_tick is None:
+    raise Exception("No tracks")
+  if max_tick + 1 > MAX_TICK:
+    raise Exception(f"MIDI file has a largest tick of {max_tick + 1}, it is "
+                    f"likely corrupt")
+  if not resolution:
+    raise Exception("Invalid resolution: 0")
+  return list(instruments)
+
+
+def scan_midi_file(midi_path: str) -> List[ScannedInstrument]:
+  """
+  Reads and scans the given MIDI file, the reading and the scanning are
+  recorded separately in the metrics, see metrics_utils.
+
+  :param midi_path: the path to the MIDI file
+  :return: the instruments, see scan_midi
+  """
+  with timed("midi_read"):
+    with open(midi_path, "rb") as midi_file:
+      content = midi_file.read()
+  add_bytes_read(len(content))
+  with timed("midi_scan"):
+    return scan_midi(content)
+
+
+def _encode_variable_int(value: int) -> bytes:
+  encoded = [value & 0x7f]
+  value >>= 7
+  while value:
+    encoded.append(0x80 | (value & 0x7f))
+    value >>= 7
+  return bytes(reversed(encoded))
+
+
+def _filter_track(content: bytes,
+                  position: int,
+                  kept_channels: Set[int],
+                  output: bytearray) -> int:
+  # Writes the track chunk at the given position with only the channel
+  # events of the kept channels and the meta events, the track must have
+  # been checked by _scan_track, returns the position after the track
+  _, size = struct.unpack_from(">4sL", content, position)
+  position += 8
+  end = position + size
+  track = bytearray()
+  # The delta of the dropped events, added to the next written event
+  pending_delta = 0
+  last_status = None
+  while position != end:
+    delta, position = _read_variable_int(content, position)
+    pending_delta += delta
+    status = content[position]
+    if status < 0x80:
+      status = last_status
+      if status in (0xf0, 0xf7):
+        position += 1
+    else:
+      position += 1
+      if status != 0xff:
+        last_status = status
+
+    if status < 0xf0:
+      kind = status & 0xf0
+      length = 1 if kind == 0xc0 or kind == 0xd0 else 2
+      if status & 0x0f in kept_channels:
+        # The status is always written, the running status of the original
+        # track might come from a dropped event
+        track += _encode_variable_int(pending_delta)
+        track.append(status)
+        track += content[position:position + length]
+        pending_delta = 0
+      position += length
+    elif status == 0xff:
+      length, data_position = _read_variable_int(content, position + 1)
+      track += _encode_variable_int(pending_delta)
+      track.append(0xff)
+      track += content[position:data_position + length]
+      pending_delta = 0
+      position = data_position + length
+    elif status == 0xf0 or status == 0xf7:
+      # The sysex events are ignored by PrettyMIDI
+      length, position = _read_variable_int(content, position)
+      position += length
+    else:
+      position += _SYSTEM_MESSAGE_LENGTHS[status] - 1
+  if pending_delta or not track:
+    # Keeps the length of the track (and of the file) with an end of track
+    track += _encode_variable_int(pending_delta) + b"\xff\x2f\x00"
+  output += b"MTrk" + struct.pack(">L", len(track)) + track
+  return position
+
+
+def filter_midi(content: bytes,
+                keep: Callable[[ScannedInstrument], bool]) -> bytes:
+  """
+  Returns the given MIDI file content with only the channel events of the
+  channels (of each track) having a kept instrument, and the meta events.
+  PrettyMIDI loads the same kept instruments from the filtered content as
+  from the original content, with the same notes, control changes, pitch
+  bends, names and timing, but doesn't decode the other events. Raises for
+  the files PrettyMIDI can't load, see scan_midi.
+
+  :param content: the content of the MIDI file
+  :param keep: the function returning True for the kept instruments, see
+  midi_utils.is_drum_instrument
+  :return: the filtered content
+  """
+  instruments = scan_midi(content)
+  kept_channels = {}
+  for instrument in instruments:
+    if keep(instrument):
+      kept_channels.setdefault(instrument.track, set()).add(instrument.channel)
+  _, size = struct.unpack_from(">4sL", content, 0)
+  _, tracks_count, _ = struct.unpack_from(">hhh", content, 8)
+  position = 8 + size
+  output = bytearray(content[:position])
+  for track in range(tracks_count):
+    position = _filter_track(content, position,
+                             kept_channels.get(track, set()), output)
+  return bytes(output)
+
+
+def read_midi_filtered(
+    midi_path: str,
+    keep: Callable[[ScannedInstrument], bool]) -> PrettyMIDI:
+  """
+  Reads and parses only the kept instruments of the given MIDI file, see
+  filter_midi. The reading, the filtering and the parsing are recorded
+  separately in the metrics, see metrics_utils.
+
+  :param midi_path: the path to the MIDI file
+  :param keep: the function returning True for the kept instruments
+  :return: the PrettyMIDI instance, containing the kept instruments (and
+  the other instruments of their channels)
+  """
+  with timed("midi_read"):
+    with open(midi_path, "rb") as midi_file:
+      content = midi_file.read()
+  add_bytes_read(len(content))
+  with timed("midi_filter"):
+    content = filter_midi(content, keep)
+  with timed("midi_parse"):
+    return PrettyMIDI(io.BytesIO(content))
+
+
+def get_scanned_instrument_classes(
+    instruments: List[ScannedInstrument]) -> Union[List[str], Rejected]:
+  """
+  Returns the list of instruments classes given by PrettyMIDI for the
+  scanned instruments, see chapter_06_example_04.get_instrument_classes.
+
+  :param instruments: the scanned instruments, see scan_midi
+  :return: the list of instruments classes, or the rejection if there are
+  no instruments
+  """
+  classes = [program_to_instrument_class(instrument.program)
+             for instrument in instruments
+             if not instrument.is_drum]
+  drums = ["Drums" for instrument in instruments if instrument.is_drum]
+  classes = classes + drums
+  if not classes:
+    return Rejected(Rejection.NO_PROGRAM_CLASSES, len(classes))
+  return classes
+
+
+def _get_pm_instruments(content: bytes) -> List[Tuple[int, bool]]:
+  pm = PrettyMIDI(io.BytesIO(content))
+  return [(instrument.program, instrument.is_drum)
+          for instrument in pm.instruments]
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--sample_size", type=int, default=1000)
+  parser.add_argument("--seed", type=int)
+  parser.add_argument("--path_dataset_dir", type=str, required=True)
+  args = parser.parse_args()
+
+  midi_paths, _ = sample_midi_paths(args.path_dataset_dir, args.sample_size,
+                                    seed=args.seed)
+  contents = []
+  for midi_path in midi_paths:
+    with open(midi_path, "rb") as midi_file:
+      contents.append(midi_file.read())
+
+  # Compares the instruments (or the failure) of the scanner and PrettyMIDI
+  mismatches = 0
+  pm_time = 0.
+  scan_time = 0.
+  for midi_path, content in zip(midi_paths, contents):
+    start = timeit.default_timer()
+    try:
+      expected = _get_pm_instruments(content)
+    except Exception:
+      expected = None
+    pm_time += timeit.default_timer() - start
+    start = timeit.default_timer()
+    try:
+      scanned = [(instrument.program, instrument.is_drum)
+                 for instrument in scan_midi(content)]
+    except Exception:
+      scanned = None
+    scan_time += timeit.default_timer() - start
+    if scanned != expected:
+      mismatches += 1
+      print(f"Mismatch for {midi_path}: {scanned} instead of {expected}")
+  print(f"Number of MIDI files: {len(midi_paths)}, "
+        f"number of mismatches: {mismatches}")
+  print(f"PrettyMIDI: {pm_time:.3f}s, scanner: {scan_time:.3f}s "
+        f"({pm_time / scan_time if scan_time else 0:.1f}x faster)")
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,339 @@
+"""
+Synthetic dataset utilities, to generate a small dataset with the same
+structure as the Lakh MIDI Dataset matched with the MSD (the MIDI files in
+"lmd_matched", the h5 files in "lmd_matched_h5" and the match scores file),
+with an optional Last.fm tag cache, so the examples can be run and measured
+offline at any scale.
+
+The songs have drums (sometimes split in multiple drum instruments, sometimes
+four on the floor), pianos (sometimes multiple) and other instruments, the
+MIDI files are named by the MD5 of their content like in the LMD, and some
+MIDI files are matched with multiple MSD ids. The generation is
+deterministic for a given seed.
+"""
+
+import argparse
+import hashlib
+import io
+import json
+import os
+import random
+import string
+import timeit
+from functools import partial
+from multiprocessing.pool import Pool
+from typing import Dict
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+from typing import Tuple
+
+import tables
+from pretty_midi import Instrument
+from pretty_midi import Note
+from pretty_midi import PrettyMIDI
+from pretty_midi import TimeSignature
+
+from lakh_utils import get_midi_path
+from lakh_utils import msd_id_to_h5
+from lastfm_utils import TagCache
+from midi_utils import PIANO_PROGRAMS
+from multiprocessing_utils import SharedCounter
+from multiprocessing_utils import imap_results
+
+# The types of the columns of the "metadata.songs" table of the MSD h5 files
+METADATA_COLUMN_TYPES = {
+  "analyzer_version": tables.StringCol(32),
+  "artist_7digitalid": tables.Int32Col(),
+  "artist_familiarity": tables.Float64Col(),
+  "artist_hotttnesss": tables.Float64Col(),
+  "artist_id": tables.StringCol(32),
+  "artist_latitude": tables.Float64Col(),
+  "artist_location": tables.StringCol(1024),
+  "artist_longitude": tables.Float64Col(),
+  "artist_mbid": tables.StringCol(40),
+  "artist_name": tables.StringCol(1024),
+  "artist_playmeid": tables.Int32Col(),
+  "genre": tables.StringCol(1024),
+  "idx_artist_terms": tables.Int32Col(),
+  "idx_similar_artists": tables.Int32Col(),
+  "release": tables.StringCol(1024),
+  "release_7digitalid": tables.Int32Col(),
+  "song_hotttnesss": tables.Float64Col(),
+  "song_id": tables.StringCol(32),
+  "title": tables.StringCol(1024),
+  "track_7digitalid": tables.Int32Col(),
+}
+
+# The tags of the generated songs, most popular first
+TAGS = ["rock", "pop", "electronic", "jazz", "blues", "techno", "house",
+        "classical", "soul", "hip-hop", "country", "metal", "disco", "funk"]
+
+# The drum pitches of the generated drum patterns
+_KICK, _SNARE, _HI_HAT = 36, 38, 42
+
+
+class SyntheticTrack(NamedTuple):
+  """
+  A generated MSD track, with the seed and the score of each matched song.
+  """
+  msd_id: str
+  artist: str
+  title: str
+  song_seeds: List[int]
+  scores: List[float]
+
+
+def generate_midi(seed: int) -> PrettyMIDI:
+  """
+  Generates a song with drums, pianos and other instruments.
+
+  :param seed: the seed of the song, the same seed gives the same song
+  :return: the PrettyMIDI instance
+  """
+  rng = random.Random(seed)
+  tempo = rng.uniform(70, 180)
+  pm = PrettyMIDI(initial_tempo=tempo)
+  pm.time_signature_changes.append(
+    TimeSignature(rng.choice([3, 4, 4, 4, 6]), 4, 0))
+  beat = 60 / tempo
+  num_beats = int(rng.uniform(30, 240) / beat)
+
+  if rng.random() < 0.85:
+    # The drums, the kick drum is sometimes on all the beats, the drum
+    # pitches are sometimes split in multiple instruments
+    four_on_the_floor = rng.random() < 0.3
+    drums = [Instrument(program=0, is_drum=True)
+             for _ in range(3 if rng.random() < 0.15 else 1)]
+    for index in range(num_beats):
+      start = index * beat
+      if four_on_the_floor or (index % 2 == 0 and rng.random() < 0.7):
+        drums[0].notes.append(Note(100, _KICK, start, start + beat / 4))
+      elif rng.random() < 0.2:
+        offbeat = start + beat / 2
+        drums[0].notes.append(Note(90, _KICK, offbeat, offbeat + beat / 4))
+      if index % 2 == 1:
+        drums[1 % len(drums)].notes.append(
+          Note(100, _SNARE, start, start + beat / 4))
+      for eighth in (start, start + beat / 2):
+        drums[2 % len(drums)].notes.append(
+          Note(70, _HI_HAT, eighth, eighth + beat / 8))
+    pm.instruments.extend(drums)
+
+  num_pianos = rng.choices([0, 1, 2, 3], weights=[30, 55, 10, 5])[0]
+  num_others = rng.randint(1, 6)
+  programs = ([rng.choice(PIANO_PROGRAMS) for _ in range(num_pianos)]
+              + [rng.randint(8, 127) for _ in range(num_others)])
+  for program in programs:
+    # The melodic instruments, random notes on the subdivisions of the beats
+    instrument = Instrument(program=program)
+    pitch = rng.randint(36, 84)
+    time = rng.choice([0, 4 * beat, 8 * beat])
+    while time < num_beats * beat:
+      duration = beat * rng.choice([0.25, 0.5, 0.5, 1, 1, 2])
+      if rng.random() < 0.8:
+        pitch = min(max(pitch + rng.randint(-5, 5), 21), 108)
+        instrument.notes.append(Note(rng.randint(60, 110),
+                                     pitch,
+                                     time,
+                                     time + duration))
+      time += duration
+    pm.instruments.append(instrument)
+
+  rng.shuffle(pm.instruments)
+  return pm
+
+
+def _generate_track(track: SyntheticTrack,
+                    dataset_path: str) -> Tuple[str, Dict[str, float]]:
+  # Writes the h5 file and the matched MIDI files of the track, the MIDI
+  # files are named by the MD5 of their content
+  rng = random.Random(track.msd_id)
+  h5_path = msd_id_to_h5(track.msd_id, dataset_path)
+  os.makedirs(os.path.dirname(h5_path), exist_ok=True)
+  values = {
+    "analyzer_version": "",
+    "artist_7digitalid": rng.randint(1, 999999),
+    "artist_familiarity": rng.random(),
+    "artist_hotttnesss": rng.random(),
+    "artist_id": "AR" + _random_id(rng, 16),
+    "artist_latitude": (rng.uniform(-90, 90) if rng.random() < 0.4
+                        else float("nan")),
+    "artist_location": rng.choice(["", "London", "New York", "Montreal"]),
+    "artist_longitude": (rng.uniform(-180, 180) if rng.random() < 0.4
+                         else float("nan")),
+    "artist_mbid": "-".join(_random_id(rng, size).lower()
+                            for size in (8, 4, 4, 4, 12)),
+    "artist_name": track.artist,
+    "artist_playmeid": rng.randint(-1, 99999),
+    "genre": "",
+    "idx_artist_terms": 0,
+    "idx_similar_artists": 0,
+    "release": f"Release {rng.randint(0, 9999)}",
+    "release_7digitalid": rng.randint(1, 999999),
+    "song_hotttnesss": rng.random(),
+    "song_id": "SO" + _random_id(rng, 16),
+    "title": track.title,
+    "track_7digitalid": rng.randint(1, 9999999),
+  }
+  with tables.open_file(h5_path, "w") as h5:
+    group = h5.create_group("/", "metadata")
+    songs = h5.create_table(group, "songs", METADATA_COLUMN_TYPES)
+    row = songs.row
+    for column, value in values.items():
+      row[column] = (value.encode("utf-8") if isinstance(value, str)
+                     else value)
+    row.append()
+    songs.flush()
+
+  scores = {}
+  for song_seed, score in zip(track.song_seeds, track.scores):
+    file = io.BytesIO()
+    generate_midi(song_seed).write(file)
+    content = file.getvalue()
+    midi_md5 = hashlib.md5(content).hexdigest()
+    midi_path = get_midi_path(track.msd_id, midi_md5, dataset_path)
+    os.makedirs(os.path.dirname(midi_path), exist_ok=True)
+    with open(midi_path, "wb") as midi_file:
+      midi_file.write(content)
+    scores[midi_md5] = score
+  return track.msd_id, scores
+
+
+def _random_id(rng: random.Random, size: int) -> str:
+  return "".join(rng.choice(string.ascii_uppercase + string.digits)
+                 for _ in range(size))
+
+
+def plan_tracks(num_tracks: int,
+                max_matches: int = 3,
+                duplicate_ratio: float = 0.05,
+                num_artists: Optional[int] = None,
+                seed: int = 42) -> List[SyntheticTrack]:
+  """
+  Returns the tracks to generate, without generating them.
+
+  :param num_tracks: the number of MSD ids
+  :param max_matches: the maximum number of MIDI files matched with a MSD id
+  :param duplicate_ratio: the ratio of matched MIDI files that are also
+  matched with another MSD id
+  :param num_artists: the number of artists, a tenth of the tracks if not
+  provided, the number of songs per artist is a long tail
+  :param seed: the seed of the dataset
+  :return: the list of tracks
+  """
+  rng = random.Random(seed)
+  num_artists = num_artists or max(num_tracks // 10, 1)
+  msd_ids = set()
+  song_seeds = []
+  tracks = []
+  while len(tracks) < num_tracks:
+    msd_id = "TR" + _random_id(rng, 16)
+    if msd_id in msd_ids:
+      continue
+    msd_ids.add(msd_id)
+    artist_index = int(rng.paretovariate(1.2) - 1) % num_artists
+    track_seeds = []
+    for _ in range(rng.randint(1, max_matches)):
+      if song_seeds and rng.random() < duplicate_ratio:
+        track_seeds.append(rng.choice(song_seeds))
+      else:
+        track_seeds.append(rng.getrandbits(32))
+        song_seeds.append(track_seeds[-1])
+    tracks.append(SyntheticTrack(msd_id,
+                                 f"Artist {artist_index}",
+                                 f"Song {len(tracks)}",
+                                 list(dict.fromkeys(track_seeds)),
+                                 [round(rng.uniform(0.5, 1), 6)
+                                  for _ in dict.fromkeys(track_seeds)]))
+  return tracks
+
+
+def generate_tag_cache(tracks: List[SyntheticTrack],
+                       tag_cache: TagCache,
+                       not_found_ratio: float = 0.1,
+                       seed: int = 42):
+  """
+  Stores the tags of the tracks in the tag cache, like the Last.fm API
+  responses, so the examples can use it with "--tag_cache_only".
+
+  :param tracks: the generated tracks
+  :param tag_cache: the tag cache
+  :param not_found_ratio: the ratio of tracks without tags in the API
+  :param seed: the seed of the tags
+  """
+  rng = random.Random(seed)
+  for track in tracks:
+    if rng.random() < not_found_ratio:
+      tag_cache.put(track.artist, track.title,
+                    error=f"Error in request for '{track.artist}' - "
+                          f"'{track.title}': 'Track not found'")
+    else:
+      num_tags = rng.randint(1, 5)
+      tags = list(dict.fromkeys(rng.choices(
+        TAGS, weights=range(len(TAGS), 0, -1), k=num_tags)))
+      tag_cache.put(track.artist, track.title, tags=tags)
+
+
+def generate_dataset(dataset_path: str,
+                     tracks: List[SyntheticTrack],
+                     pool_size: int = 4,
+                     chunksize: int = 8) -> Dict[str, Dict[str, float]]:
+  """
+  Generates the h5 files, the MIDI files and the match scores file of the
+  tracks in the dataset directory.
+
+  :param dataset_path: the dataset path
+  :param tracks: the tracks to generate, use plan_tracks
+  :param pool_size: the number of processes
+  :param chunksize: the number of tracks sent to a worker at once
+  :return: the MSD score dict, also written in "match_scores.json"
+  """
+  counter = SharedCounter(len(tracks))
+  with Pool(pool_size) as pool:
+    results = dict(imap_results(pool,
+                                partial(_generate_track,
+                                        dataset_path=dataset_path),
+                                tracks,
+                                counter,
+                                chunksize))
+  # Same order as the tracks, for reproducible samples
+  msd_score_matches = {track.msd_id: results[track.msd_id]
+                       for track in tracks}
+  with open(os.path.join(dataset_path, "match_scores.json"), "w") as file:
+    json.dump(msd_score_matches, file)
+  return msd_score_matches
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--pool_size", type=int, default=4)
+  parser.add_argument("--path_dataset_dir", type=str, required=True)
+  parser.add_argument("--path_tag_cache", type=str)
+  parser.add_argument("--num_tracks", type=int, default=1000)
+  parser.add_argument("--max_matches", type=int, default=3)
+  parser.add_argument("--duplicate_ratio", type=float, default=0.05)
+  parser.add_argument("--seed", type=int, default=42)
+  args = parser.parse_args()
+
+  start = timeit.default_timer()
+  tracks = plan_tracks(args.num_tracks,
+                       args.max_matches,
+                       args.duplicate_ratio,
+                       seed=args.seed)
+  msd_score_matches = generate_dataset(args.path_dataset_dir,
+                                       tracks,
+                                       args.pool_size)
+  if args.path_tag_cache:
+    generate_tag_cache(tracks, TagCache(args.path_tag_cache), seed=args.seed)
+  stop = timeit.default_timer()
+  midi_md5s = [midi_md5 for scores in msd_score_matches.values()
+               for midi_md5 in scores]
+  print(f"Number of tracks: {len(msd_score_matches)}, "
+        f"number of MIDI files: {len(midi_md5s)}, "
+        f"number of distinct MIDI files: {len(set(midi_md5s))}")
+  print("Time: ", stop - start)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,152 @@
+"""
+TFRecord utilities, to write the extracted tracks directly as NoteSequence
+TFRecord files, ready for the Magenta pipelines (see
+melody_rnn_pipeline_example.py), instead of writing MIDI files and
+converting them again with Magenta's "convert_dir_to_note_sequences".
+
+Each pool worker appends to its own TFRecord file, since a file can't be
+written by multiple processes. A TFRecord file is a sequence of self
+delimited records, so the files of the workers can be concatenated into a
+single file using the main of this file.
+
+Tensorflow and Magenta are imported on first use, so the examples writing
+MIDI files don't require them.
+"""
+
+import argparse
+import glob
+import os
+import shutil
+import uuid
+from typing import List
+
+from pretty_midi import PrettyMIDI
+
+from metrics_utils import add_bytes_written
+from metrics_utils import timed
+from multiprocessing_utils import deferred_soft_timeout
+
+
+def pm_to_note_sequence(pm: PrettyMIDI,
+                        source_id: str,
+                        collection_name: str):
+  """
+  Converts the PrettyMIDI instance to a NoteSequence, with the same id,
+  filename and collection name as convert_dir_to_note_sequences.
+
+  :param pm: the PrettyMIDI instance
+  :param source_id: the source of the sequence, for example the MSD id
+  :param collection_name: the collection name, for example "drums"
+  :return: the NoteSequence
+  """
+  import magenta.music as mm
+  from magenta.music import note_sequence_io
+  sequence = mm.midi_io.midi_to_note_sequence(pm)
+  sequence.filename = source_id
+  sequence.collection_name = collection_name
+  sequence.id = note_sequence_io.generate_note_sequence_id(
+    source_id, collection_name, "midi")
+  return sequence
+
+
+class NoteSequenceWriter(object):
+  """
+  A NoteSequence TFRecord writer, each process writes to its own file in the
+  output directory. The file is opened lazily for each process, so the
+  writer can be shared with pool workers.
+  """
+
+  def __init__(self, output_dir: str, collection_name: str):
+    """
+    Constructs the writer.
+
+    :param output_dir: the directory of the TFRecord files
+    :param collection_name: the collection name of the sequences, also the
+    prefix of the TFRecord files
+    """
+    self._output_dir = output_dir
+    self._collection_name = collection_name
+    # The files of the shards sharing the output directory don't collide,
+    # even if their workers have the same pid on different machines
+    self._run_id = uuid.uuid4().hex[:8]
+    self._writer = None
+    self._path = None
+    self._pid = None
+
+  def __getstate__(self):
+    # The TFRecord writers cannot be pickled or shared between processes
+    return {"_output_dir": self._output_dir,
+            "_collection_name": self._collection_name,
+            "_run_id": self._run_id,
+            "_writer": None,
+            "_path": None,
+            "_pid": None}
+
+  def _get_writer(self):
+    if self._writer is None or self._pid != os.getpid():
+      import tensorflow as tf
+      os.makedirs(self._output_dir, exist_ok=True)
+      self._path = os.path.join(
+        self._output_dir,
+        f"{self._collection_name}-{self._run_id}-{os.getpid()}.tfrecord")
+      self._writer = tf.python_io.TFRecordWriter(self._path)
+      self._pid = os.getpid()
+    return self._writer
+
+  def write(self, pm: PrettyMIDI, source_id: str) -> str:
+    """
+    Converts the PrettyMIDI instance to a NoteSequence and appends it to the
+    TFRecord file of this process.
+
+    :param pm: the PrettyMIDI instance
+    :param source_id: the source of the sequence, for example the MSD id
+    :return: the path of the TFRecord file containing the sequence
+    """
+    with timed("note_sequence"):
+      sequence = pm_to_note_sequence(pm, source_id, self._collection_name)
+      content = sequence.SerializeToString()
+    with timed("tfrecord_write"), deferred_soft_timeout():
+      writer = self._get_writer()
+      writer.write(content)
+      # The pool workers are terminated at the end of the processing, so
+      # each record is flushed to keep the file complete
+      writer.flush()
+    add_bytes_written(len(content))
+    return self._path
+
+
+def concatenate_tfrecords(tfrecord_paths: List[str], output_path: str):
+  """
+  Concatenates the TFRecord files into a single TFRecord file.
+
+  :param tfrecord_paths: the paths to the TFRecord files, for example the
+  files of the pool workers
+  :param output_path: the path to the TFRecord file to write
+  """
+  tmp_output_path = output_path + ".tmp"
+  with open(tmp_output_path, "wb") as output_file:
+    for tfrecord_path in tfrecord_paths:
+      with open(tfrecord_path, "rb") as tfrecord_file:
+        shutil.copyfileobj(tfrecord_file, output_file)
+  os.replace(tmp_output_path, output_path)
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--path_output_dir", type=str, required=True)
+  parser.add_argument("--collection_name", type=str, required=True)
+  parser.add_argument("--path_output_file", type=str, required=True)
+  args = parser.parse_args()
+
+  tfrecord_paths = sorted(glob.glob(os.path.join(
+    args.path_output_dir, f"{args.collection_name}-*.tfrecord")))
+  if not tfrecord_paths:
+    raise Exception(f"No TFRecord files for {args.collection_name} in "
+                    f"{args.path_output_dir}")
+  concatenate_tfrecords(tfrecord_paths, args.path_output_file)
+  print(f"Number of concatenated files: {len(tfrecord_paths)}, "
+        f"size: {os.path.getsize(args.path_output_file)} bytes")
+
+
+if __name__ == "__main__":
+  main()